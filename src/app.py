@@ -33,17 +33,73 @@ from models import (
 #     Message,
 )
 
-from routes import auth_route, user_route, book_route, club_route, den_route, forum_route
+from services import (
+    volume_cache,
+    search_cache,
+    books_client,
+    cover_store,
+    sql_stats,
+    user_cache,
+    CurrentUser,
+    pool_stats,
+    engine_options,
+    read_replica,
+    forum_hub,
+    stats_report,
+    GOOGLE_BOOKS_API_URL,
+)
+from routes import auth_route, user_route, book_route, club_route, den_route, forum_route, cover_route
 
 # Load environmental variables file
 load_dotenv()
 
 # Import Environmental Variables
 production_db = os.environ.get("DB_URI")
+replica_db = os.environ.get("DB_REPLICA_URI")  # Optional read replica for GET requests
 # If local database should have the format: "postgresql:///<dbname>"
 testrun = os.environ.get("TESTRUN")  # True or False
+db_pool_size = int(os.environ.get("DB_POOL_SIZE", 5))  # persistent connections per worker
+db_max_overflow = int(os.environ.get("DB_MAX_OVERFLOW", 10))  # extra connections per worker under load, -1 unlimited
+db_pool_timeout = float(os.environ.get("DB_POOL_TIMEOUT", 30))  # seconds waiting for a free connection
+db_pool_recycle = int(os.environ.get("DB_POOL_RECYCLE", 1800))  # seconds before a connection is replaced
+db_pool_pre_ping = os.environ.get("DB_POOL_PRE_PING", "True") == "True"  # Check connections before use
+db_statement_timeout = int(os.environ.get("DB_STATEMENT_TIMEOUT_MS", 0))  # PostgreSQL only, 0 disables
+db_pool_wait_warn = float(os.environ.get("DB_POOL_WAIT_WARN_MS", 1000))  # checkout waits logged as warnings
+db_replica_sticky = float(os.environ.get("DB_REPLICA_STICKY_SECONDS", 5))  # reads stay on the primary after a write
 secret_code = os.environ.get("SECRETE_KEY")
 api_key = os.environ.get("GOOGLE_API_KEY")
+books_api_url = os.environ.get("GOOGLE_BOOKS_API_URL", GOOGLE_BOOKS_API_URL)
+books_connect_timeout = float(os.environ.get("GOOGLE_BOOKS_CONNECT_TIMEOUT", 3.05))  # seconds
+books_read_timeout = float(os.environ.get("GOOGLE_BOOKS_READ_TIMEOUT", 10))  # seconds
+books_retries = int(os.environ.get("GOOGLE_BOOKS_RETRIES", 2))
+books_deadline = float(os.environ.get("GOOGLE_BOOKS_DEADLINE", 15))  # seconds for a call and its retries
+books_pool_size = int(os.environ.get("GOOGLE_BOOKS_POOL_SIZE", 10))
+books_breaker_failures = int(os.environ.get("GOOGLE_BOOKS_BREAKER_FAILURES", 5))
+books_breaker_reset = float(os.environ.get("GOOGLE_BOOKS_BREAKER_RESET", 30))  # seconds
+books_lock_dir = os.environ.get("GOOGLE_BOOKS_LOCK_DIR")  # Coalesce calls across workers when set
+books_batch_max = int(os.environ.get("BOOKS_BATCH_MAX", 40))  # volumes per /books/batch request
+volume_cache_ttl = int(os.environ.get("VOLUME_CACHE_TTL", 86400))  # seconds
+volume_cache_entries = int(os.environ.get("VOLUME_CACHE_MAX_ENTRIES", 1024))
+volume_cache_bytes = int(os.environ.get("VOLUME_CACHE_MAX_BYTES", 8 * 1024 * 1024))
+search_cache_ttl = int(os.environ.get("SEARCH_CACHE_TTL", 300))  # seconds
+search_cache_grace = int(os.environ.get("SEARCH_CACHE_GRACE", 3600))  # seconds served stale
+search_cache_entries = int(os.environ.get("SEARCH_CACHE_MAX_ENTRIES", 512))
+search_prefetch_pages = int(os.environ.get("SEARCH_PREFETCH_PAGES", 2))  # upstream pages per search request
+forum_max_page_size = int(os.environ.get("FORUM_MAX_PAGE_SIZE", 50))  # messages per forum page
+forum_stream_heartbeat = float(os.environ.get("FORUM_STREAM_HEARTBEAT", 15))  # seconds between keep-alives
+forum_stream_max_seconds = float(os.environ.get("FORUM_STREAM_MAX_SECONDS", 300))  # before the browser reconnects
+forum_stream_poll_seconds = float(os.environ.get("FORUM_STREAM_POLL_SECONDS", 2))  # reads of the changes made by other workers
+forum_stream_queue_size = int(os.environ.get("FORUM_STREAM_QUEUE_SIZE", 1000))  # events waiting per stream
+forum_changes_retention = int(os.environ.get("FORUM_CHANGES_RETENTION_DAYS", 30))  # forum change log kept, 0 keeps all
+comments_max_page_size = int(os.environ.get("COMMENTS_MAX_PAGE_SIZE", 50))  # comments per page
+sql_stats_headers = os.environ.get("SQL_STATS_HEADERS") == "True"  # Add query count and time headers
+sql_stats_log = os.environ.get("SQL_STATS_LOG") == "True"  # Log query count and time of each request
+sql_stats_slow_ms = float(os.environ.get("SQL_STATS_SLOW_MS", 100))
+stats_log_seconds = float(os.environ.get("STATS_LOG_SECONDS", 300))  # between service stats log lines, 0 disables
+user_cache_ttl = int(os.environ.get("USER_CACHE_TTL", 30))  # seconds a worker may serve a stale user summary
+user_cache_entries = int(os.environ.get("USER_CACHE_MAX_ENTRIES", 4096))
+cover_cache_dir = os.environ.get("COVER_CACHE_DIR")  # Defaults to <instance folder>/covers
+cover_cache_bytes = int(os.environ.get("COVER_CACHE_MAX_BYTES", 256 * 1024 * 1024))  # disk budget for covers
 
 # Setup Flask app
 app = Flask(__name__)
@@ -52,11 +108,71 @@ app.config["DEBUG_TB_INTERCEPT_REDIRECTS"] = False
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 app.config["SQLALCHEMY_ECHO"] = False
 app.config["GOOGLE_API_KEY"] = api_key
+app.config["GOOGLE_BOOKS_API_URL"] = books_api_url
+app.config["GOOGLE_BOOKS_CONNECT_TIMEOUT"] = books_connect_timeout
+app.config["GOOGLE_BOOKS_READ_TIMEOUT"] = books_read_timeout
+app.config["GOOGLE_BOOKS_RETRIES"] = books_retries
+app.config["GOOGLE_BOOKS_DEADLINE"] = books_deadline
+app.config["GOOGLE_BOOKS_POOL_SIZE"] = books_pool_size
+app.config["GOOGLE_BOOKS_BREAKER_FAILURES"] = books_breaker_failures
+app.config["GOOGLE_BOOKS_BREAKER_RESET"] = books_breaker_reset
+app.config["GOOGLE_BOOKS_LOCK_DIR"] = books_lock_dir
+app.config["BOOKS_BATCH_MAX"] = books_batch_max
+app.config["VOLUME_CACHE_TTL"] = volume_cache_ttl
+app.config["VOLUME_CACHE_MAX_ENTRIES"] = volume_cache_entries
+app.config["VOLUME_CACHE_MAX_BYTES"] = volume_cache_bytes
+app.config["SEARCH_CACHE_TTL"] = search_cache_ttl
+app.config["SEARCH_CACHE_GRACE"] = search_cache_grace
+app.config["SEARCH_CACHE_MAX_ENTRIES"] = search_cache_entries
+app.config["SEARCH_PREFETCH_PAGES"] = search_prefetch_pages
+app.config["FORUM_MAX_PAGE_SIZE"] = forum_max_page_size
+app.config["FORUM_STREAM_HEARTBEAT"] = forum_stream_heartbeat
+app.config["FORUM_STREAM_MAX_SECONDS"] = forum_stream_max_seconds
+app.config["FORUM_STREAM_POLL_SECONDS"] = forum_stream_poll_seconds
+app.config["FORUM_STREAM_QUEUE_SIZE"] = forum_stream_queue_size
+app.config["FORUM_CHANGES_RETENTION_DAYS"] = forum_changes_retention
+app.config["COMMENTS_MAX_PAGE_SIZE"] = comments_max_page_size
+app.config["SQL_STATS_HEADERS"] = sql_stats_headers
+app.config["SQL_STATS_LOG"] = sql_stats_log
+app.config["SQL_STATS_SLOW_MS"] = sql_stats_slow_ms
+app.config["DB_POOL_WAIT_WARN_MS"] = db_pool_wait_warn
+app.config["STATS_LOG_SECONDS"] = stats_log_seconds
+app.config["DB_REPLICA_STICKY_SECONDS"] = db_replica_sticky
+app.config["USER_CACHE_TTL"] = user_cache_ttl
+app.config["USER_CACHE_MAX_ENTRIES"] = user_cache_entries
+app.config["COVER_CACHE_MAX_BYTES"] = cover_cache_bytes
+if cover_cache_dir:
+    app.config["COVER_CACHE_DIR"] = cover_cache_dir
 debug = DebugToolbarExtension(app)
+books_client.init_app(app)
+volume_cache.init_app(app)
+search_cache.init_app(app)
+cover_store.init_app(app, books_client.fetch_cover)
+sql_stats.init_app(app)
+user_cache.init_app(app)
+read_replica.init_app(app)
+forum_hub.init_app(app)
+pool_stats.init_app(app)
+stats_report.init_app(app)
+stats_report.register("db_pool", pool_stats.stats)
+stats_report.register("google_books", books_client.stats)
 
 # Detect if testing environmental variable is set to True
 if not testrun:
     app.config["SQLALCHEMY_DATABASE_URI"] = production_db
+    pool_options = dict(
+        pool_size=db_pool_size,
+        max_overflow=db_max_overflow,
+        pool_timeout=db_pool_timeout,
+        pool_recycle=db_pool_recycle,
+        pre_ping=db_pool_pre_ping,
+        statement_timeout_ms=db_statement_timeout,
+    )
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(production_db, **pool_options)
+    if replica_db:
+        app.config["SQLALCHEMY_BINDS"] = {
+            "replica": {"url": replica_db, **engine_options(replica_db, **pool_options)}
+        }
     connect_db(app)
 
 # In case of running the app on python terminal
@@ -66,10 +182,18 @@ if __name__ == "__main__":
 
 @app.before_request
 def load_user():
-    """If user login id found in session, load current user to Flask global."""
+    """If user login id found in session, set a lazy current user on Flask global.
+    The User is only loaded from the database when a view needs more than its identity.
+    A session of a deleted user is logged out, the protected views then redirect to the login."""
+
+    if "CURRENT_USER" in session and user_cache.identity(session["CURRENT_USER"]) is None:
+        # A replica may not have a new account yet, only the primary tells it was deleted
+        with read_replica.on_primary():
+            if user_cache.identity(session["CURRENT_USER"]) is None:
+                session.pop("CURRENT_USER")
 
     if "CURRENT_USER" in session:
-        g.user = db.get_or_404(User, session["CURRENT_USER"])
+        g.user = CurrentUser(session["CURRENT_USER"])
 
     else:
         g.user = None
@@ -83,6 +207,7 @@ app.register_blueprint(book_route)
 app.register_blueprint(club_route, url_prefix='/clubs')
 app.register_blueprint(den_route, url_prefix='/den')
 app.register_blueprint(forum_route, url_prefix='/forum')
+app.register_blueprint(cover_route)
 
 """
 # View functions
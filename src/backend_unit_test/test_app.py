@@ -1,6 +1,8 @@
 import pytest
+import json
 from flask import session, g
 from datetime import date
+from models import db
 
 
 def test_homepage(client):
@@ -185,6 +187,65 @@ def test_create_club(client, test_user):
     assert b"Reading club added to the database" in response.data
 
 
+def test_case_insensitive_uniqueness(client, test_user, models, monkeypatch):
+    """Test E-mails and club names are unique regardless of case, also when validation races an insert"""
+    import forms
+
+    data = {
+        "email": "TEST1@test.com",
+        "username": "newuser",
+        "password": "Password123",
+        "first_name": "New",
+        "last_name": "User",
+    }
+    response = client.post("/register", data=data)
+    assert b"This E-mail is already in the database" in response.data
+
+    # The validator runs before a concurrent signup commits the same E-mail
+    value_taken = forms.value_taken
+    calls = []
+
+    def racing_value_taken(column, value):
+        calls.append(value)
+        return len(calls) > 1 and value_taken(column, value)
+
+    monkeypatch.setattr(forms, "value_taken", racing_value_taken)
+    response = client.post("/register", data=data)
+    assert b"This E-mail is already in the database" in response.data
+    assert models["User"].query.filter_by(username="newuser").first() is None
+    monkeypatch.undo()
+
+    client.post("/login", data={"username": "testuser1", "password": "PassWord1"})
+    response = client.post(
+        "/user/",
+        data={"email": "Test1@Test.com", "first_name": "Test", "last_name": "User", "button": "save"},
+        follow_redirects=True,
+    )
+    assert b"User profile updated" in response.data
+
+    client.post("/clubs/", data={"name": "Test Club", "description": ""})
+    response = client.post("/clubs/", data={"name": "TEST club", "description": ""})
+    assert b"Club Name already taken" in response.data
+    assert models["Club"].query.count() == 1
+
+    # A failed insert revalidated with an error on another field than the name
+    from forms import NewClubForm
+    from wtforms.validators import ValidationError
+
+    checks = []
+
+    def failing_description(form, field):
+        checks.append(field.data)
+        if len(checks) > 1:
+            raise ValidationError("Description rejected")
+
+    monkeypatch.setattr(NewClubForm, "validate_description", failing_description, raising=False)
+    monkeypatch.setattr(models["Club"], "create_club", lambda **kwargs: None)
+    response = client.post("/clubs/", data={"name": "Other Club", "description": "Spam"}, follow_redirects=True)
+    assert response.status_code == 200
+    assert b"Description rejected" in response.data
+
+
 def test_club_membership(client, test_user, models):
     """Test club membership operations."""
     # Login first
@@ -319,3 +380,850 @@ def test_book_details(client, test_user):
     data = response.json
     assert "title" in data
     assert "authors" in data
+
+
+def test_book_routes_degraded(client, test_book, monkeypatch):
+    """Test book search and details fall back to the local catalog when Google Books fails"""
+    from services import books_client, search_cache, volume_cache
+
+    monkeypatch.setattr(books_client, "get_volume", lambda volume_id: (None, 503))
+    monkeypatch.setattr(books_client, "search_volumes", lambda params: (None, 503))
+    search_cache.clear()
+    volume_cache.clear()
+
+    response = client.get(f"/book/{test_book.api_id}")
+    assert response.status_code == 200
+    assert response.json["title"] == "Test Book"
+    assert response.json["degraded"] is True
+    assert response.headers["X-Degraded"] == "1"
+
+    response = client.get("/search?q=test book")
+    assert response.status_code == 200
+    assert response.json[0]["data"]["id"] == test_book.api_id
+    assert response.json[0]["degraded"] is True
+
+    response = client.get("/book/unknown-volume")
+    assert response.status_code == 503
+
+
+def test_book_details_quota_exceeded(client, test_book, monkeypatch):
+    """Test a 403 over the Google Books quota falls back to the local catalog"""
+    from services import books_client, volume_cache
+
+    class QuotaResponse:
+        status_code = 403
+        headers = {}
+
+        def json(self):
+            return {"error": {"code": 403, "errors": [{"reason": "dailyLimitExceeded"}]}}
+
+    monkeypatch.setattr(books_client.session, "get", lambda url, params, timeout: QuotaResponse())
+    monkeypatch.setattr(books_client.breaker, "failure_threshold", 100)
+    volume_cache.clear()
+
+    response = client.get(f"/book/{test_book.api_id}")
+    assert response.status_code == 200
+    assert response.json["degraded"] is True
+
+
+def test_book_search_local_first(client, test_book, monkeypatch):
+    """Test local catalog hits are listed before upstream results, without duplicates"""
+    from services import books_client, search_cache
+
+    upstream = {
+        "items": [
+            {"id": test_book.api_id, "volumeInfo": {"title": "Test Book", "language": "en"}},
+            {"id": "other", "volumeInfo": {"title": "Another Test Book", "language": "en"}},
+        ]
+    }
+    monkeypatch.setattr(books_client, "search_volumes", lambda params: (upstream, 200))
+    search_cache.clear()
+
+    response = client.get("/search?q=test")
+    assert response.status_code == 200
+    assert [book["data"]["id"] for book in response.json] == [test_book.api_id, "other"]
+
+
+def test_books_batch(client, test_book, monkeypatch):
+    """Test the batch route answers cached volumes locally and fetches the others together"""
+    from services import books_client, volume_cache
+
+    volume_cache.clear()
+    volume_cache.set("cached", {"volumeInfo": {"title": "Cached Book"}})
+    requested = []
+
+    def fake_get_volumes(volume_ids):
+        requested.extend(volume_ids)
+        return {
+            "fresh": ({"volumeInfo": {"title": "Fresh Book"}}, 200),
+            "gone": (None, 404),
+        }
+
+    monkeypatch.setattr(books_client, "get_volumes", fake_get_volumes)
+
+    response = client.get("/books/batch?ids=fresh,cached,gone,cached")
+    assert response.status_code == 200
+    assert requested == ["fresh", "gone"]
+    assert [book["title"] for book in response.json["books"]] == ["Fresh Book", "Cached Book"]
+    assert response.json["missing"] == {"gone": 404}
+
+    response = client.get("/books/batch?ids=")
+    assert response.status_code == 400
+
+
+def test_books_batch_single_query(client, models, count_queries, monkeypatch):
+    """Test the payloads stored on the books are read with one query for the whole batch"""
+    from services import books_client, volume_cache
+
+    for api_id in ["stored1", "stored2", "stored3"]:
+        models["Book"].save_book({"api_id": api_id, "title": api_id, "cover": "c"})
+    volume_cache.set_many(
+        {api_id: {"volumeInfo": {"title": api_id.title()}} for api_id in ["stored1", "stored2", "stored3"]}
+    )
+    volume_cache.clear()
+    monkeypatch.setattr(books_client, "get_volumes", lambda volume_ids: pytest.fail("upstream called"))
+
+    with count_queries() as queries:
+        response = client.get("/books/batch?ids=stored1,stored2,stored3")
+    assert [book["title"] for book in response.json["books"]] == ["Stored1", "Stored2", "Stored3"]
+    assert queries.count == 1
+
+
+def test_cover_proxy(client, models, test_user, tmp_path, monkeypatch):
+    """Test covers are fetched once, resized and served with validators"""
+    import io
+    from PIL import Image
+    from services import cover_store
+
+    image = io.BytesIO()
+    Image.new("RGB", (600, 900), "red").save(image, "JPEG")
+    fetched = []
+
+    def fake_fetch(url):
+        fetched.append(url)
+        return image.getvalue(), 200
+
+    monkeypatch.setattr(cover_store, "directory", str(tmp_path))
+    monkeypatch.setattr(cover_store, "fetch", fake_fetch)
+    models["Book"].save_book(
+        {
+            "api_id": "cover1",
+            "title": "Cover Book",
+            "cover": "http://books.google.com/books/content?id=cover1",
+        }
+    )
+
+    # Visitors are sent to Google Books until a logged in user had the cover stored
+    response = client.get("/covers/cover1?size=small")
+    assert response.status_code == 302
+    assert response.location == "https://books.google.com/books/content?id=cover1"
+    assert fetched == []
+
+    client.post("/login", data={"username": "testuser1", "password": "PassWord1"})
+    response = client.get("/covers/cover1?size=small")
+    assert response.status_code == 200
+    assert response.mimetype == "image/jpeg"
+    assert Image.open(io.BytesIO(response.data)).size == (128, 192)
+    assert "immutable" not in response.headers["Cache-Control"]
+    assert "max-age=86400" in response.headers["Cache-Control"]
+    etag = response.headers["ETag"]
+
+    response = client.get("/covers/cover1?size=small", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    client.get("/covers/cover1?size=large")
+    assert fetched == ["https://books.google.com/books/content?id=cover1"]
+
+    assert client.get("/covers/cover1?size=huge").status_code == 400
+    assert client.get("/covers/unknown?src=https://example.com/x.jpg").status_code == 404
+    # A search result src must be the thumbnail of the same volume to be stored, others are redirected to
+    response = client.get("/covers/unknown?src=https://books.google.com/books/content?id=other")
+    assert response.status_code == 302
+    assert response.location == "https://books.google.com/books/content?id=other"
+    assert client.get("/covers/new1?src=https://books.google.com/books/content?id=new1").status_code == 200
+    models["Book"].save_book(
+        {"api_id": "elsewhere1", "title": "Elsewhere", "cover": "https://example.com/elsewhere.jpg"}
+    )
+    response = client.get("/covers/elsewhere1")
+    assert response.status_code == 302
+    assert response.location == "https://example.com/elsewhere.jpg"
+
+    # A cover evicted by another request before it is opened is looked up again
+    get = cover_store.get
+    lookups = []
+
+    def evicted_get(api_id, source_url, size="medium"):
+        lookups.append(api_id)
+        path, etag, mimetype = get(api_id, source_url, size)
+        return (str(tmp_path / "evicted.jpg") if len(lookups) == 1 else path), etag, mimetype
+
+    monkeypatch.setattr(cover_store, "get", evicted_get)
+    response = client.get("/covers/cover1?size=small")
+    assert response.status_code == 200
+    assert Image.open(io.BytesIO(response.data)).size == (128, 192)
+    assert lookups == ["cover1", "cover1"]
+    monkeypatch.setattr(
+        cover_store, "get", lambda api_id, source_url, size="medium": (str(tmp_path / "gone"), "x", "image/jpeg")
+    )
+    response = client.get("/covers/cover1?size=small")
+    assert response.status_code == 302
+    assert response.location == "https://books.google.com/books/content?id=cover1"
+    monkeypatch.setattr(cover_store, "get", get)
+
+    client.post("/logout")
+    assert client.get("/covers/cover1?size=small").status_code == 200
+
+
+def test_cover_store_eviction(tmp_path):
+    """Test the cover store removes the least recently used files past its size limit"""
+    import os
+    from services import CoverStore
+
+    urls = {f"b{n}": f"https://books.google.com/books/content?id=b{n}" for n in range(4)}
+    contents = {url: bytes([n]) * 400 for n, url in enumerate(urls.values())}
+    store = CoverStore(str(tmp_path), fetch=lambda url: (contents[url], 200), max_bytes=1500)
+    for api_id in ["b0", "b1", "b2"]:
+        store.get(api_id, urls[api_id])
+    for path in tmp_path.rglob("*"):
+        os.utime(path, (100, 100))
+    store.get("b0", urls["b0"])  # b0 is now the most recently used
+
+    store.get("b3", urls["b3"])
+    assert sum(path.stat().st_size for path in tmp_path.rglob("*") if path.is_file()) <= 1500
+    assert store.has("b0", urls["b0"]) and store.has("b3", urls["b3"])
+    assert not (store.has("b1", urls["b1"]) and store.has("b2", urls["b2"]))
+
+
+def test_book_details_standin_errors(client, test_book, standin):
+    """Test upstream errors injected by the stand-in fall back to the local catalog"""
+    from services import volume_cache
+
+    volume_cache.clear()
+    standin.config["STANDIN_ERROR_RATE"] = 1.0
+    response = client.get(f"/book/{test_book.api_id}")
+    assert response.status_code == 200
+    assert response.json["degraded"] is True
+
+    standin.config["STANDIN_ERROR_RATE"] = 0.0
+    response = client.get("/book/gCtazG4ZXlQC")
+    assert response.status_code == 200
+    assert response.json["title"] == "The Hobbit"
+
+
+def test_book_search_pagination(client, standin):
+    """Test search pages are read ahead and continued with the returned cursor"""
+    from services import search_cache
+
+    search_cache.clear()
+    response = client.get("/search?q=python")
+    assert response.status_code == 200
+    first_ids = [book["data"]["id"] for book in response.json]
+    assert first_ids[:2] == ["py-001", "py-002"]
+    assert "X-Next-Cursor" not in response.headers
+
+    response = client.get("/search?q=dune")
+    assert len(response.json) == 80
+    cursor = response.headers["X-Next-Cursor"]
+    response = client.get(f"/search?cursor={cursor}")
+    assert response.status_code == 200
+    assert response.json[0]["data"]["title"] == "Dune Volume 81"
+
+    response = client.get("/search?q=dune&format=ndjson")
+    assert response.mimetype == "application/x-ndjson"
+    lines = [json.loads(line) for line in response.data.decode().splitlines()]
+    assert len(lines) == 81
+    assert lines[-1]["next_cursor"] and lines[-1]["degraded"] is False
+
+    assert client.get("/search?cursor=tampered").status_code == 400
+
+
+def test_book_search_full_local_page(client, standin, models):
+    """Test a page filled by local books is streamed when asked and continues with the upstream results"""
+    from services import search_cache
+
+    search_cache.clear()
+    for index in range(40):
+        models["Book"].save_book(
+            {"api_id": f"local-dune-{index}", "title": f"Dune Notes {index}", "cover": "https://example.com/cover.jpg"}
+        )
+
+    response = client.get("/search?q=dune&format=ndjson")
+    assert response.mimetype == "application/x-ndjson"
+    lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert len(lines) == 41
+    assert all(line["data"]["id"].startswith("local-dune-") for line in lines[:-1])
+    cursor = lines[-1]["next_cursor"]
+    assert cursor and lines[-1]["degraded"] is False
+
+    response = client.get("/search?q=dune")
+    assert response.headers["X-Cache"] == "LOCAL"
+    assert response.headers["X-Next-Cursor"] == cursor
+    response = client.get(f"/search?cursor={cursor}")
+    assert response.json[0]["data"]["title"] == "Dune Volume 1"
+
+
+def test_book_search_stream_without_app_context(context, standin):
+    """Test the streamed search body is generated after the request and app contexts are gone"""
+    import threading
+    from app import app
+    from services import search_cache
+
+    search_cache.clear()
+    lines = []
+
+    def read_stream():
+        # A new thread starts without the app context pushed by the test fixtures
+        response = app.test_client().get("/search?q=dune&format=ndjson")
+        lines.extend(json.loads(line) for line in response.get_data(as_text=True).splitlines())
+
+    reader = threading.Thread(target=read_stream)
+    reader.start()
+    reader.join(30)
+    assert len(lines) == 81
+    assert lines[-1]["next_cursor"]
+
+
+"""
+Query Count Tests
+"""
+
+
+def add_test_books(models, user_id, start, quantity):
+    """Add books to the test user reading list"""
+    user = db.session.get(models["User"], user_id)
+    for index in range(start, start + quantity):
+        book = models["Book"].save_book(
+            {"api_id": f"book{index}", "title": f"Book {index}", "cover": "https://example.com/cover.jpg"}
+        )
+        user.add_to_reading_list(book)
+
+
+def test_den_view_query_count(client, test_user, models, count_queries):
+    """Test the den page cost does not grow with the reading list"""
+    client.post("/login", data={"username": "testuser1", "password": "PassWord1"})
+    user_id = test_user.id
+    add_test_books(models, user_id, 0, 2)
+    with count_queries() as few:
+        assert client.get("/den/").status_code == 200
+
+    add_test_books(models, user_id, 2, 8)
+    with count_queries() as many:
+        response = client.get("/den/")
+    assert b"Book 9" in response.data
+    assert len(many) == len(few)
+    assert len(few) == 2  # user identity, reading list with books
+
+
+def test_clubs_views_query_count(client, test_user, models, count_queries):
+    """Test the clubs and club pages cost does not grow with members, books and clubs"""
+    client.post("/login", data={"username": "testuser1", "password": "PassWord1"})
+    user_id = test_user.id
+    club = models["Club"].create_club(name="Club 0", description="", owner_id=user_id)
+    club_id = club.id
+
+    with count_queries() as few_clubs:
+        assert client.get("/clubs/").status_code == 200
+    with count_queries() as few_members:
+        assert client.get(f"/clubs/{club_id}").status_code == 200
+
+    for index in range(1, 6):
+        member = models["User"].signup(
+            {
+                "email": f"member{index}@test.com",
+                "username": f"member{index}",
+                "password": "PassWord1",
+                "first_name": "Member",
+                "last_name": f"{index}",
+            }
+        )
+        models["ClubMembers"].enrol_user(club_id=club_id, member_id=member.id, status=2)
+        other_club = models["Club"].create_club(
+            name=f"Club {index}", description="", owner_id=member.id
+        )
+        models["ClubMembers"].enrol_user(
+            club_id=other_club.id, member_id=user_id, status=3
+        )
+        book = models["Book"].save_book(
+            {"api_id": f"club{index}", "title": f"Club Book {index}", "cover": "https://example.com/cover.jpg"}
+        )
+        db.session.get(models["Club"], club_id).add_book_to_list(book)
+
+    with count_queries() as many_clubs:
+        response = client.get("/clubs/")
+    assert b"Club 5" in response.data
+    assert len(many_clubs) == len(few_clubs)
+    assert len(few_clubs) == 3  # user identity, memberships with clubs, unread counts
+
+    with count_queries() as many_members:
+        response = client.get(f"/clubs/{club_id}")
+    assert b"Club Book 5" in response.data
+    assert len(many_members) == len(few_members)
+    assert len(few_members) == 4  # access probe, club, club books, members
+
+
+def test_book_clubs_uses_cached_memberships(client, test_user, test_book, models, count_queries):
+    """Test the book clubs list reads the memberships from the user cache, not one query per club"""
+    client.post("/login", data={"username": "testuser1", "password": "PassWord1"})
+    user_id, volume_id = test_user.id, test_book.api_id
+    clubs = [
+        models["Club"].create_club(name=f"Club {index}", description="", owner_id=user_id)
+        for index in range(3)
+    ]
+    clubs[1].add_book_to_list(db.session.get(models["Book"], volume_id))
+    friend = models["User"].signup(
+        {
+            "email": "friend@test.com",
+            "username": "friend",
+            "password": "PassWord1",
+            "first_name": "Friend",
+            "last_name": "User",
+        }
+    )
+    other = models["Club"].create_club(name="Not Mine", description="", owner_id=friend.id)
+    models["ClubMembers"].enrol_user(club_id=other.id, member_id=user_id, status=3)
+
+    client.get(f"/book/{volume_id}/clubs")
+    with count_queries() as queries:
+        response = client.get(f"/book/{volume_id}/clubs")
+    assert response.json == {"included": ["Club 1"], "choices": ["Club 0", "Club 2"]}
+    assert len(queries) == 3  # book, club names, clubs listing the book
+
+
+def test_current_user_is_lazy(client, test_user, models, count_queries):
+    """Test the current user is only loaded when a view needs it and its summary is cached"""
+    client.post("/login", data={"username": "testuser1", "password": "PassWord1"})
+    with count_queries() as homepage:
+        response = client.get("/")
+    assert b"testuser1" in response.data
+    assert len(homepage) == 0
+
+    with count_queries() as den:
+        assert client.get("/den/").status_code == 200
+    assert len(den) == 1  # reading list, the identity is cached at login
+
+    user = db.session.get(models["User"], test_user.id)
+    user.update_info({"first_name": "Renamed"})
+    with count_queries() as renamed:
+        assert client.get("/").status_code == 200
+    assert len(renamed) == 1
+
+    db.session.delete(db.session.get(models["User"], test_user.id))
+    db.session.commit()
+    response = client.get("/den/")
+    assert response.status_code == 302
+    assert "/login" in response.location
+    with client.session_transaction() as client_session:
+        assert "CURRENT_USER" not in client_session
+    assert client.get("/").status_code == 200
+
+
+def test_forum_poll_query_count(client, test_user, models, count_queries):
+    """Test the forum poll cost does not grow with the user clubs or the message authors"""
+    client.post("/login", data={"username": "testuser1", "password": "PassWord1"})
+    club = models["Club"].create_club(name="Club 0", description="", owner_id=test_user.id)
+    club_id, user_id = club.id, test_user.id
+    with count_queries() as few:
+        assert client.get(f"/forum/{club_id}/messages").status_code == 200
+
+    for index in range(1, 6):
+        models["Club"].create_club(name=f"Club {index}", description="", owner_id=user_id)
+    with count_queries() as many:
+        assert client.get(f"/forum/{club_id}/messages").status_code == 200
+    # identity check of the session (the club changes dropped the cached user), access probe,
+    # messages page, change log position
+    assert len(many) == len(few) == 4
+
+    for index in range(1, 4):
+        author = models["User"].signup(
+            {
+                "email": f"author{index}@test.com",
+                "username": f"author{index}",
+                "password": "PassWord1",
+                "first_name": "Author",
+                "last_name": f"{index}",
+            }
+        )
+        models["ClubMembers"].enrol_user(club_id=club_id, member_id=author.id, status=2)
+        models["Message"].add_message(club_id=club_id, user_id=author.id, message=f"Post {index}")
+    with count_queries() as page:
+        response = client.get(f"/forum/{club_id}/messages")
+    assert [message["user_username"] for message in response.json["messages"]] == [
+        "author3",
+        "author2",
+        "author1",
+    ]
+    assert response.json["messages"][0]["timestamp"].endswith("Z")
+    assert len(page) == len(few)  # read marker, the session identity is cached since the last poll
+
+    db.session.get(models["ClubMembers"], (club_id, user_id)).delete()
+    assert client.get(f"/forum/{club_id}/messages").status_code == 302
+
+
+def test_read_replica_routing(client, test_user, models, monkeypatch, tmp_path):
+    """Test GET requests read from the replica, except shortly after the user wrote"""
+    from sqlalchemy import create_engine
+    from app import app
+
+    # Without a replica the session is left alone
+    client.post("/login", data={"username": "testuser1", "password": "PassWord1"})
+    client.post("/clubs/", data={"name": "No Replica Club", "description": ""})
+    with client.session_transaction() as flask_session:
+        assert "DB_PRIMARY_UNTIL" not in flask_session
+
+    replica = create_engine(f"sqlite:///{tmp_path / 'replica.db'}")
+    db.metadata.create_all(replica)  # same schema, no rows: a replica lagging behind
+    monkeypatch.setitem(db.engines, "replica", replica)
+
+    client.post("/login", data={"username": "testuser1", "password": "PassWord1"})
+    models["Club"].create_club(name="Primary Club", description="", owner_id=test_user.id)
+    assert b"Primary Club" not in client.get("/clubs/").data
+
+    client.post("/clubs/", data={"name": "Replica Club", "description": ""})
+    assert b"Primary Club" in client.get("/clubs/").data
+
+    monkeypatch.setattr(app.extensions["read_replica"], "sticky_seconds", 0)
+    client.post("/clubs/", data={"name": "Replica Club 2", "description": ""})
+    assert b"Primary Club" not in client.get("/clubs/").data
+    assert models["Club"].query.count() == 4
+
+    # A flush during a replica read goes to the primary, and so do the reads after it
+    with app.test_request_context("/clubs/"):
+        app.preprocess_request()
+        assert g.db_replica
+        db.session.add(models["Club"](name="Flushed Club", description=""))
+        db.session.flush()
+        assert not g.db_replica
+        assert models["Club"].query.filter_by(name="Flushed Club").count() == 1
+        db.session.rollback()
+    replica.dispose()
+
+
+def test_club_forum_stream(client, test_user, models, monkeypatch):
+    """Test the forum stream sends the change log after the first page position and resumes after Last-Event-ID"""
+    import time
+    from app import app
+
+    monkeypatch.setitem(app.config, "FORUM_STREAM_MAX_SECONDS", 0.1)
+    monkeypatch.setitem(app.config, "FORUM_STREAM_HEARTBEAT", 0.05)
+    client.post("/login", data={"username": "testuser1", "password": "PassWord1"})
+    club = models["Club"].create_club(name="Live Club", description="", owner_id=test_user.id)
+    club_id, user_id = club.id, test_user.id
+
+    start = client.get(f"/forum/{club_id}/messages").json["changes_seq"]
+    message = client.post(f"/forum/{club_id}/messages", json={"message": "Live hello"}).json["message"]
+    # Posted by another worker: only in the shared change log
+    other = models["Message"].add_message(club_id, user_id, "From another worker")
+    other_id = other.id
+
+    response = client.get(f"/forum/{club_id}/stream?since={start}")
+    assert response.mimetype == "text/event-stream"
+    body = response.get_data(as_text=True)
+    assert [line for line in body.splitlines() if line.startswith("event:")] == [
+        "event: created",
+        "event: created",
+    ]
+    assert "Live hello" in body and "From another worker" in body
+    event_ids = [int(line[4:]) for line in body.splitlines() if line.startswith("id:")]
+    changes = client.get(f"/forum/{club_id}/changes?since={start}").json["changes"]
+    assert event_ids == [change["seq"] for change in changes]  # event ids are change log positions
+
+    client.patch(f"/forum/{club_id}/messages/{message['id']}", json={"message": "Live edit"})
+    client.delete(f"/forum/{club_id}/messages/{other_id}", json={})
+    body = client.get(
+        f"/forum/{club_id}/stream?since={start}", headers={"Last-Event-ID": str(event_ids[-1])}
+    ).get_data(as_text=True)
+    assert [line for line in body.splitlines() if line.startswith("event:")] == [
+        "event: edited",
+        "event: deleted",
+    ]
+    assert "Live edit" in body and f'"id": {other_id}' in body
+
+    body = client.get(f"/forum/{club_id}/stream").get_data(as_text=True)
+    assert "event:" not in body and ": keep-alive" in body
+    body = client.get(f"/forum/{club_id}/stream", headers={"Last-Event-ID": "expired-1"}).get_data(as_text=True)
+    assert "event: reset" in body
+
+    # A member removed while the stream is open is disconnected at the next heartbeat
+    checks = []
+
+    def removed_after_open(club_id, member_id):
+        checks.append(member_id)
+        return len(checks) == 1
+
+    monkeypatch.setitem(app.config, "FORUM_STREAM_MAX_SECONDS", 30)
+    monkeypatch.setattr(models["ClubMembers"], "has_access", removed_after_open)
+    started = time.monotonic()
+    body = client.get(f"/forum/{club_id}/stream").get_data(as_text=True)
+    assert time.monotonic() - started < 5
+    assert len(checks) == 2 and ": keep-alive" not in body
+
+
+def test_club_changes_delta(client, test_user, models):
+    """Test the changes route returns the latest change of each message since a position"""
+    client.post("/login", data={"username": "testuser1", "password": "PassWord1"})
+    club = models["Club"].create_club(name="Delta Club", description="", owner_id=test_user.id)
+    club_id = club.id
+    kept = client.post(f"/forum/{club_id}/messages", json={"message": "Kept"}).json["message"]
+    since = client.get(f"/forum/{club_id}/messages").json["changes_seq"]
+    assert since > 0
+
+    edited = client.post(f"/forum/{club_id}/messages", json={"message": "Draft"}).json["message"]
+    client.patch(f"/forum/{club_id}/messages/{edited['id']}", json={"message": "Final"})
+    client.delete(f"/forum/{club_id}/messages/{kept['id']}", json={})
+
+    delta = client.get(f"/forum/{club_id}/changes?since={since}").json
+    assert [(change["type"], change.get("id")) for change in delta["changes"]] == [
+        ("created", None),
+        ("deleted", kept["id"]),
+    ]
+    assert delta["changes"][0]["message"]["message"] == "Final"
+    assert delta["more"] is False
+
+    assert client.get(f"/forum/{club_id}/changes?since={delta['latest']}").json["changes"] == []
+    assert client.get(f"/forum/{club_id}/changes?since=abc").status_code == 400
+
+    # Positions before the pruned part of the log must reload the messages
+    from datetime import datetime, timedelta, timezone
+    from models import MessageChange
+
+    MessageChange.prune(datetime.now(timezone.utc) + timedelta(days=1))
+    db.session.commit()
+    assert client.get(f"/forum/{club_id}/changes?since={since}").status_code == 410
+    assert client.get(f"/forum/{club_id}/changes?since={delta['latest']}").json["changes"] == []
+
+
+def test_club_forum_search(client, test_user, models):
+    """Test the forum search ranks, highlights and pages the matching messages"""
+    client.post("/login", data={"username": "testuser1", "password": "PassWord1"})
+    club = models["Club"].create_club(name="Search Club", description="", owner_id=test_user.id)
+    other = models["Club"].create_club(name="Other Club", description="", owner_id=test_user.id)
+    club_id = club.id
+    for index in range(3):
+        models["Message"].add_message(club_id, test_user.id, f"Chapter {index} has <b>dragons</b>")
+    models["Message"].add_message(club_id, test_user.id, "Dragons, dragons and more dragons")
+    models["Message"].add_message(club_id, test_user.id, "Nothing to see here")
+    models["Message"].add_message(other.id, test_user.id, "Dragons in another club")
+
+    response = client.get(f"/forum/{club_id}/search?q=dragon&quantity=2")
+    assert response.status_code == 200
+    page = response.json
+    assert page["results"][0]["message"] == "Dragons, dragons and more dragons"
+    assert page["results"][1]["highlight"] == "Chapter 2 has &lt;b&gt;<mark>dragons</mark>&lt;/b&gt;"
+
+    response = client.get(f"/forum/{club_id}/search?q=dragon&quantity=2&cursor={page['next_cursor']}")
+    page = response.json
+    assert [result["message"] for result in page["results"]] == [
+        "Chapter 1 has <b>dragons</b>",
+        "Chapter 0 has <b>dragons</b>",
+    ]
+    assert page["next_cursor"] is None
+
+    assert client.get(f"/forum/{club_id}/search?q=hobbits").json["results"] == []
+    assert client.get(f"/forum/{club_id}/search?q=").status_code == 400
+    first = client.get(f"/forum/{club_id}/search?q=dragon&quantity=1").json["next_cursor"]
+    assert client.get(f"/forum/{club_id}/search?q=chapter&cursor={first}").status_code == 400
+
+
+def test_clubs_unread_counts(client, test_user, models, count_queries):
+    """Test the clubs page shows the messages posted since the member last read the forum"""
+    client.post("/login", data={"username": "testuser1", "password": "PassWord1"})
+    user_id = test_user.id
+    friend = models["User"].signup(
+        {
+            "email": "friend@test.com",
+            "username": "friend",
+            "password": "PassWord1",
+            "first_name": "Friend",
+            "last_name": "User",
+        }
+    )
+    friend_id = friend.id
+    club_ids = []
+    for index in range(3):
+        club = models["Club"].create_club(name=f"Busy Club {index}", description="", owner_id=user_id)
+        models["ClubMembers"].enrol_user(club_id=club.id, member_id=friend_id, status=2)
+        club_ids.append(club.id)
+    for club_id, posts in zip(club_ids, [2, 0, 3]):
+        for index in range(posts):
+            models["Message"].add_message(club_id, friend_id, f"News {index}")
+    models["Message"].add_message(club_ids[1], user_id, "My own message")
+
+    assert models["ClubMembers"].unread_counts(user_id) == {club_ids[0]: 2, club_ids[2]: 3}
+    with count_queries() as clubs_page:
+        response = client.get("/clubs/")
+    assert response.data.count(b"New forum messages") == 2
+    assert len(clubs_page) == 3  # user identity, memberships with clubs, unread counts
+
+    client.get(f"/forum/{club_ids[2]}/messages")
+    assert models["ClubMembers"].unread_counts(user_id) == {club_ids[0]: 2}
+    later = models["Message"].add_message(club_ids[2], friend_id, "Later news")
+    later_id = later.id
+    assert models["ClubMembers"].unread_counts(user_id) == {club_ids[0]: 2, club_ids[2]: 1}
+
+    # Messages shown by the live forum are marked read by the page
+    assert client.post(f"/forum/{club_ids[2]}/read", json={"message_id": later_id}).status_code == 200
+    assert models["ClubMembers"].unread_counts(user_id) == {club_ids[0]: 2}
+    assert client.post(f"/forum/{club_ids[0]}/read", json={"message_id": later_id}).status_code == 404
+    assert client.post(f"/forum/{club_ids[0]}/read", json={}).status_code == 400
+    assert models["ClubMembers"].unread_counts(user_id) == {club_ids[0]: 2}
+
+    # New members and accepted invites start with the history read
+    newcomer = models["User"].signup(
+        {
+            "email": "newcomer@test.com",
+            "username": "newcomer",
+            "password": "PassWord1",
+            "first_name": "New",
+            "last_name": "Comer",
+        }
+    )
+    newcomer_id = newcomer.id
+    models["ClubMembers"].enrol_user(club_id=club_ids[0], member_id=newcomer_id, status=2)
+    invite = models["ClubMembers"].enrol_user(club_id=club_ids[2], member_id=newcomer_id, status=3)
+    models["Message"].add_message(club_ids[2], friend_id, "Before the invite is accepted")
+    assert invite.accept_invite()
+    assert models["ClubMembers"].unread_counts(newcomer_id) == {}
+    models["Message"].add_message(club_ids[0], friend_id, "Welcome")
+    assert models["ClubMembers"].unread_counts(newcomer_id) == {club_ids[0]: 1}
+
+
+def test_sql_stats_headers(client, test_user, query_budget, monkeypatch):
+    """Test request SQL statistics are reported in the response headers when enabled"""
+    from app import app
+
+    client.post("/login", data={"username": "testuser1", "password": "PassWord1"})
+    monkeypatch.setitem(app.config, "SQL_STATS_HEADERS", True)
+    with query_budget(1):
+        response = client.get("/den/")
+    assert response.headers["X-DB-Queries"] == "1"
+    assert float(response.headers["X-DB-Time-ms"]) >= 0
+    assert response.headers["Server-Timing"].startswith("db;dur=")
+    assert float(response.headers["X-DB-Pool-Wait-ms"]) >= 0
+    assert "X-DB-Pool-Saturation" in response.headers
+
+    monkeypatch.setitem(app.config, "SQL_STATS_HEADERS", False)
+    assert "X-DB-Queries" not in client.get("/den/").headers
+
+
+def test_service_stats_log(client, monkeypatch, caplog):
+    """Test the pool and Google Books counters are logged by the first request after the interval"""
+    from services import stats_report
+
+    monkeypatch.setattr(stats_report, "interval", 60)
+    client.get("/")
+    assert "Service stats" not in caplog.text
+    monkeypatch.setattr(stats_report, "_last", stats_report._last - 60)
+    with caplog.at_level("INFO"):
+        client.get("/")
+    line = next(record.getMessage() for record in caplog.records if "Service stats" in record.getMessage())
+    stats = json.loads(line.split(": ", 1)[1])
+    assert stats["db_pool"]["timeouts"] >= 0
+    assert stats["google_books"]["circuit"] in ("closed", "open", "half_open")
+    assert "latency" in stats["google_books"]
+
+
+def test_club_messages_keyset_pages(client, test_user, models):
+    """Test forum pages follow the cursors without repeating or skipping messages"""
+    from datetime import datetime, timedelta
+
+    client.post("/login", data={"username": "testuser1", "password": "PassWord1"})
+    club = models["Club"].create_club(
+        name="Test Club", description="Test Description", owner_id=test_user.id
+    )
+    start = datetime(2024, 1, 1)
+    for index in range(5):
+        db.session.add(
+            models["Message"](
+                club_id=club.id,
+                user_id=test_user.id,
+                message=f"Message {index}",
+                timestamp=start + timedelta(minutes=index // 2),
+            )
+        )
+    db.session.commit()
+
+    response = client.get(f"/forum/{club.id}/messages?quantity=2")
+    page = response.json
+    assert [m["message"] for m in page["messages"]] == ["Message 4", "Message 3"]
+    assert page["more"] is True
+    newest = page["next_after"]
+
+    response = client.get(f"/forum/{club.id}/messages?quantity=2&before={page['next_before']}")
+    page = response.json
+    assert [m["message"] for m in page["messages"]] == ["Message 2", "Message 1"]
+
+    models["Message"].add_message(club_id=club.id, user_id=test_user.id, message="Newer")
+    response = client.get(f"/forum/{club.id}/messages?quantity=2&before={page['next_before']}")
+    page = response.json
+    assert [m["message"] for m in page["messages"]] == ["Message 0"]
+    assert page["next_before"] is None
+
+    response = client.get(f"/forum/{club.id}/messages?after={newest}")
+    assert [m["message"] for m in response.json["messages"]] == ["Newer"]
+
+    response = client.get(f"/forum/{club.id}/messages?quantity=1000")
+    assert len(response.json["messages"]) == 6
+    assert client.get(f"/forum/{club.id}/messages?before=tampered").status_code == 400
+
+
+def test_book_comments_pages(client, test_user, test_book, models, query_budget):
+    """Test book comments are paged with a rating summary and authors loaded in bulk"""
+    user_id = test_user.id
+    client.post("/login", data={"username": "testuser1", "password": "PassWord1"})
+    response = client.get(f"/comments/{test_book.api_id}")
+    assert response.status_code == 200
+    assert response.json["comments"] == []
+    assert response.json["summary"]["count"] == 0
+
+    book_id = test_book.api_id
+    for index, rating in enumerate([5, 4.5, 3, None]):
+        user = models["User"].signup(
+            {
+                "email": f"reader{index}@test.com",
+                "username": f"reader{index}",
+                "password": "PassWord1",
+                "first_name": f"Reader {index}",
+                "last_name": "Test",
+            }
+        )
+        models["Comment"].create_comment(
+            {
+                "user_id": user.id,
+                "book_id": book_id,
+                "date": date(2024, 1, 1 + index // 2),
+                "comment": f"Comment {index}",
+                "rating": rating,
+                "domain": 2,
+            }
+        )
+
+    with query_budget(4):
+        response = client.get(f"/comments/{book_id}?quantity=3")
+    page = response.json
+    assert [comment["comment"] for comment in page["comments"]] == [
+        "Comment 0",
+        "Comment 1",
+        "Comment 2",
+    ]
+    assert page["comments"][0]["username"] == "Reader 0"
+    assert page["summary"]["count"] == 4
+    assert page["summary"]["mean_rating"] == 4.17
+    assert page["summary"]["histogram"]["4"] == 1
+    assert page["summary"]["histogram"]["5"] == 1
+
+    response = client.get(f"/comments/{book_id}?quantity=3&cursor={page['next_cursor']}")
+    assert [comment["comment"] for comment in response.json["comments"]] == ["Comment 3"]
+    assert response.json["next_cursor"] is None
+    assert "summary" not in response.json
+
+    # Comments without a date come first and do not break the cursor
+    models["Comment"].create_comment(
+        {"user_id": user_id, "book_id": book_id, "date": None, "comment": "Undated", "rating": 2, "domain": 2}
+    )
+    seen = []
+    cursor = ""
+    while cursor is not None:
+        response = client.get(f"/comments/{book_id}?quantity=1&cursor={cursor}")
+        assert response.status_code == 200
+        seen += [comment["comment"] for comment in response.json["comments"]]
+        cursor = response.json["next_cursor"]
+    assert seen == ["Undated", "Comment 0", "Comment 1", "Comment 2", "Comment 3"]
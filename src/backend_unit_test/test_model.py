@@ -1,5 +1,7 @@
 import pytest
 from datetime import date, datetime
+from models import db
+from sqlalchemy import text
 
 
 def test_user_model_creation(models, context):
@@ -221,3 +223,264 @@ def test_delete_operations(models, test_user, test_book):
         .first()
     )
     assert user_book.delete() == True
+
+
+def test_book_full_text_search(models, context):
+    """Test the local full text search ranks title matches first"""
+    models["Book"].save_book(
+        {
+            "api_id": "dune1",
+            "title": "Dune",
+            "cover": "https://example.com/dune.jpg",
+            "authors": "Frank Herbert",
+        }
+    )
+    models["Book"].save_book(
+        {
+            "api_id": "essay1",
+            "title": "Essays on Science Fiction",
+            "cover": "https://example.com/essay.jpg",
+            "description": "A long look at Dune and other classics",
+        }
+    )
+
+    results = models["Book"].full_text_search("dune")
+    assert [book.api_id for book in results] == ["dune1", "essay1"]
+    assert [book.api_id for book in models["Book"].full_text_search("herb")] == ["dune1"]
+    assert models["Book"].full_text_search("   ") == []
+
+    book = db.session.get(models["Book"], "dune1")
+    book.title = "Children of Dune"
+    db.session.commit()
+    assert [b.api_id for b in models["Book"].full_text_search("children")] == ["dune1"]
+
+    if db.engine.dialect.name == "sqlite":
+        # VACUUM may renumber the rowids, the index must still point to the right books
+        db.session.delete(book)
+        db.session.execute(text("UPDATE books SET rowid = rowid + 100"))
+        db.session.commit()
+        assert [b.api_id for b in models["Book"].full_text_search("essays")] == ["essay1"]
+
+
+def test_books_search_id_index_is_sqlite_only(models):
+    """Test the search_id index of the SQLite full text index is not created on PostgreSQL"""
+    from sqlalchemy import create_mock_engine
+
+    statements = []
+    engine = create_mock_engine("postgresql://", lambda sql, *args, **kwargs: statements.append(str(sql)))
+    models["Book"].__table__.create(engine, checkfirst=False)
+    assert statements and not any("uq_books_search_id" in statement for statement in statements)
+
+
+def test_schema_migrations_and_indexes(context):
+    """Test migrations upgrade an unversioned database and the hot queries use indexes"""
+    from sqlalchemy import text
+    from migrations import upgrade, check_indexes, LATEST_VERSION
+
+    messages = []
+    assert upgrade(db.engine, log=messages.append) == LATEST_VERSION
+    assert len(messages) == LATEST_VERSION
+    assert upgrade(db.engine, log=messages.append) == LATEST_VERSION
+    assert len(messages) == LATEST_VERSION
+
+    for name, (indexed, plan) in check_indexes(db.engine).items():
+        assert indexed, f"{name}: {plan}"
+
+    with db.engine.begin() as connection:
+        connection.execute(text("DROP TABLE schema_version"))
+
+
+def test_message_change_log(test_user, models):
+    """Test message inserts, edits and deletes are logged in order, deletes as tombstones"""
+    from models import MessageChange
+
+    club = models["Club"].create_club(name="Log Club", description="", owner_id=test_user.id)
+    message = models["Message"].add_message(club_id=club.id, user_id=test_user.id, message="Hello")
+    message_id = message.id
+    message.update_message("Hello again")
+    message.update_message("Hello again")  # unchanged text is not an edit
+    message.delete()
+
+    changes = MessageChange.since(club.id, 0, 10)
+    assert [(change.kind, change.message_id) for change in changes] == [
+        ("created", message_id),
+        ("edited", message_id),
+        ("deleted", message_id),
+    ]
+    assert changes[0].seq < changes[1].seq < changes[2].seq
+    assert MessageChange.latest_seq(club.id) == changes[2].seq
+    assert MessageChange.since(club.id, changes[2].seq, 10) == []
+
+
+def test_message_change_pruning(test_user, models):
+    """Test pruning keeps a marker per club, so old positions are known to be incomplete"""
+    from datetime import datetime, timedelta, timezone
+    from models import MessageChange
+
+    Message = models["Message"]
+    clubs = [
+        models["Club"].create_club(name=f"Pruned Club {index}", description="", owner_id=test_user.id).id
+        for index in range(2)
+    ]
+    old = [Message.add_message(club_id, test_user.id, "Old").id for club_id in clubs for _ in range(3)]
+    recent = Message.add_message(clubs[0], test_user.id, "Recent").id
+    cutoff = datetime.now(timezone.utc) - timedelta(days=30)
+    MessageChange.query.filter(MessageChange.message_id.in_(old)).update(
+        {"changed_at": cutoff - timedelta(days=1)}
+    )
+    db.session.commit()
+    before = [MessageChange.latest_seq(club_id) for club_id in clubs]
+
+    assert MessageChange.horizon(clubs[0]) == 0
+    assert MessageChange.prune(cutoff) == 4
+    db.session.commit()
+    horizons = [MessageChange.horizon(club_id) for club_id in clubs]
+    assert horizons[0] < before[0] and horizons[1] == before[1]
+    assert [change.message_id for change in MessageChange.since(clubs[0], 0, 10)] == [recent]
+    assert MessageChange.since(clubs[1], 0, 10) == []
+    assert MessageChange.prune(cutoff) == 0
+
+    # The markers keep the sequence numbers growing
+    message = Message.add_message(clubs[1], test_user.id, "New")
+    assert MessageChange.latest_seq(clubs[1]) > before[0]
+    assert [change.message_id for change in MessageChange.since(clubs[1], horizons[1], 10)] == [message.id]
+
+
+def test_message_full_text_search(test_user, models):
+    """Test the message search index follows message edits and deletes"""
+    Message = models["Message"]
+    club = models["Club"].create_club(name="Index Club", description="", owner_id=test_user.id)
+    message = Message.add_message(club.id, test_user.id, "The hobbit was slow")
+    message_id = message.id
+    assert [row.id for row, _, _ in Message.full_text_search(club.id, "hobbit")] == [message_id]
+
+    message.update_message("The dwarves were late")
+    assert Message.full_text_search(club.id, "hobbit") == []
+    assert [row.id for row, _, _ in Message.full_text_search(club.id, "dwar")] == [message_id]
+
+    message.delete()
+    assert Message.full_text_search(club.id, "dwarves") == []
+    assert Message.full_text_search(club.id, "!!") == []
+
+
+def test_case_insensitive_index_migration_reports_duplicates(models, test_user):
+    """Test the lower() unique index migration lists the rows that only differ by case"""
+    from migrations import case_insensitive_unique_indexes, MigrationError
+
+    user_id = test_user.id
+    with db.engine.begin() as connection:
+        connection.execute(text("DROP INDEX uq_users_email_lower"))
+        connection.execute(text("DROP INDEX uq_clubs_name_lower"))
+    twin = models["User"].signup(
+        {
+            "email": test_user.email.upper(),
+            "username": "twin",
+            "password": "PassWord1",
+            "first_name": "Twin",
+            "last_name": "User",
+        }
+    )
+    twin_id = twin.id
+
+    with pytest.raises(MigrationError) as error:
+        with db.engine.begin() as connection:
+            case_insensitive_unique_indexes(connection)
+    assert f"users.email 'test1@test.com': ids {user_id}, {twin_id}" in str(error.value)
+    assert "clubs.name" not in str(error.value)
+
+    twin = db.session.get(models["User"], twin_id)
+    twin.email = "twin@test.com"
+    db.session.commit()
+    with db.engine.begin() as connection:
+        case_insensitive_unique_indexes(connection)
+    assert models["User"].signup(
+        {
+            "email": "TWIN@test.com",
+            "username": "triplet",
+            "password": "PassWord1",
+            "first_name": "Triplet",
+            "last_name": "User",
+        }
+    ) is False
+
+
+def test_message_search_pages_are_stable(test_user, models):
+    """Test search pages neither skip nor repeat messages when other clubs post matching messages"""
+    Message = models["Message"]
+    club = models["Club"].create_club(name="Paged Club", description="", owner_id=test_user.id)
+    other = models["Club"].create_club(name="Busy Club", description="", owner_id=test_user.id)
+    club_id, other_id, user_id = club.id, other.id, test_user.id
+    posted = [
+        Message.add_message(club_id, user_id, text).id
+        for text in [
+            "dragon",
+            "dragon dragon and a long tale of the lonely mountain",
+            "a dragon",
+            "dragon dragon dragon",
+            "the dragon slept on gold for a very long time",
+        ]
+    ]
+
+    found, after = [], None
+    while True:
+        page = Message.full_text_search(club_id, "dragon", limit=2, after=after)
+        if not page:
+            break
+        found += [row.id for row, _, _ in page]
+        after = (page[-1][1], page[-1][0].id)
+        # Matches in other clubs must not move the position of the next page
+        for _ in range(5):
+            Message.add_message(other_id, user_id, "dragon " + "word " * 40)
+    assert sorted(found) == sorted(posted)
+    assert len(found) == len(posted)
+
+
+def test_book_rating_summary(models, test_user, test_book):
+    """Test the book rating summary follows the public comments and is rebuilt by its migration"""
+    from models import BookRating
+    from migrations import book_rating_summaries
+
+    Comment = models["Comment"]
+    book_id, user_id = test_book.api_id, test_user.id
+    users = [user_id] + [
+        models["User"].signup(
+            {
+                "email": f"rater{index}@test.com",
+                "username": f"rater{index}",
+                "password": "PassWord1",
+                "first_name": "Rater",
+                "last_name": f"{index}",
+            }
+        ).id
+        for index in range(3)
+    ]
+    comments = [
+        Comment.create_comment(
+            {"user_id": rater, "book_id": book_id, "date": date.today(), "comment": "",
+             "rating": rating, "domain": domain}
+        )
+        for rater, rating, domain in zip(users, [5, 3.5, None, 1], [2, 2, 2, 1])
+    ]
+    summary = BookRating.summary(book_id)
+    assert summary["count"] == 3
+    assert summary["mean_rating"] == 4.25
+    assert summary["histogram"] == {"0": 0, "1": 0, "2": 0, "3": 1, "4": 0, "5": 1}
+
+    comments[3].update({"domain": "2"})  # made public, the form sends text
+    comments[0].update({"rating": 4.5})
+    db.session.delete(comments[1])
+    db.session.commit()
+    expected = {
+        "count": 3,
+        "mean_rating": 2.75,
+        "histogram": {"0": 0, "1": 1, "2": 0, "3": 0, "4": 1, "5": 0},
+    }
+    assert BookRating.summary(book_id) == expected
+
+    db.session.execute(text("DELETE FROM book_ratings"))
+    db.session.commit()
+    assert BookRating.summary(book_id)["count"] == 0
+    with db.engine.begin() as connection:
+        book_rating_summaries(connection)
+    db.session.expire_all()
+    assert BookRating.summary(book_id) == expected
@@ -0,0 +1,590 @@
+import pytest
+import threading
+import time
+import requests
+from datetime import timedelta
+from services import (
+    VolumeCache,
+    SearchCache,
+    BooksClient,
+    CircuitBreaker,
+    SingleFlight,
+    QueryStats,
+    UserCache,
+    CurrentUser,
+    user_cache,
+    pool_stats,
+    PoolMonitor,
+    StatsReport,
+    engine_options,
+    ForumHub,
+    normalize_query,
+)
+from services.volume_cache import utcnow
+from models import db, Book
+
+
+"""
+Volume Cache Tests
+"""
+
+
+def test_volume_cache_lru_eviction(context):
+    """Test the volume cache evicts the least recently used entry"""
+    cache = VolumeCache(ttl=60, max_entries=2)
+    cache.set("a", {"id": "a"})
+    cache.set("b", {"id": "b"})
+    assert cache.get("a") == {"id": "a"}
+    cache.set("c", {"id": "c"})
+
+    assert cache.get("b") is None
+    assert cache.get("a") == {"id": "a"}
+    assert cache.get("c") == {"id": "c"}
+    stats = cache.stats()
+    assert stats["hits"] == 3
+    assert stats["misses"] == 1
+    assert stats["entries"] == 2
+
+
+def test_volume_cache_size_limit(context):
+    """Test the volume cache keeps the total payload size under the limit"""
+    cache = VolumeCache(ttl=60, max_entries=10, max_bytes=40)
+    cache.set("a", {"title": "x" * 20})
+    cache.set("b", {"title": "y" * 20})
+    assert cache.get("a") is None
+    assert cache.get("b") is not None
+    assert cache.stats()["bytes"] <= 40
+
+
+def test_volume_cache_stored_payload(test_book):
+    """Test the volume cache answers from the payload stored on the Book row"""
+    cache = VolumeCache(ttl=60)
+    cache.set(test_book.api_id, {"id": test_book.api_id, "volumeInfo": {}})
+    assert test_book.raw_payload is not None
+
+    cache.invalidate(test_book.api_id)
+    assert cache.get(test_book.api_id) == {"id": test_book.api_id, "volumeInfo": {}}
+    assert cache.stats()["db_hits"] == 1
+
+    test_book.fetched_at = utcnow() - timedelta(seconds=120)
+    cache.invalidate(test_book.api_id)
+    assert cache.get(test_book.api_id) is None
+
+
+def test_volume_cache_isolation(test_book):
+    """Test cached payloads are copies and storing them leaves the request session pending changes alone"""
+    cache = VolumeCache(ttl=60)
+    volume_id = test_book.api_id
+    test_book.title = "Unsaved Title"
+    cache.set(volume_id, {"id": volume_id, "volumeInfo": {"title": "Test Book"}})
+    db.session.rollback()
+    assert db.session.get(Book, volume_id).title == "Test Book"
+
+    payload = cache.get(volume_id)
+    payload["volumeInfo"]["title"] = "Changed"
+    assert cache.get(volume_id)["volumeInfo"]["title"] == "Test Book"
+
+
+"""
+Search Cache Tests
+"""
+
+
+def test_normalize_query():
+    """Test search cache keys are case-folded, whitespace-collapsed and language scoped"""
+    assert normalize_query("  The   HOBBIT ") == "en:the hobbit"
+    assert normalize_query("The Hobbit", "pt") == "pt:the hobbit"
+
+
+def test_search_cache_stale_while_revalidate():
+    """Test stale entries are served while a single background refresh runs"""
+    cache = SearchCache(ttl=0, grace=60)
+    cache.set("en:dune", ["old"])
+    results, status = cache.lookup("en:dune")
+    assert results == ["old"]
+    assert status == "STALE"
+
+    started = threading.Event()
+    release = threading.Event()
+
+    def loader():
+        started.set()
+        release.wait(5)
+        return ["new"], 200
+
+    assert cache.refresh("en:dune", loader)
+    started.wait(5)
+    assert not cache.refresh("en:dune", loader)
+    release.set()
+    for _ in range(50):
+        if cache.stats()["refreshing"] == 0:
+            break
+        time.sleep(0.01)
+    cache.ttl = 60
+    assert cache.lookup("en:dune") == (["new"], "HIT")
+
+
+def test_search_cache_refresh_error(caplog):
+    """Test a failing background refresh is logged and keeps the stale entry"""
+    cache = SearchCache(ttl=0, grace=60)
+    cache.set("en:dune", ["old"])
+
+    def loader():
+        raise RuntimeError("upstream down")
+
+    assert cache.refresh("en:dune", loader)
+    for _ in range(50):
+        if cache.stats()["refreshing"] == 0:
+            break
+        time.sleep(0.01)
+    assert cache.stats()["refresh_errors"] == 1
+    assert "Search cache refresh failed" in caplog.text
+    assert cache.lookup("en:dune") == (["old"], "STALE")
+
+
+def test_search_cache_expired_entry():
+    """Test entries past the grace window are dropped"""
+    cache = SearchCache(ttl=0, grace=0)
+    cache.set("en:dune", ["old"])
+    time.sleep(0.01)
+    assert cache.lookup("en:dune") == (None, "MISS")
+
+
+"""
+Books Client Tests
+"""
+
+
+class FakeResponse:
+    def __init__(self, status_code, payload=None, headers=None):
+        self.status_code = status_code
+        self._payload = payload
+        self.headers = headers or {}
+
+    def json(self):
+        return self._payload
+
+
+def test_books_client_retries(monkeypatch):
+    """Test the books client retries 5xx replies and records latency"""
+    client = BooksClient(api_key="key", retries=2, backoff=0)
+    replies = [FakeResponse(503), FakeResponse(200, {"id": "abc"})]
+    calls = []
+
+    def fake_get(url, params, timeout):
+        calls.append((url, params, timeout))
+        return replies.pop(0)
+
+    monkeypatch.setattr(client.session, "get", fake_get)
+    assert client.get_volume("abc") == ({"id": "abc"}, 200)
+    assert len(calls) == 2
+    assert calls[0][0].endswith("/abc")
+    assert calls[0][1]["key"] == "key"
+    assert calls[0][2] == (client.connect_timeout, client.read_timeout)
+    assert client.stats()["latency"]["volume"]["count"] == 2
+
+
+def test_books_client_timeout(monkeypatch):
+    """Test the books client gives up after the retry budget on timeouts"""
+    client = BooksClient(retries=1, backoff=0)
+    calls = []
+
+    def fake_get(url, params, timeout):
+        calls.append(url)
+        raise requests.Timeout()
+
+    monkeypatch.setattr(client.session, "get", fake_get)
+    assert client.search_volumes({"q": "dune"}) == (None, 504)
+    assert len(calls) == 2
+
+
+def test_books_client_deadline(monkeypatch):
+    """Test retries and their backoff stay within the total deadline"""
+    client = BooksClient(retries=5, backoff=0.2, deadline=0.3)
+    monkeypatch.setattr(client, "_delay", lambda attempt, retry_after=None: 0.2)
+    timeouts = []
+
+    def fake_get(url, params, timeout):
+        timeouts.append(timeout)
+        return FakeResponse(503)
+
+    monkeypatch.setattr(client.session, "get", fake_get)
+    start = time.monotonic()
+    assert client.search_volumes({"q": "dune"}) == (None, 503)
+    assert time.monotonic() - start < 0.3
+    assert len(timeouts) == 2
+    assert max(timeouts[1]) <= 0.3 - 0.2
+
+
+def test_books_client_no_retry_on_404(monkeypatch):
+    """Test client errors other than 429 are returned without retrying"""
+    client = BooksClient(retries=2, backoff=0)
+    calls = []
+
+    def fake_get(url, params, timeout):
+        calls.append(url)
+        return FakeResponse(404)
+
+    monkeypatch.setattr(client.session, "get", fake_get)
+    assert client.get_volume("missing") == (None, 404)
+    assert len(calls) == 1
+
+
+def test_books_client_quota_replies(monkeypatch):
+    """Test 403 quota replies count as breaker failures, other 403 replies do not"""
+    client = BooksClient(retries=2, backoff=0, breaker_failures=2, breaker_reset=60)
+    quota = {"error": {"code": 403, "errors": [{"reason": "dailyLimitExceeded"}]}}
+    replies = [
+        FakeResponse(403, {"error": {"code": 403, "errors": [{"reason": "forbidden"}]}}),
+        FakeResponse(403, {"error": {"code": 403, "errors": [{"reason": "rateLimitExceeded"}]}}),
+        FakeResponse(200, {"id": "abc"}),
+        FakeResponse(403, quota),
+        FakeResponse(403, quota),
+    ]
+    calls = []
+
+    def fake_get(url, params, timeout):
+        calls.append(url)
+        return replies.pop(0)
+
+    monkeypatch.setattr(client.session, "get", fake_get)
+    assert client.get_volume("abc") == (None, 403)
+    assert client.stats()["circuit"] == "closed"
+    assert client.get_volume("abc") == ({"id": "abc"}, 200)  # the rate limit is retried
+    assert client.get_volume("abc") == (None, 429)  # the daily limit is not
+    assert client.get_volume("abc") == (None, 429)
+    assert len(calls) == 5
+    assert client.stats()["circuit"] == "open"
+    assert client.get_volume("abc") == (None, 503)
+
+
+"""
+Circuit Breaker Tests
+"""
+
+
+def test_circuit_breaker_opens_and_recovers():
+    """Test the circuit opens after consecutive failures and closes after a good trial"""
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.05)
+    breaker.record_failure()
+    assert breaker.allow_request()
+    breaker.record_failure()
+    assert breaker.is_open
+    assert not breaker.allow_request()
+
+    time.sleep(0.06)
+    assert breaker.state == "half_open"
+    assert breaker.allow_request()
+    assert not breaker.allow_request()
+    breaker.record_success()
+    assert breaker.state == "closed"
+
+
+def test_books_client_open_circuit(monkeypatch):
+    """Test the books client refuses calls while the circuit is open"""
+    client = BooksClient(retries=0, breaker_failures=1, breaker_reset=60)
+    calls = []
+
+    def fake_get(url, params, timeout):
+        calls.append(url)
+        return FakeResponse(500)
+
+    monkeypatch.setattr(client.session, "get", fake_get)
+    assert client.get_volume("abc") == (None, 500)
+    assert client.get_volume("abc") == (None, 503)
+    assert len(calls) == 1
+    assert client.stats()["circuit"] == "open"
+
+
+def test_books_client_half_open_trial_errors(monkeypatch):
+    """Test any failure of the half open trial re-opens the circuit instead of blocking it for good"""
+    client = BooksClient(retries=0, breaker_failures=1, breaker_reset=0)
+    errors = [requests.TooManyRedirects(), KeyError("volumeInfo")]
+
+    def fake_get(url, params, timeout):
+        raise errors.pop(0)
+
+    monkeypatch.setattr(client.session, "get", fake_get)
+    client.breaker.record_failure()
+    assert client.get_volume("abc") == (None, 502)
+    with pytest.raises(KeyError):
+        client.get_volume("abc")
+
+    monkeypatch.setattr(client.session, "get", lambda url, params, timeout: FakeResponse(200, {"id": "abc"}))
+    assert client.get_volume("abc") == ({"id": "abc"}, 200)
+    assert client.stats()["circuit"] == "closed"
+
+
+"""
+Single Flight Tests
+"""
+
+
+def test_single_flight_coalesces_calls():
+    """Test concurrent identical calls share a single execution"""
+    flight = SingleFlight()
+    release = threading.Event()
+    calls = []
+
+    def function():
+        calls.append(1)
+        release.wait(5)
+        return {"id": "abc"}, 200
+
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(flight.do("abc", function)))
+        for _ in range(5)
+    ]
+    for thread in threads:
+        thread.start()
+    for _ in range(100):
+        if flight.stats()["followers"] == 4:
+            break
+        time.sleep(0.01)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert len(calls) == 1
+    assert results == [({"id": "abc"}, 200)] * 5
+    assert flight.stats()["in_flight"] == 0
+
+
+def test_single_flight_shared_result(tmp_path):
+    """Test a result written by another worker is reused through the lock directory"""
+    first = SingleFlight(lock_dir=str(tmp_path), result_ttl=60)
+    second = SingleFlight(lock_dir=str(tmp_path), result_ttl=60)
+    assert first.do("abc", lambda: ({"id": "abc"}, 200)) == ({"id": "abc"}, 200)
+    assert second.do("abc", lambda: pytest.fail("upstream called twice")) == ({"id": "abc"}, 200)
+
+
+def test_single_flight_bounded_lock_dir(tmp_path):
+    """Test the lock directory keeps a fixed set of files and keys sharing a stripe get their own result"""
+    flight = SingleFlight(lock_dir=str(tmp_path), result_ttl=60, stripes=2)
+    for number in range(20):
+        key = f"volume-{number}"
+        assert flight.do(key, lambda: ({"id": key}, 200)) == ({"id": key}, 200)
+    assert len(list(tmp_path.iterdir())) <= 4
+    assert flight.do("volume-unhashable", lambda: ({"id": {1, 2}}, 200))[1] == 200
+    assert len(list(tmp_path.iterdir())) <= 4
+
+
+"""
+SQL Stats Tests
+"""
+
+
+def test_query_stats_slowest():
+    """Test query statistics keep the total time and the slowest statements"""
+    stats = QueryStats(keep_slowest=2)
+    stats.record("SELECT 1", 0.001)
+    stats.record("SELECT 2", 0.003)
+    stats.record("SELECT 3", 0.002)
+    summary = stats.summary()
+    assert summary["queries"] == 3
+    assert summary["db_time_ms"] == 6.0
+    assert [item["statement"] for item in summary["slowest"]] == ["SELECT 2", "SELECT 3"]
+
+
+def test_sql_stats_failed_statement(context):
+    """Test a failing statement does not leave its start time behind for the next statements"""
+    from sqlalchemy import text
+    from sqlalchemy.exc import OperationalError
+    from services import sql_stats
+
+    with sql_stats.track() as stats:
+        with db.engine.connect() as connection:
+            with pytest.raises(OperationalError):
+                connection.execute(text("SELECT * FROM missing_table"))
+            connection.execute(text("SELECT 1"))
+            assert connection.info.get("sql_stats_start") == []
+    assert stats.count == 2
+    assert stats.statements[-1] == "SELECT 1"
+
+
+def test_engine_options():
+    """Test the pool options are only set for databases with a real connection pool"""
+    assert engine_options("sqlite:///:memory:") == {}
+    options = engine_options(
+        "postgresql:///bookworm", pool_size=8, max_overflow=2, statement_timeout_ms=5000
+    )
+    assert options["pool_size"] == 8
+    assert options["max_overflow"] == 2
+    assert options["pool_pre_ping"] is True
+    assert options["connect_args"] == {"options": "-c statement_timeout=5000"}
+    assert "connect_args" not in engine_options("sqlite:///bookworm.db", statement_timeout_ms=5000)
+
+
+def test_pool_saturation_and_timeouts(tmp_path):
+    """Test pool checkouts, saturation and checkout timeouts are measured"""
+    from sqlalchemy import create_engine, text
+    from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+
+    engine = create_engine(
+        f"sqlite:///{tmp_path / 'pool.db'}",
+        **engine_options(f"sqlite:///{tmp_path / 'pool.db'}", pool_size=1, max_overflow=0, pool_timeout=0.05),
+    )
+    pool_stats.reset()
+    with engine.connect() as connection:
+        connection.execute(text("SELECT 1"))
+        assert pool_stats.stats()["saturation"] >= 1.0
+        with pytest.raises(PoolTimeoutError):
+            engine.connect()
+    stats = pool_stats.stats()
+    assert stats["checkouts"] == 1
+    assert stats["timeouts"] == 1
+    assert stats["wait_max_ms"] >= 50
+    assert stats["peak_in_use"] == 1
+    engine.dispose()
+
+
+"""
+User Cache Tests
+"""
+
+
+def test_user_cache_invalidated_on_membership_change(test_user, models):
+    """Test the membership summary is cached and dropped when a membership changes"""
+    user = CurrentUser(test_user.id)
+    assert user.club_ids() == set()
+    club = models["Club"].create_club(name="Cached Club", description="", owner_id=test_user.id)
+    assert user.club_ids() == {club.id}
+
+    membership = db.session.get(models["ClubMembers"], (club.id, test_user.id))
+    membership.status = 4
+    db.session.commit()
+    assert user.club_ids() == set()
+    assert user.club_ids(statuses=(4,)) == {club.id}
+    assert user_cache.stats()["hits"] >= 1
+
+
+def test_user_cache_expiry_and_limit(test_user):
+    """Test cached identities expire after the ttl and are evicted beyond the entry limit"""
+    cache = UserCache(ttl=0.05, max_entries=1)
+    assert cache.identity(test_user.id)["username"] == "testuser1"
+    assert cache.stats() == {"hits": 0, "misses": 1, "entries": 1}
+    cache.identity(test_user.id)
+    assert cache.stats()["hits"] == 1
+    time.sleep(0.06)
+    cache.identity(test_user.id)
+    assert cache.stats()["misses"] == 2
+    assert cache.identity(test_user.id + 1) is None
+    cache.remember_user(test_user)
+    assert cache.stats()["entries"] == 1
+
+
+"""
+Forum Hub Tests
+"""
+
+
+def test_forum_hub_fan_out():
+    """Test each change batch is read once per club and pushed to every subscriber of the club"""
+    hub = ForumHub(poll_seconds=5)
+    log = {1: [], 2: []}
+    loads = []
+
+    def loader(club_id):
+        def load(since):
+            loads.append(club_id)
+            events = [(seq, f"event {seq}") for seq in log[club_id] if seq > since]
+            return events, events[-1][0] if events else since, False
+
+        return load
+
+    subscriptions = [hub.subscribe(1, 0, loader(1)) for _ in range(3)]
+    other, _ = hub.subscribe(2, 0, loader(2))
+    assert [position for _, position in subscriptions] == [0, 0, 0]
+    assert hub.stats() == {"readers": 2, "subscribers": 4}
+
+    log[1] += [1, 2]
+    hub.notify(1)
+    for subscription, _ in subscriptions:
+        assert subscription.get(timeout=5) == [(1, "event 1"), (2, "event 2")]
+    assert loads == [1]
+    assert other.get(timeout=0.05) == []
+
+    # A late subscriber starts after the reader position
+    late, position = hub.subscribe(1, 0, loader(1))
+    assert position == 2
+    log[1].append(3)
+    hub.notify(1)
+    assert late.get(timeout=5) == [(3, "event 3")]
+    assert loads == [1, 1]
+
+    for subscription, _ in subscriptions + [(late, None)]:
+        hub.unsubscribe(1, subscription)
+    hub.unsubscribe(2, other)
+    deadline = time.monotonic() + 5
+    while hub.stats()["readers"] and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert hub.stats() == {"readers": 0, "subscribers": 0}
+
+
+def test_forum_hub_poll_and_overflow():
+    """Test the club reader polls the log without notifications and flags subscribers it cannot keep up with"""
+    hub = ForumHub(poll_seconds=0.05, queue_size=2)
+    log = []
+
+    def load(since):
+        events = [(seq, f"event {seq}") for seq in log if seq > since]
+        return events, events[-1][0] if events else since, False
+
+    subscription, _ = hub.subscribe(1, 0, load)
+    log.append(1)  # made by another worker, no notification
+    assert subscription.get(timeout=5) == [(1, "event 1")]
+    log.extend([2, 3, 4])
+    deadline = time.monotonic() + 5
+    while not subscription.overflowed and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert subscription.overflowed
+    hub.unsubscribe(1, subscription)
+
+def test_pool_wait_warnings(caplog):
+    """Test pool timeouts and long waits are logged, at most once per interval"""
+
+    class Pool:
+        def checkedout(self):
+            return 1
+
+    monitor = PoolMonitor(wait_warn=0.5, warn_interval=60)
+    with caplog.at_level("WARNING", logger="services.pool_stats"):
+        monitor.record_checkout(Pool(), 0.01)
+        assert not caplog.records
+        monitor.record_checkout(Pool(), 0.01, timed_out=True)
+        monitor.record_checkout(Pool(), 0.6)
+        monitor.record_checkout(Pool(), 0.7)
+    assert len(caplog.records) == 1
+    assert "timeout" in caplog.records[0].getMessage()
+    monitor._warned -= 60
+    with caplog.at_level("WARNING", logger="services.pool_stats"):
+        monitor.record_checkout(Pool(), 0.8)
+    assert len(caplog.records) == 2
+    assert "3 slow checkouts" in caplog.records[1].getMessage()
+
+
+def test_stats_report_interval(caplog):
+    """Test the service stats are logged once per interval"""
+    report = StatsReport(interval=60)
+    report.register("db_pool", lambda: {"timeouts": 2})
+    assert report.report() == {"db_pool": {"timeouts": 2}}
+    assert not report.due()
+    report._last -= 60
+    assert report.due()
+    assert not report.due()
+    with caplog.at_level("INFO", logger="services.stats_report"):
+        report.log()
+    assert caplog.records[0].getMessage() == 'Service stats: {"db_pool": {"timeouts": 2}}'
+    assert not StatsReport(interval=0).due()
+
+
+def test_forum_hub_prune_interval():
+    """Test the change log is pruned at most once per interval, never with a 0 retention"""
+    hub = ForumHub(retention_days=30, prune_seconds=60)
+    before = hub.prune_before()
+    assert before is not None and before.tzinfo is not None
+    assert hub.prune_before() is None
+    hub._pruned_at -= 60
+    assert hub.prune_before() is not None
+    assert ForumHub(retention_days=0).prune_before() is None
@@ -1,5 +1,6 @@
 import os
 import pytest
+from contextlib import contextmanager
 from models import (
     connect_db,
     db,
@@ -22,6 +23,8 @@ os.environ["TESTRUN"] = "True"
 
 # Now we can import app
 from app import app
+from services import books_client, sql_stats, user_cache
+from google_books_standin import StandinAdapter, create_standin_app
 
 
 app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("TEST_DB_URI")
@@ -30,6 +33,15 @@ app.config["WTF_CSRF_ENABLED"] = False
 
 connect_db(app)
 
+# Google Books requests are answered in-process by the stand-in server,
+# replaying the recorded fixtures, so tests never reach the real API.
+STANDIN_URL = "http://google-books.test"
+google_books_standin = create_standin_app(
+    fixtures=os.path.join(os.path.dirname(__file__), "backend_unit_test", "fixtures", "google_books.json")
+)
+books_client.base_url = f"{STANDIN_URL}/books/v1/volumes"
+books_client.session.mount(STANDIN_URL, StandinAdapter(google_books_standin))
+
 
 @pytest.fixture(scope="session")
 def models():
@@ -51,6 +63,7 @@ def context():
     """Create an app context."""
     with app.app_context() as context:
         context.push()
+        user_cache.clear()
         db.drop_all()
         db.create_all()
         yield
@@ -59,6 +72,14 @@ def context():
         context.pop()
 
 
+@pytest.fixture()
+def standin():
+    """Google Books stand-in app, latency and errors reset after each test"""
+    yield google_books_standin
+    google_books_standin.config.update(STANDIN_LATENCY=0.0, STANDIN_ERROR_RATE=0.0)
+    books_client.breaker.reset()
+
+
 @pytest.fixture()
 def client(context):
     """Cliente test client for http requests"""
@@ -93,3 +114,44 @@ def test_book(context, models):
     )
     db.session.commit()
     return book
+
+
+@pytest.fixture
+def count_queries(context):
+    """Collect the SQL statements executed while the returned tracker is active.
+    The session is emptied first, so objects created by the test are loaded again like in a real request:
+
+    with count_queries() as queries:
+        client.get("/den")
+    assert len(queries) == 3
+    """
+
+    @contextmanager
+    def counter():
+        db.session.expunge_all()
+        with sql_stats.track() as stats:
+            yield stats
+
+    return counter
+
+
+@pytest.fixture
+def query_budget(count_queries):
+    """Fail the test when the wrapped block runs more SQL statements than its budget:
+
+    with query_budget(3):
+        client.get("/den")
+    """
+
+    @contextmanager
+    def budget(max_queries):
+        with count_queries() as stats:
+            yield stats
+        if stats.count > max_queries:
+            statements = "\n".join(f"  {statement}" for statement in stats.statements)
+            pytest.fail(
+                f"Query budget exceeded: {stats.count} statements, budget {max_queries}\n{statements}",
+                pytrace=False,
+            )
+
+    return budget
@@ -1,5 +1,5 @@
 from flask_wtf import FlaskForm
-from sqlalchemy import URL
+from sqlalchemy import URL, func
 from models import db, Club, User
 from wtforms import (
     StringField,
@@ -27,6 +27,13 @@ def password_validator():
         message="Password must have 6 characters minimum, UPPERCASE, lowercase and numeric character",
     )
 
+def value_taken(column, value):
+    """Case insensitive existence probe, answered by the unique lower(column) index"""
+    return db.session.query(
+        db.select(column).where(func.lower(column) == value.lower()).exists()
+    ).scalar()
+
+
 class UserAddForm(FlaskForm):
     """Form for user registration."""
 
@@ -49,14 +56,17 @@ class UserAddForm(FlaskForm):
 
     def validate_email(form, field):
         """Additional validator to confirm the E-mail was not previously used"""
-        database_list = db.session.query(User.email).all()
-        if field.data in [email[0] for email in database_list]:
+        if value_taken(User.email, field.data):
             raise ValidationError("This E-mail is already in the database")
 
 
 class UserEditForm(FlaskForm):
     """Form for user information editing."""
 
+    def __init__(self, current_email=None, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.current_email = current_email
+
     first_name = StringField("First name", validators=[DataRequired(), Length(max=50)])
     last_name = StringField("Last name", validators=[DataRequired(), Length(max=50)])
     email = StringField("E-mail", validators=[DataRequired(), Email()])
@@ -73,9 +83,10 @@ class UserEditForm(FlaskForm):
     )
 
     def validate_email(form, field):
-        """Additional validator to confirm the E-mail was not previously used"""
-        database_list = db.session.query(User.email).all()
-        if field.data in database_list:
+        """Additional validator to confirm the E-mail was not previously used, exception for the current user E-mail"""
+        if form.current_email and form.current_email.lower() == field.data.lower():
+            return
+        if value_taken(User.email, field.data):
             raise ValidationError("This E-mail is already in the database")
 
 
@@ -144,9 +155,7 @@ class NewClubForm(FlaskForm):
 
     def validate_name(form, field):
         """Additional validator to check for existing clubs with the same name, exception in case it is updating an existing club"""
-        if form.current_name and form.current_name == field.data:
+        if form.current_name and form.current_name.lower() == field.data.lower():
             return
-        clubs = db.session.query(Club).all()
-        club_names = [club.name for club in clubs]
-        if field.data in club_names:
+        if value_taken(Club.name, field.data):
             raise ValidationError("Club Name already taken")
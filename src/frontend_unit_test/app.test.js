@@ -39,7 +39,9 @@ describe("BookwormDen Frontend Functions", () => {
         const result = addMarkup(book).prop("outerHTML");
         expect(result).toContain("Mock Book");
         expect(result).toContain("Mock Author");
-        expect(result).toContain("https://example.com/cover.jpg");
+        expect(result).toContain(
+            "/covers/1?src=https%3A%2F%2Fexample.com%2Fcover.jpg&amp;size=small"
+        );
         expect(result).toContain("2022");
     });
 
@@ -66,7 +68,9 @@ describe("BookwormDen Frontend Functions", () => {
         };
 
         const markup = addBookDetailsMarkup(book);
-        expect(markup.find("img").attr("src")).toBe("test-url.jpg");
+        expect(markup.find("img").attr("src")).toBe(
+            "/covers/123?src=test-url.jpg&size=medium"
+        );
         expect(markup.html()).toContain("Test Publisher");
         expect(markup.html()).toContain("200 pages");
         expect(markup.html()).toContain("Fiction");
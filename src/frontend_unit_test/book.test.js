@@ -10,11 +10,13 @@ document.body.innerHTML = htmlTemplate;
 // Import functions to test
 const {
     getCommentMarkup,
+    getSummaryText,
     getClubLi,
     addClub,
     showDescription,
     showStatistics,
     showComments,
+    loadMoreComments,
     showAddComment,
     showBookClubs,
     addReadingClub,
@@ -108,21 +110,69 @@ test("showComments fetches and displays comments", async () => {
     ];
 
     global.Comment = {
-        getAllComments: jest.fn().mockResolvedValue(mockComments),
+        getCommentsPage: jest
+            .fn()
+            .mockResolvedValue({
+                comments: mockComments,
+                summary: {
+                    count: 1,
+                    mean_rating: 5,
+                    histogram: { 0: 0, 1: 0, 2: 0, 3: 0, 4: 0, 5: 1 },
+                },
+                nextCursor: null,
+            }),
     };
 
     await showComments({ target: { dataset: { book: 1 } } });
+    expect(document.querySelector("#comments-summary").innerText).toContain(
+        "Average rating 5 from 1 comment"
+    );
+
+    const commentList = document.querySelector("#ul-comments");
+    expect(global.Comment.getCommentsPage).toHaveBeenCalledWith(1, null);
+    expect(commentList.children.length).toBe(1);
+    expect(commentList.innerHTML).toContain("Great book!");
+    expect(commentList.innerHTML).toContain("user123");
+    expect(document.querySelector("#more-comments-btn").hidden).toBe(true);
+});
 
-    const observer = new MutationObserver((mutations, obs) => {
-        const commentList = document.querySelector("#ul-comments");
+// Test getSummaryText
+test("getSummaryText describes the rating summary", () => {
+    expect(getSummaryText({ count: 0, mean_rating: null, histogram: {} })).toBe("");
+    expect(getSummaryText({ count: 2, mean_rating: null, histogram: {} })).toBe(
+        "2 comments, no ratings yet"
+    );
+});
 
-        if (commentList.innerHTML.includes("Great book!")) {
-            obs.disconnect();
-            expect(commentList.children.length).toBe(1);
-            expect(commentList.innerHTML).toContain("Great book!");
-            expect(commentList.innerHTML).toContain("user123");
-        }
+// Test loadMoreComments
+test("loadMoreComments appends the next page until the cursor runs out", async () => {
+    const comment = (text) => ({
+        comment: text,
+        username: "user123",
+        rating: 4,
+        date: "2024-11-24",
+        user_id: 1,
+        book_id: 1,
     });
+
+    global.Comment = {
+        getCommentsPage: jest
+            .fn()
+            .mockResolvedValueOnce({ comments: [comment("First")], nextCursor: "c1" })
+            .mockResolvedValueOnce({ comments: [comment("Second")], nextCursor: null }),
+    };
+
+    await showComments({ target: { dataset: { book: 1 } } });
+    const moreButton = document.querySelector("#more-comments-btn");
+    expect(moreButton.hidden).toBe(false);
+
+    await loadMoreComments();
+
+    const commentList = document.querySelector("#ul-comments");
+    expect(global.Comment.getCommentsPage).toHaveBeenLastCalledWith(1, "c1");
+    expect(commentList.children.length).toBe(2);
+    expect(commentList.innerHTML).toContain("Second");
+    expect(moreButton.hidden).toBe(true);
 });
 
 // Test addReadingClub
@@ -0,0 +1,221 @@
+"""
+================================================================
+Google Books API stand-in server
+
+Serves the volumes API endpoints used by the BooksClient from a record/replay
+fixture file, with configurable latency and error injection. It can be used
+in-process through StandinAdapter or as a small WSGI server:
+
+    python google_books_standin.py --fixtures fixtures.json --latency 0.2 --error-rate 0.05
+
+Point the app to it with GOOGLE_BOOKS_API_URL=http://localhost:5050/books/v1/volumes
+Adding --record forwards unknown requests to Google Books and saves the replies
+to the fixture file, so they are replayed on the next run.
+================================================================
+"""
+
+import argparse
+import hashlib
+import io
+import json
+import random
+import threading
+import time
+
+import requests
+from flask import Flask, jsonify, request
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+
+from services import GOOGLE_BOOKS_API_URL
+
+VOLUMES_PATH = "/books/v1/volumes"
+
+
+class Fixtures:
+    """Record/replay fixture file.
+
+    Format: {"interactions": [{"path": ..., "params": {...}, "status": 200, "body": {...}}]}
+    Requests match on path and query parameters, the API key is never stored.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._lock = threading.Lock()
+        self._interactions = {}
+        if path:
+            try:
+                with open(path) as fixture_file:
+                    for interaction in json.load(fixture_file).get("interactions", []):
+                        self._interactions[self.key(interaction["path"], interaction["params"])] = interaction
+            except FileNotFoundError:
+                pass
+
+    @staticmethod
+    def key(path, params):
+        params = {name: str(value) for name, value in params.items() if name != "key"}
+        return path, tuple(sorted(params.items()))
+
+    def find(self, path, params):
+        return self._interactions.get(self.key(path, params))
+
+    def record(self, path, params, status, body):
+        params = {name: value for name, value in params.items() if name != "key"}
+        interaction = {"path": path, "params": params, "status": status, "body": body}
+        with self._lock:
+            self._interactions[self.key(path, params)] = interaction
+            if self.path:
+                with open(self.path, "w") as fixture_file:
+                    json.dump(
+                        {"interactions": list(self._interactions.values())}, fixture_file, indent=2
+                    )
+        return interaction
+
+
+def synthetic_volume(volume_id, title=None):
+    """Deterministic volume payload for requests missing from the fixtures"""
+    seed = int(hashlib.sha256(volume_id.encode()).hexdigest()[:8], 16)
+    return {
+        "id": volume_id,
+        "volumeInfo": {
+            "title": title or f"Stand-in Book {volume_id}",
+            "authors": [f"Author {seed % 97}"],
+            "publisher": "Stand-in Press",
+            "publishedDate": str(1950 + seed % 75),
+            "description": f"Synthetic volume {volume_id} served by the Google Books stand-in.",
+            "pageCount": 100 + seed % 700,
+            "categories": ["Fiction"],
+            "averageRating": seed % 5 + 1,
+            "language": "en",
+            "imageLinks": {
+                "thumbnail": f"http://books.google.com/books/content?id={volume_id}&printsec=frontcover&img=1&zoom=1"
+            },
+        },
+    }
+
+
+def synthetic_search(params):
+    """Deterministic search payload for requests missing from the fixtures"""
+    query = params.get("q", "").split(":", 1)[-1]
+    start = int(params.get("startIndex", 0))
+    count = min(int(params.get("maxResults", 10)), 40)
+    items = []
+    for index in range(start, start + count):
+        volume_id = hashlib.sha256(f"{query}:{index}".encode()).hexdigest()[:12]
+        items.append(synthetic_volume(volume_id, title=f"{query.title()} Volume {index + 1}"))
+    return {"kind": "books#volumes", "totalItems": 200, "items": items}
+
+
+def create_standin_app(
+    fixtures=None,
+    latency=0.0,
+    jitter=0.0,
+    error_rate=0.0,
+    error_status=503,
+    synthesize=True,
+    record_url=None,
+    api_key=None,
+):
+    """Create the stand-in flask app.
+    Unknown requests are forwarded to record_url and recorded when it is set, otherwise
+    they are answered with synthetic payloads (synthesize=True) or a 404."""
+    fixtures = fixtures if isinstance(fixtures, Fixtures) else Fixtures(fixtures)
+    app = Flask(__name__)
+    app.config.update(
+        STANDIN_LATENCY=latency,
+        STANDIN_JITTER=jitter,
+        STANDIN_ERROR_RATE=error_rate,
+        STANDIN_ERROR_STATUS=error_status,
+    )
+    app.extensions["standin_fixtures"] = fixtures
+    stats = app.extensions["standin_stats"] = {"requests": 0, "errors": 0, "recorded": 0}
+
+    def reply(path):
+        stats["requests"] += 1
+        delay = app.config["STANDIN_LATENCY"] + random.uniform(0, app.config["STANDIN_JITTER"])
+        if delay:
+            time.sleep(delay)
+        if random.random() < app.config["STANDIN_ERROR_RATE"]:
+            stats["errors"] += 1
+            return jsonify({"error": {"code": app.config["STANDIN_ERROR_STATUS"]}}), app.config["STANDIN_ERROR_STATUS"]
+
+        params = request.args.to_dict()
+        interaction = fixtures.find(path, params)
+        if interaction is None and record_url:
+            upstream = requests.get(
+                record_url + path[len(VOLUMES_PATH):],
+                params={**params, "key": api_key or params.get("key")},
+                timeout=10,
+            )
+            body = upstream.json() if upstream.content else None
+            interaction = fixtures.record(path, params, upstream.status_code, body)
+            stats["recorded"] += 1
+        if interaction is not None:
+            return jsonify(interaction["body"]), interaction["status"]
+        if not synthesize:
+            return jsonify({"error": {"code": 404, "message": "Not in fixtures"}}), 404
+        if path == VOLUMES_PATH:
+            return jsonify(synthetic_search(params)), 200
+        return jsonify(synthetic_volume(path.rsplit("/", 1)[-1])), 200
+
+    @app.route(VOLUMES_PATH, methods=["GET"])
+    def search_volumes():
+        return reply(VOLUMES_PATH)
+
+    @app.route(f"{VOLUMES_PATH}/<volume_id>", methods=["GET"])
+    def get_volume(volume_id):
+        return reply(f"{VOLUMES_PATH}/{volume_id}")
+
+    return app
+
+
+class StandinAdapter(BaseAdapter):
+    """Requests transport adapter answering from a WSGI app, to use the stand-in in-process:
+
+        books_client.session.mount("http://google-books.test/", StandinAdapter(create_standin_app()))
+    """
+
+    def __init__(self, app):
+        super().__init__()
+        self.client = app.test_client()
+
+    def send(self, request, **kwargs):
+        wsgi_response = self.client.open(request.path_url, method=request.method, headers=dict(request.headers))
+        response = requests.Response()
+        response.status_code = wsgi_response.status_code
+        response.headers = CaseInsensitiveDict(wsgi_response.headers)
+        response.raw = io.BytesIO(wsgi_response.get_data())
+        response.encoding = "utf-8"
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Google Books API stand-in server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5050)
+    parser.add_argument("--fixtures", help="record/replay fixture file")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every reply")
+    parser.add_argument("--jitter", type=float, default=0.0, help="random extra seconds per reply")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of replies failing")
+    parser.add_argument("--error-status", type=int, default=503)
+    parser.add_argument("--no-synthesize", action="store_true", help="reply 404 outside the fixtures")
+    parser.add_argument("--record", action="store_true", help="record unknown requests from Google Books")
+    parser.add_argument("--api-key", help="Google Books API key used when recording")
+    args = parser.parse_args()
+
+    standin = create_standin_app(
+        fixtures=args.fixtures,
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        synthesize=not args.no_synthesize,
+        record_url=GOOGLE_BOOKS_API_URL if args.record else None,
+        api_key=args.api_key,
+    )
+    standin.run(host=args.host, port=args.port, threaded=True)
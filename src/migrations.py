@@ -0,0 +1,341 @@
+"""
+================================================================
+BookWorm Den schema migrations
+
+Versioned, idempotent schema changes for databases created before a model
+change. The applied version is stored in the schema_version table.
+
+    python migrations.py            # upgrade the DB_URI database
+    python migrations.py --explain  # check the hot queries use their indexes
+
+New databases created with db.create_all() (seed.py, tests) already have the
+latest schema and are stamped with the latest version on the first upgrade.
+================================================================
+"""
+
+import sys
+from sqlalchemy import inspect, text
+from models import db
+from models.book import POSTGRESQL_SEARCH_INDEX, SQLITE_SEARCH_INDEX, SQLITE_DROP_SEARCH_INDEX
+from models.message import (
+    POSTGRESQL_MESSAGES_SEARCH_INDEX,
+    SQLITE_MESSAGES_SEARCH_INDEX,
+    SQLITE_DROP_MESSAGES_SEARCH_INDEX,
+)
+
+
+def add_column(connection, table, column, column_type):
+    """Add a column unless it already exists"""
+    columns = [existing["name"] for existing in inspect(connection).get_columns(table)]
+    if column not in columns:
+        connection.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}"))
+
+
+def book_cache_columns(connection):
+    """Google Books payload columns used by the volume cache"""
+    timestamp = "TIMESTAMP" if connection.dialect.name == "postgresql" else "DATETIME"
+    add_column(connection, "books", "raw_payload", "TEXT")
+    add_column(connection, "books", "fetched_at", timestamp)
+
+
+def book_search_ids(connection):
+    """Stable integer key of the SQLite books index, numbering the existing rows in their current
+    rowid order. The column is mapped on every database, it stays NULL and unindexed on PostgreSQL"""
+    add_column(connection, "books", "search_id", "INTEGER")
+    if connection.dialect.name == "sqlite":
+        connection.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS uq_books_search_id ON books (search_id)"))
+        connection.execute(text("UPDATE books SET search_id = rowid WHERE search_id IS NULL"))
+
+
+def book_search_index(connection):
+    """Full text index over the books table"""
+    book_search_ids(connection)
+    statements = {
+        "postgresql": POSTGRESQL_SEARCH_INDEX,
+        "sqlite": SQLITE_SEARCH_INDEX,
+    }.get(connection.dialect.name, [])
+    for statement in statements:
+        connection.execute(text(statement))
+
+
+def book_search_index_key(connection):
+    """Key the SQLite books index on search_id instead of the rowid renumbered by VACUUM"""
+    book_search_ids(connection)
+    if connection.dialect.name == "sqlite":
+        for statement in SQLITE_DROP_SEARCH_INDEX + SQLITE_SEARCH_INDEX:
+            connection.execute(text(statement))
+
+
+def hot_query_indexes(connection):
+    """Composite indexes for the comments, forum and membership lookups"""
+    for statement in [
+        "CREATE INDEX IF NOT EXISTS ix_comments_book_domain_date ON comments (book_id, domain, date)",
+        "CREATE INDEX IF NOT EXISTS ix_messages_club_timestamp ON messages (club_id, timestamp DESC, id DESC)",
+        "CREATE INDEX IF NOT EXISTS ix_clubs_users_member_status ON clubs_users (member_id, status)",
+        "CREATE INDEX IF NOT EXISTS ix_clubs_users_club_status ON clubs_users (club_id, status)",
+    ]:
+        connection.execute(text(statement))
+
+
+class MigrationError(Exception):
+    """A migration that cannot be applied until the data is fixed by hand"""
+
+
+def case_insensitive_duplicates(connection, table, column):
+    """Map of lower(column) to the ids of the rows sharing it, for the values used more than once"""
+    rows = connection.execute(
+        text(
+            f"SELECT id, lower({column}) FROM {table} WHERE lower({column}) IN "
+            f"(SELECT lower({column}) FROM {table} GROUP BY lower({column}) HAVING COUNT(*) > 1) "
+            f"ORDER BY lower({column}), id"
+        )
+    )
+    duplicates = {}
+    for row_id, value in rows:
+        duplicates.setdefault(value, []).append(row_id)
+    return duplicates
+
+
+def case_insensitive_unique_indexes(connection):
+    """Unique lower(email) and lower(name) indexes behind the signup and club name validators.
+    Values that only differ by case must be merged or renamed first, they are listed instead of indexed"""
+    conflicts = [
+        f"{table}.{column} {value!r}: ids {', '.join(str(row_id) for row_id in ids)}"
+        for table, column in [("users", "email"), ("clubs", "name")]
+        for value, ids in case_insensitive_duplicates(connection, table, column).items()
+    ]
+    if conflicts:
+        raise MigrationError(
+            "Values differing only by case must be fixed before the unique indexes are created:\n  "
+            + "\n  ".join(conflicts)
+        )
+    for statement in [
+        "CREATE UNIQUE INDEX IF NOT EXISTS uq_users_email_lower ON users (lower(email))",
+        "CREATE UNIQUE INDEX IF NOT EXISTS uq_clubs_name_lower ON clubs (lower(name))",
+    ]:
+        connection.execute(text(statement))
+
+
+def message_change_log(connection):
+    """Change log of the forum messages, read by the forum delta sync"""
+    db.metadata.tables["message_changes"].create(connection, checkfirst=True)
+
+
+def message_search_index(connection):
+    """Full text index over the forum messages"""
+    statements = {
+        "postgresql": POSTGRESQL_MESSAGES_SEARCH_INDEX,
+        "sqlite": SQLITE_MESSAGES_SEARCH_INDEX,
+    }.get(connection.dialect.name, [])
+    for statement in statements:
+        connection.execute(text(statement))
+
+
+def forum_read_markers(connection):
+    """Read marker of each club member, starting at the latest message so old history is not unread"""
+    add_column(connection, "clubs_users", "last_read_message_id", "INTEGER")
+    connection.execute(
+        text(
+            "UPDATE clubs_users SET last_read_message_id = "
+            "(SELECT MAX(messages.id) FROM messages WHERE messages.club_id = clubs_users.club_id) "
+            "WHERE last_read_message_id IS NULL"
+        )
+    )
+    connection.execute(text("CREATE INDEX IF NOT EXISTS ix_messages_club_id ON messages (club_id, id)"))
+
+
+def message_search_index_club(connection):
+    """Add the club id to the SQLite messages index, so a search only reads its club postings"""
+    if connection.dialect.name == "sqlite":
+        for statement in SQLITE_DROP_MESSAGES_SEARCH_INDEX + SQLITE_MESSAGES_SEARCH_INDEX:
+            connection.execute(text(statement))
+
+
+def book_rating_summaries(connection):
+    """Rating summary row of each book, filled from the public comments"""
+    db.metadata.tables["book_ratings"].create(connection, checkfirst=True)
+    star_counts = ", ".join(
+        f"SUM(CASE WHEN rating >= {stars} AND rating < {stars + 1} THEN 1 ELSE 0 END)"
+        for stars in range(1, 5)
+    )
+    connection.execute(
+        text(
+            "INSERT INTO book_ratings (book_id, comments_count, rated_count, rating_total, "
+            "stars_0, stars_1, stars_2, stars_3, stars_4, stars_5) "
+            "SELECT book_id, COUNT(*), COUNT(rating), COALESCE(SUM(rating), 0), "
+            f"SUM(CASE WHEN rating < 1 THEN 1 ELSE 0 END), {star_counts}, "
+            "SUM(CASE WHEN rating >= 5 THEN 1 ELSE 0 END) "
+            "FROM comments WHERE domain = 2 AND book_id NOT IN (SELECT book_id FROM book_ratings) "
+            "GROUP BY book_id"
+        )
+    )
+
+
+def drop_unused_search_id_index(connection):
+    """The books search_id index only serves the SQLite full text index"""
+    if connection.dialect.name != "sqlite":
+        connection.execute(text("DROP INDEX IF EXISTS uq_books_search_id"))
+
+
+# (version, description, function) in the order they must be applied
+MIGRATIONS = [
+    (1, "Google Books payload columns on books", book_cache_columns),
+    (2, "Full text index on books", book_search_index),
+    (3, "Indexes for comments, messages and clubs_users lookups", hot_query_indexes),
+    (4, "Case insensitive unique indexes on users.email and clubs.name", case_insensitive_unique_indexes),
+    (5, "Forum message change log", message_change_log),
+    (6, "Full text index on messages", message_search_index),
+    (7, "Forum read markers on clubs_users", forum_read_markers),
+    (8, "Stable key of the books full text index", book_search_index_key),
+    (9, "Club id in the messages full text index", message_search_index_club),
+    (10, "Rating summaries of the books", book_rating_summaries),
+    (11, "Drop the books search_id index outside SQLite", drop_unused_search_id_index),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def current_version(connection):
+    """Applied schema version, None when the database has no version table yet"""
+    if not inspect(connection).has_table("schema_version"):
+        return None
+    return connection.execute(text("SELECT MAX(version) FROM schema_version")).scalar() or 0
+
+
+def upgrade(engine=None, log=print):
+    """Apply the pending migrations, each one in its own transaction. Returns the final version"""
+    engine = engine or db.engine
+    with engine.begin() as connection:
+        version = current_version(connection)
+        if version is None:
+            fresh = not inspect(connection).has_table("users")
+            connection.execute(
+                text("CREATE TABLE schema_version (version INTEGER PRIMARY KEY, description TEXT)")
+            )
+            if fresh:
+                db.metadata.create_all(connection)
+                connection.execute(
+                    text("INSERT INTO schema_version VALUES (:version, 'Initial schema')"),
+                    {"version": LATEST_VERSION},
+                )
+                log(f"Created schema at version {LATEST_VERSION}")
+                return LATEST_VERSION
+            version = 0
+
+    for migration_version, description, migration in MIGRATIONS:
+        if migration_version <= version:
+            continue
+        with engine.begin() as connection:
+            migration(connection)
+            connection.execute(
+                text("INSERT INTO schema_version VALUES (:version, :description)"),
+                {"version": migration_version, "description": description},
+            )
+        log(f"Applied migration {migration_version}: {description}")
+        version = migration_version
+    return version
+
+
+"""
+EXPLAIN check
+Each hot query must be answered through an index. On PostgreSQL sequential scans are
+disabled while explaining, so the check does not depend on table sizes or statistics.
+"""
+
+HOT_QUERIES = {
+    "book comments": (
+        "SELECT * FROM comments WHERE book_id = :book_id AND domain = 2 ORDER BY date",
+        {"book_id": "abc"},
+        "comments",
+    ),
+    "club messages": (
+        "SELECT * FROM messages WHERE club_id = :club_id ORDER BY timestamp DESC, id DESC LIMIT 20",
+        {"club_id": 1},
+        "messages",
+    ),
+    "user memberships": (
+        "SELECT * FROM clubs_users WHERE member_id = :member_id AND status IN (1, 2)",
+        {"member_id": 1},
+        "clubs_users",
+    ),
+    "club memberships": (
+        "SELECT * FROM clubs_users WHERE club_id = :club_id AND status = 1",
+        {"club_id": 1},
+        "clubs_users",
+    ),
+    "email check": (
+        "SELECT 1 FROM users WHERE lower(email) = :email",
+        {"email": "bookworm@example.com"},
+        "users",
+    ),
+    "club name check": (
+        "SELECT 1 FROM clubs WHERE lower(name) = :name",
+        {"name": "bookworms"},
+        "clubs",
+    ),
+    "forum changes": (
+        "SELECT * FROM message_changes WHERE club_id = :club_id AND seq > :seq ORDER BY seq LIMIT 50",
+        {"club_id": 1, "seq": 0},
+        "message_changes",
+    ),
+    "unread messages": (
+        "SELECT COUNT(*) FROM messages WHERE club_id = :club_id AND id > :last_read AND user_id != :member_id",
+        {"club_id": 1, "last_read": 0, "member_id": 1},
+        "messages",
+    ),
+    "login": (
+        "SELECT * FROM users WHERE username = :username",
+        {"username": "bookworm"},
+        "users",
+    ),
+}
+
+
+def explain(connection, statement, params):
+    """Query plan lines for a statement"""
+    if connection.dialect.name == "postgresql":
+        connection.execute(text("SET LOCAL enable_seqscan = off"))
+        rows = connection.execute(text(f"EXPLAIN {statement}"), params)
+        return [row[0] for row in rows]
+    rows = connection.execute(text(f"EXPLAIN QUERY PLAN {statement}"), params)
+    return [row[-1] for row in rows]
+
+
+def uses_index(plan, table):
+    """False when the plan reads the whole table"""
+    for line in plan:
+        if f"Seq Scan on {table}" in line:
+            return False
+        if line.startswith(f"SCAN {table}") and "INDEX" not in line:
+            return False
+    return True
+
+
+def check_indexes(engine=None):
+    """Explain every hot query. Returns {name: (uses_index, plan)}"""
+    engine = engine or db.engine
+    results = {}
+    for name, (statement, params, table) in HOT_QUERIES.items():
+        with engine.begin() as connection:
+            plan = explain(connection, statement, params)
+        results[name] = (uses_index(plan, table), plan)
+    return results
+
+
+if __name__ == "__main__":
+    from app import app
+
+    with app.app_context():
+        if "--explain" in sys.argv:
+            failed = False
+            for name, (indexed, plan) in check_indexes().items():
+                print(f"{'OK  ' if indexed else 'SCAN'} {name}")
+                for line in plan:
+                    print(f"       {line}")
+                failed = failed or not indexed
+            sys.exit(1 if failed else 0)
+        try:
+            upgrade()
+        except MigrationError as error:
+            print(error)
+            sys.exit(1)
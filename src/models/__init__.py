@@ -3,9 +3,11 @@ from .user import User
 from .book import Book
 from .user_book import UserBook
 from .comment import Comment
+from .book_rating import BookRating
 from .club import Club
 from .club_book import ClubBook
 from .club_member import ClubMembers
 from .message import Message
+from .message_change import MessageChange
 
-__all__=["User", "Book", "UserBook", "Comment", "Club", "ClubBook", "ClubMembers", "Message", "db", "connect_db"]
\ No newline at end of file
+__all__=["User", "Book", "UserBook", "Comment", "BookRating", "Club", "ClubBook", "ClubMembers", "Message", "MessageChange", "db", "connect_db"]
\ No newline at end of file
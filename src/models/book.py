@@ -1,3 +1,5 @@
+import re
+from sqlalchemy import DDL, event, text
 from .database import db
 
 class Book(db.Model):
@@ -15,12 +17,34 @@ class Book(db.Model):
     categories = db.Column(db.Text)
     description = db.Column(db.Text)
     page_count = db.Column(db.Integer)
+    raw_payload = db.Column(db.Text)  # Last Google Books volume payload, as JSON
+    fetched_at = db.Column(db.DateTime)  # When raw_payload was fetched from Google Books
+    # Stable key of the SQLite full text index, set by its insert trigger. The column is mapped on
+    # every database but stays NULL on PostgreSQL, whose index is an expression over the text columns
+    search_id = db.Column(db.Integer)
 
     userlog = db.relationship("UserBook", backref="book")
     clubs = db.relationship("Club", secondary="clubs_books", backref="books")
 
+    __table_args__ = (db.Index("uq_books_search_id", search_id, unique=True).ddl_if(dialect="sqlite"),)
+
     # users -> users through users_books
 
+    def serialize(self):
+        """Method to convert the local book record into the book details sent to the frontend"""
+        return {
+            "title": self.title,
+            "authors": self.authors.split(",") if self.authors else [],
+            "categories": self.categories.split(",") if self.categories else [],
+            "publisher": "",
+            "publishedDate": None,
+            "description": self.description or "",
+            "thumbnail": self.cover,
+            "page_count": self.page_count or 0,
+            "average_rating": 0,
+            "id": self.api_id,
+        }
+
     @classmethod
     def save_book(cls, data):
         """Class method to save a new book to the database"""
@@ -31,4 +55,94 @@ class Book(db.Model):
             return new_book
         except:
             db.session.rollback()
-            return False
\ No newline at end of file
+            return False
+
+    @classmethod
+    def full_text_search(cls, query, limit=40):
+        """Class method to search the local books by title, authors, categories and description.
+        Uses the PostgreSQL tsvector index or the SQLite FTS5 table, best matches first.
+        The last search word is matched as a prefix to support search as you type."""
+        words = re.findall(r"\w+", query.lower())
+        if not words:
+            return []
+        dialect = db.session.get_bind().dialect.name
+        if dialect == "postgresql":
+            ids = db.session.execute(
+                text(
+                    f"SELECT api_id FROM books WHERE {BOOKS_TSVECTOR} @@ to_tsquery('english', :query) "
+                    f"ORDER BY ts_rank({BOOKS_TSVECTOR}, to_tsquery('english', :query)) DESC LIMIT :limit"
+                ),
+                {"query": " & ".join(words) + ":*", "limit": limit},
+            ).scalars().all()
+        elif dialect == "sqlite":
+            ids = db.session.execute(
+                text(
+                    "SELECT books.api_id FROM books_fts JOIN books ON books.search_id = books_fts.rowid "
+                    "WHERE books_fts MATCH :query "
+                    "ORDER BY bm25(books_fts, 10.0, 5.0, 2.0, 1.0) LIMIT :limit"
+                ),
+                {"query": " ".join(f'"{word}"' for word in words) + "*", "limit": limit},
+            ).scalars().all()
+        else:
+            return (
+                db.session.query(cls)
+                .filter(cls.title.ilike(f"%{' '.join(words)}%"))
+                .order_by(cls.title)
+                .limit(limit)
+                .all()
+            )
+        books = {book.api_id: book for book in db.session.query(cls).filter(cls.api_id.in_(ids))}
+        return [books[api_id] for api_id in ids if api_id in books]
+
+
+"""
+Full text search index
+PostgreSQL indexes a weighted tsvector expression with GIN, the queries must use the same expression.
+SQLite keeps an external content FTS5 table synchronized by triggers. The books primary key is
+text, so the index is keyed on search_id: the implicit rowid may be renumbered by VACUUM.
+"""
+
+BOOKS_TSVECTOR = (
+    "(setweight(to_tsvector('english', coalesce(title, '')), 'A') || "
+    "setweight(to_tsvector('english', coalesce(authors, '')), 'B') || "
+    "setweight(to_tsvector('english', coalesce(categories, '')), 'C') || "
+    "setweight(to_tsvector('english', coalesce(description, '')), 'D'))"
+)
+
+POSTGRESQL_SEARCH_INDEX = [
+    f"CREATE INDEX IF NOT EXISTS ix_books_fulltext ON books USING GIN ({BOOKS_TSVECTOR})",
+]
+
+SQLITE_SEARCH_INDEX = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS books_fts USING fts5("
+    "title, authors, categories, description, content='books', content_rowid='search_id')",
+    "CREATE TRIGGER IF NOT EXISTS books_fts_insert AFTER INSERT ON books BEGIN "
+    "UPDATE books SET search_id = (SELECT COALESCE(MAX(search_id), 0) + 1 FROM books) "
+    "WHERE api_id = new.api_id AND search_id IS NULL; "
+    "INSERT INTO books_fts(rowid, title, authors, categories, description) "
+    "SELECT search_id, title, authors, categories, description FROM books WHERE api_id = new.api_id; END",
+    "CREATE TRIGGER IF NOT EXISTS books_fts_delete AFTER DELETE ON books BEGIN "
+    "INSERT INTO books_fts(books_fts, rowid, title, authors, categories, description) "
+    "VALUES ('delete', old.search_id, old.title, old.authors, old.categories, old.description); END",
+    "CREATE TRIGGER IF NOT EXISTS books_fts_update "
+    "AFTER UPDATE OF title, authors, categories, description ON books BEGIN "
+    "INSERT INTO books_fts(books_fts, rowid, title, authors, categories, description) "
+    "VALUES ('delete', old.search_id, old.title, old.authors, old.categories, old.description); "
+    "INSERT INTO books_fts(rowid, title, authors, categories, description) "
+    "VALUES (new.search_id, new.title, new.authors, new.categories, new.description); END",
+    "INSERT INTO books_fts(books_fts) VALUES ('rebuild')",
+]
+
+SQLITE_DROP_SEARCH_INDEX = [
+    "DROP TRIGGER IF EXISTS books_fts_insert",
+    "DROP TRIGGER IF EXISTS books_fts_delete",
+    "DROP TRIGGER IF EXISTS books_fts_update",
+    "DROP TABLE IF EXISTS books_fts",
+]
+
+for statement in POSTGRESQL_SEARCH_INDEX:
+    event.listen(Book.__table__, "after_create", DDL(statement).execute_if(dialect="postgresql"))
+for statement in SQLITE_SEARCH_INDEX:
+    event.listen(Book.__table__, "after_create", DDL(statement).execute_if(dialect="sqlite"))
+for statement in SQLITE_DROP_SEARCH_INDEX:
+    event.listen(Book.__table__, "after_drop", DDL(statement).execute_if(dialect="sqlite"))
@@ -0,0 +1,99 @@
+from .database import db
+from .comment import Comment
+from sqlalchemy import event, text
+
+STAR_COLUMNS = [f"stars_{stars}" for stars in range(6)]
+
+
+class BookRating(db.Model):
+    """Rating summary of the public comments of a book. The counters are moved by the comment
+    inserts, updates and deletes in the same transaction, so reading a summary is a primary key probe"""
+
+    __tablename__ = "book_ratings"
+
+    book_id = db.Column(db.String, db.ForeignKey("books.api_id"), primary_key=True)
+    comments_count = db.Column(db.Integer, nullable=False, default=0)
+    rated_count = db.Column(db.Integer, nullable=False, default=0)
+    rating_total = db.Column(db.Numeric, nullable=False, default=0)
+    stars_0 = db.Column(db.Integer, nullable=False, default=0)
+    stars_1 = db.Column(db.Integer, nullable=False, default=0)
+    stars_2 = db.Column(db.Integer, nullable=False, default=0)
+    stars_3 = db.Column(db.Integer, nullable=False, default=0)
+    stars_4 = db.Column(db.Integer, nullable=False, default=0)
+    stars_5 = db.Column(db.Integer, nullable=False, default=0)
+
+    def serialize(self):
+        """Summary sent with the first comments page: count, mean and histogram by whole star"""
+        return {
+            "count": self.comments_count,
+            "mean_rating": (
+                round(float(self.rating_total) / self.rated_count, 2) if self.rated_count else None
+            ),
+            "histogram": {
+                str(stars): getattr(self, column) for stars, column in enumerate(STAR_COLUMNS)
+            },
+        }
+
+    @classmethod
+    def summary(cls, book_id):
+        """Rating summary of a book, empty when it has no public comment"""
+        rating = db.session.get(cls, book_id)
+        if rating is None:
+            return {"count": 0, "mean_rating": None, "histogram": {str(stars): 0 for stars in range(6)}}
+        return rating.serialize()
+
+
+def rating_bucket(rating):
+    """Histogram column of a rating, by whole star"""
+    return STAR_COLUMNS[min(max(int(rating), 0), 5)]
+
+
+def add_to_summary(connection, book_id, domain, rating, sign):
+    """Add (sign=1) or remove (sign=-1) a comment from the rating summary of its book"""
+    if domain is None or int(domain) != 2:  # the comment form sends the domain as text
+        return
+    values = {column: 0 for column in STAR_COLUMNS}
+    values.update(book_id=book_id, comments_count=sign, rated_count=0, rating_total=0)
+    if rating is not None:
+        values.update(rated_count=sign, rating_total=sign * float(rating))
+        values[rating_bucket(rating)] = sign
+    counters = ["comments_count", "rated_count", "rating_total"] + STAR_COLUMNS
+    connection.execute(
+        text(
+            f"INSERT INTO book_ratings (book_id, {', '.join(counters)}) "
+            f"VALUES (:book_id, {', '.join(':' + column for column in counters)}) "
+            "ON CONFLICT (book_id) DO UPDATE SET "
+            + ", ".join(f"{column} = book_ratings.{column} + excluded.{column}" for column in counters)
+        ),
+        values,
+    )
+
+
+def previous_value(target, attribute):
+    """Value of a comment attribute before the flush"""
+    history = db.inspect(target).attrs[attribute].history
+    return history.deleted[0] if history.deleted else getattr(target, attribute)
+
+
+@event.listens_for(Comment, "after_insert")
+def comment_created(mapper, connection, target):
+    add_to_summary(connection, target.book_id, target.domain, target.rating, 1)
+
+
+@event.listens_for(Comment, "after_update")
+def comment_edited(mapper, connection, target):
+    old = [previous_value(target, attribute) for attribute in ("book_id", "domain", "rating")]
+    if old != [target.book_id, target.domain, target.rating]:
+        add_to_summary(connection, *old, -1)
+        add_to_summary(connection, target.book_id, target.domain, target.rating, 1)
+
+
+@event.listens_for(Comment, "after_delete")
+def comment_deleted(mapper, connection, target):
+    add_to_summary(
+        connection,
+        previous_value(target, "book_id"),
+        previous_value(target, "domain"),
+        previous_value(target, "rating"),
+        -1,
+    )
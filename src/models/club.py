@@ -12,6 +12,8 @@ class Club(db.Model):
     name = db.Column(db.String, nullable=False, unique=True)
     description = db.Column(db.Text)
 
+    __table_args__ = (db.Index("uq_clubs_name_lower", db.func.lower(name), unique=True),)
+
     membership = db.relationship(
         "ClubMembers", backref="club", cascade="all, delete-orphan"
     )
@@ -1,4 +1,5 @@
 from .database import db
+from .message import Message
 
 class ClubMembers(db.Model):
     """Many to Many relationship between clubs and member users describing membership status.
@@ -13,15 +14,22 @@ class ClubMembers(db.Model):
     status = db.Column(
         db.Integer
     )  # Should indicate the membership status (1= owner, 2 = member, 3 = invited, 4 = rejected)
+    last_read_message_id = db.Column(db.Integer)  # Newest forum message seen by the member
+
+    __table_args__ = (
+        db.Index("ix_clubs_users_member_status", member_id, status),
+        db.Index("ix_clubs_users_club_status", club_id, status),
+    )
 
     # user -> User connected to membership
     # club -> Club connected to membership
 
     def accept_invite(self):
-        """Method to accept an invitation to join a book club"""
+        """Method to accept an invitation to join a book club, the forum history counts as read"""
         try:
             if self.status != 1:
                 self.status = 2
+                self.last_read_message_id = ClubMembers.latest_message_id(self.club_id)
                 db.session.commit()
                 return True
             else:
@@ -53,12 +61,70 @@ class ClubMembers(db.Model):
             db.session.rollback()
             return False
 
+    @classmethod
+    def has_access(cls, club_id, member_id):
+        """Class method to check if a user is the owner or a member of a club, with a single primary key probe"""
+        probe = (
+            db.select(db.literal(1))
+            .where(
+                cls.club_id == club_id,
+                cls.member_id == member_id,
+                cls.status.in_([1, 2]),
+            )
+            .limit(1)
+        )
+        return db.session.execute(probe).first() is not None
+
+    @staticmethod
+    def latest_message_id(club_id):
+        """Scalar subquery of the newest forum message id of a club, the read marker of new members"""
+        return (
+            db.select(db.func.max(Message.id))
+            .where(Message.club_id == club_id)
+            .scalar_subquery()
+        )
+
+    @classmethod
+    def mark_read(cls, club_id, member_id, message_id):
+        """Class method to move the member read marker forward to a forum message, with a single UPDATE"""
+        db.session.execute(
+            db.update(cls)
+            .where(
+                cls.club_id == club_id,
+                cls.member_id == member_id,
+                db.or_(cls.last_read_message_id.is_(None), cls.last_read_message_id < message_id),
+            )
+            .values(last_read_message_id=message_id)
+        )
+
+    @classmethod
+    def unread_counts(cls, member_id):
+        """Class method to count the forum messages posted by others after the member read marker,
+        for every club the user owns or belongs to, in a single query. Returns {club_id: count}"""
+        rows = db.session.execute(
+            db.select(cls.club_id, db.func.count(Message.id))
+            .join(
+                Message,
+                db.and_(
+                    Message.club_id == cls.club_id,
+                    Message.id > db.func.coalesce(cls.last_read_message_id, 0),
+                    Message.user_id != member_id,
+                ),
+            )
+            .where(cls.member_id == member_id, cls.status.in_([1, 2]))
+            .group_by(cls.club_id)
+        )
+        return {club_id: count for club_id, count in rows}
+
     @classmethod
     def enrol_user(cls, club_id, member_id, status):
-        """Class method to invite a nem member to a club"""
+        """Class method to invite a nem member to a club, the forum history counts as read"""
         try:
             new_membership = ClubMembers(
-                club_id=club_id, member_id=member_id, status=status
+                club_id=club_id,
+                member_id=member_id,
+                status=status,
+                last_read_message_id=cls.latest_message_id(club_id),
             )
             db.session.add(new_membership)
             db.session.commit()
@@ -20,6 +20,8 @@ class Comment(db.Model):
         db.Integer
     )  # Should indicate the audience of the comment (1=Internal, 2 = Public)
 
+    __table_args__ = (db.Index("ix_comments_book_domain_date", book_id, domain, date),)
+
     # user -> User owner of the comment
     # book -> Book connected to the comment
 
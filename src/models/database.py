@@ -1,7 +1,32 @@
+from flask import g, has_app_context
 from flask_sqlalchemy import SQLAlchemy
-db = SQLAlchemy()
+from flask_sqlalchemy.session import Session
+from sqlalchemy.sql.dml import UpdateBase
+
+REPLICA_BIND = "replica"
+
+
+class RoutingSession(Session):
+    """Session sending reads to the read replica bind while the request allows it (g.db_replica).
+    INSERT/UPDATE/DELETE statements always go to the primary, and so do flushes since the
+    read replica router clears g.db_replica in before_flush."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if (
+            bind is None
+            and not isinstance(clause, UpdateBase)
+            and has_app_context()
+            and g.get("db_replica")
+        ):
+            replica = self._db.engines.get(REPLICA_BIND)
+            if replica is not None:
+                return replica
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+db = SQLAlchemy(session_options={"class_": RoutingSession})
 
 def connect_db(app):
     """Function to connect flask app to the database."""
     db.app = app
-    db.init_app(app)
\ No newline at end of file
+    db.init_app(app)
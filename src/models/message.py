@@ -1,6 +1,13 @@
+import re
+from sqlalchemy import DDL, event, text
 from .database import db
+from .user import User
 from datetime import datetime, timezone
 
+# Private use characters marking the matched words in search snippets, replaced after HTML escaping
+HIGHLIGHT_START = "\ue000"
+HIGHLIGHT_END = "\ue001"
+
 class Message(db.Model):
     """Model for the messages int he forum for the reading clubs"""
 
@@ -12,17 +19,50 @@ class Message(db.Model):
     message = db.Column(db.Text, nullable=False)
     timestamp = db.Column(db.DateTime, nullable=False)
 
+    __table_args__ = (
+        db.Index("ix_messages_club_timestamp", club_id, timestamp.desc(), id.desc()),
+        db.Index("ix_messages_club_id", club_id, id),
+    )
+
     # user -> User who posted the message
 
     def serialize(self):
         """Method to convert a forum message to a dictionary"""
+        return Message.serialize_row(
+            (
+                self.id,
+                self.message,
+                self.timestamp,
+                self.user.first_name,
+                self.user.last_name,
+                self.user.username,
+            )
+        )
+
+    @classmethod
+    def row_query(cls):
+        """Compact (id, message, timestamp, first_name, last_name, username) rows of the messages
+        joined to their authors, without building ORM entities"""
+        return db.select(
+            cls.id,
+            cls.message,
+            cls.timestamp,
+            User.first_name,
+            User.last_name,
+            User.username,
+        ).join(User, User.id == cls.user_id)
+
+    @staticmethod
+    def serialize_row(row):
+        """Convert a message row to the dictionary sent to the forum, the timestamp as ISO 8601 UTC"""
+        message_id, message, timestamp, first_name, last_name, username = row
         return {
-            "id": self.id,
-            "message": self.message,
-            "timestamp": self.timestamp.strftime("%d/%b/%y %I:%M %p"),
-            "user_first_name": self.user.first_name,
-            "user_last_name": self.user.last_name,
-            "user_username": self.user.username,
+            "id": message_id,
+            "message": message,
+            "timestamp": timestamp.replace(tzinfo=None).isoformat(timespec="seconds") + "Z",
+            "user_first_name": first_name,
+            "user_last_name": last_name,
+            "user_username": username,
         }
 
     def delete(self):
@@ -37,6 +77,8 @@ class Message(db.Model):
     def update_message(self, message):
         """Method to update a forum message"""
         try:
+            if message == self.message:
+                return self
             self.message = message
             db.session.commit()
             return self
@@ -57,4 +99,114 @@ class Message(db.Model):
             db.session.commit()
             return new_message
         except:
-            return False
\ No newline at end of file
+            return False
+
+    @classmethod
+    def full_text_search(cls, club_id, query, limit=20, after=None):
+        """Class method to search the messages of a club, best matches first and newest first on ties.
+        Uses the PostgreSQL tsvector index or the SQLite FTS5 table, the last word is matched as a prefix.
+        Returns (row, score, snippet) tuples: row as in row_query, a lower score is a better match and the
+        snippet marks the matched words with HIGHLIGHT_START/HIGHLIGHT_END.
+        after=(score, id) of the last result of the previous page continues the search after it. The score
+        only depends on the message itself (ts_rank, or the number of matches on SQLite where bm25 would
+        change with every message posted), so pages never skip or repeat a message that was not edited."""
+        words = re.findall(r"\w+", query.lower())
+        if not words:
+            return []
+        params = {"club_id": club_id, "limit": limit}
+        dialect = db.session.get_bind().dialect.name
+        if dialect == "postgresql":
+            params["query"] = " & ".join(words) + ":*"
+            params["headline"] = f"StartSel={HIGHLIGHT_START}, StopSel={HIGHLIGHT_END}, MaxWords=30, MinWords=10"
+            hits = (
+                f"SELECT id, -ts_rank({MESSAGES_TSVECTOR}, to_tsquery('english', :query)) AS score "
+                f"FROM messages WHERE club_id = :club_id AND {MESSAGES_TSVECTOR} @@ to_tsquery('english', :query)"
+            )
+            snippet = "ts_headline('english', messages.message, to_tsquery('english', :query), :headline)"
+        elif dialect == "sqlite":
+            # The club is a MATCH term too, so only the postings of the club messages are read
+            params["query"] = f'club_id : "{int(club_id)}" AND message : (' + " ".join(
+                f'"{word}"' for word in words
+            ) + "*)"
+            params.update(start=HIGHLIGHT_START, end=HIGHLIGHT_END)
+            hits = (
+                "SELECT rowid AS id, "
+                "length(replace(highlight(messages_fts, 0, :start, ''), :start, '')) "
+                "- length(highlight(messages_fts, 0, :start, '')) + 0.0 AS score, "
+                "snippet(messages_fts, 0, :start, :end, '…', 24) AS snippet "
+                "FROM messages_fts WHERE messages_fts MATCH :query"
+            )
+            snippet = "hits.snippet"
+        else:
+            params["query"] = f"%{' '.join(words)}%"
+            hits = "SELECT id, 0.0 AS score FROM messages WHERE club_id = :club_id AND lower(message) LIKE :query"
+            snippet = "messages.message"
+
+        keyset = ""
+        if after:
+            keyset = "WHERE hits.score > :score OR (hits.score = :score AND hits.id < :id) "
+            params.update(score=after[0], id=after[1])
+        found = db.session.execute(
+            text(
+                f"SELECT hits.id, hits.score, {snippet} FROM ({hits}) AS hits "
+                f"JOIN messages ON messages.id = hits.id {keyset}"
+                "ORDER BY hits.score, hits.id DESC LIMIT :limit"
+            ),
+            params,
+        ).all()
+        if not found:
+            return []
+        rows = {
+            row.id: row
+            for row in db.session.execute(
+                cls.row_query().where(cls.id.in_([message_id for message_id, _, _ in found]))
+            )
+        }
+        return [
+            (rows[message_id], score, snippet)
+            for message_id, score, snippet in found
+            if message_id in rows
+        ]
+
+
+"""
+Full text search index
+PostgreSQL indexes the message tsvector with GIN, the queries must use the same expression.
+SQLite keeps an external content FTS5 table synchronized by triggers, with the club id as an
+indexed column so a search only reads the postings of its club.
+"""
+
+MESSAGES_TSVECTOR = "to_tsvector('english', message)"
+
+POSTGRESQL_MESSAGES_SEARCH_INDEX = [
+    f"CREATE INDEX IF NOT EXISTS ix_messages_fulltext ON messages USING GIN ({MESSAGES_TSVECTOR})",
+]
+
+SQLITE_MESSAGES_SEARCH_INDEX = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5("
+    "message, club_id, content='messages', content_rowid='id')",
+    "CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN "
+    "INSERT INTO messages_fts(rowid, message, club_id) VALUES (new.id, new.message, new.club_id); END",
+    "CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN "
+    "INSERT INTO messages_fts(messages_fts, rowid, message, club_id) "
+    "VALUES ('delete', old.id, old.message, old.club_id); END",
+    "CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF message ON messages BEGIN "
+    "INSERT INTO messages_fts(messages_fts, rowid, message, club_id) "
+    "VALUES ('delete', old.id, old.message, old.club_id); "
+    "INSERT INTO messages_fts(rowid, message, club_id) VALUES (new.id, new.message, new.club_id); END",
+    "INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')",
+]
+
+SQLITE_DROP_MESSAGES_SEARCH_INDEX = [
+    "DROP TRIGGER IF EXISTS messages_fts_insert",
+    "DROP TRIGGER IF EXISTS messages_fts_delete",
+    "DROP TRIGGER IF EXISTS messages_fts_update",
+    "DROP TABLE IF EXISTS messages_fts",
+]
+
+for statement in POSTGRESQL_MESSAGES_SEARCH_INDEX:
+    event.listen(Message.__table__, "after_create", DDL(statement).execute_if(dialect="postgresql"))
+for statement in SQLITE_MESSAGES_SEARCH_INDEX:
+    event.listen(Message.__table__, "after_create", DDL(statement).execute_if(dialect="sqlite"))
+for statement in SQLITE_DROP_MESSAGES_SEARCH_INDEX:
+    event.listen(Message.__table__, "after_drop", DDL(statement).execute_if(dialect="sqlite"))
@@ -0,0 +1,105 @@
+from .database import db
+from .message import Message
+from datetime import datetime, timezone
+from sqlalchemy import event, func, select, text
+
+PRUNED = "pruned"
+
+
+class MessageChange(db.Model):
+    """Change log of the forum messages. Every insert, edit and delete of a message adds a row
+    with an increasing sequence number, deletes are kept as tombstones (the message row is gone).
+
+    The log is pruned after a retention window, see prune(). Deleting a club removes its messages
+    and its log through the database cascade, without tombstones: its members lose access to it, so
+    no stream or delta read follows that log anymore. Messages removed by the cascade of a user
+    deletion leave no tombstone either, the clubs show them until their next full reload.
+    """
+
+    __tablename__ = "message_changes"
+
+    seq = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    club_id = db.Column(db.Integer, db.ForeignKey("clubs.id", ondelete="CASCADE"), nullable=False)
+    message_id = db.Column(db.Integer, nullable=False)
+    kind = db.Column(db.String(10), nullable=False)  # created, edited, deleted or pruned
+    changed_at = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (db.Index("ix_message_changes_club_seq", club_id, seq),)
+
+    @classmethod
+    def since(cls, club_id, seq, limit):
+        """Club changes after a sequence number, oldest first"""
+        return (
+            db.session.query(cls)
+            .filter(cls.club_id == club_id, cls.seq > seq, cls.kind != PRUNED)
+            .order_by(cls.seq)
+            .limit(limit)
+            .all()
+        )
+
+    @classmethod
+    def latest_seq(cls, club_id):
+        """Sequence number of the latest change of a club, 0 when there is none"""
+        return db.session.query(func.max(cls.seq)).filter(cls.club_id == club_id).scalar() or 0
+
+    @classmethod
+    def horizon(cls, club_id):
+        """Position of the club pruned marker, 0 when the club log is complete. The changes after a
+        position older than the horizon may be gone, the client must reload the club messages"""
+        first = (
+            db.session.query(cls.seq, cls.kind)
+            .filter(cls.club_id == club_id)
+            .order_by(cls.seq)
+            .first()
+        )
+        return first.seq if first and first.kind == PRUNED else 0
+
+    @classmethod
+    def prune(cls, before):
+        """Remove the changes made before a datetime. The latest removed change of each club stays
+        as its "pruned" marker, which also keeps the sequence numbers from being reused.
+        Returns the number of removed changes, the caller commits"""
+        table = cls.__table__
+        last_pruned = (
+            select(func.max(table.c.seq)).where(table.c.changed_at < before).group_by(table.c.club_id)
+        )
+        db.session.execute(table.update().where(table.c.seq.in_(last_pruned)).values(kind=PRUNED))
+        marker = table.alias("marker")
+        marker_seq = (
+            select(func.max(marker.c.seq))
+            .where(marker.c.club_id == table.c.club_id, marker.c.kind == PRUNED)
+            .scalar_subquery()
+        )
+        return db.session.execute(table.delete().where(table.c.seq < marker_seq)).rowcount
+
+
+def record_change(connection, message, kind):
+    """Insert the change row in the transaction of the message change.
+    On PostgreSQL the club changes are serialized with a transaction lock, so sequence numbers
+    become visible in order and a client reading since=<seq> never skips a later commit."""
+    if connection.dialect.name == "postgresql":
+        connection.execute(text("SELECT pg_advisory_xact_lock(:club_id)"), {"club_id": message.club_id})
+    connection.execute(
+        MessageChange.__table__.insert().values(
+            club_id=message.club_id,
+            message_id=message.id,
+            kind=kind,
+            changed_at=datetime.now(timezone.utc),
+        )
+    )
+
+
+@event.listens_for(Message, "after_insert")
+def message_created(mapper, connection, target):
+    record_change(connection, target, "created")
+
+
+@event.listens_for(Message, "after_update")
+def message_edited(mapper, connection, target):
+    if db.inspect(target).attrs.message.history.has_changes():
+        record_change(connection, target, "edited")
+
+
+@event.listens_for(Message, "after_delete")
+def message_deleted(mapper, connection, target):
+    record_change(connection, target, "deleted")
@@ -23,6 +23,8 @@ class User(db.Model):
     bio = db.Column(db.Text)
     location = db.Column(db.String(30))
 
+    __table_args__ = (db.Index("uq_users_email_lower", db.func.lower(email), unique=True),)
+
     books = db.relationship("Book", secondary="users_books", backref="users")
     readlog = db.relationship("UserBook", backref="user")
     comments = db.relationship("Comment", backref="user")
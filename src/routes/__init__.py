@@ -5,7 +5,8 @@ from .book import book_route
 from .club import club_route
 from .den import den_route
 from .forum import forum_route
+from .cover import cover_route
 
 
 
-__all__=["auth_route", "user_route", "book_route", "club_route", "den_route", "forum_route"]
\ No newline at end of file
+__all__=["auth_route", "user_route", "book_route", "club_route", "den_route", "forum_route", "cover_route"]
\ No newline at end of file
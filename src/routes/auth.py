@@ -21,8 +21,9 @@ def registration_view():
             flash(f"Welcome {new_user.first_name} to the BookwormDen", "success")
             login(new_user)
             return redirect(url_for("den_route.user_den_view"))
-        else:
+        elif registration_form.validate():
             flash("Error creating new user, please try again", "danger")
+        # else a concurrent signup took the E-mail, shown as a field error
 
     return render_template("user_signup.html", form=registration_form)
 
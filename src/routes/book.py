@@ -1,107 +1,364 @@
-from flask import Blueprint, render_template, redirect, url_for, flash, g, jsonify, request, current_app
-import requests
-from operator import and_
-from .utils import login_required, club_access_required, login, logout
+from flask import Blueprint, render_template, redirect, url_for, flash, g, jsonify, request, current_app, Response
+from itsdangerous import BadSignature
+import json
+from datetime import date
+from sqlalchemy import and_, or_
+from sqlalchemy.orm import joinedload
+from .utils import login_required, club_access_required, login, logout, cursor_serializer
 from forms import (
     UserAddForm,
     LoginForm,
     UserEditForm
 )
-from models import db, Book, Comment, Club, ClubMembers, ClubBook
+from models import db, Book, Comment, BookRating, Club, ClubMembers, ClubBook
+from services import volume_cache, search_cache, normalize_query, books_client
+from services.books_client import RETRY_STATUS
 
-GOOGLE_BOOKS_API_URL = "https://www.googleapis.com/books/v1/volumes"
+SEARCH_PAGE_SIZE = 40  # Google Books maximum page size
+SEARCH_MAX_START = 400  # Deeper pages are rarely relevant
+COMMENTS_NO_DATE = date(1970, 1, 1)  # Paging position of the comments without a date
 
 book_route = Blueprint("book_route", __name__)
 
 
 @book_route.route("/search", methods=["GET"])
 def books_search_route():
-    """Route to execute book search queries. Replies with json file with search content"""
-    title_search = request.args.get("q", "")
+    """Route to execute book search queries. Replies with json file with search content.
+    Books found in the local catalog come first, followed by the Google Books results not already listed.
+    Each request reads SEARCH_PREFETCH_PAGES upstream pages concurrently, the X-Next-Cursor header holds
+    the cursor for the following pages. With format=ndjson the books are streamed one per line as
+    each page arrives, and the last line holds the next cursor. When the local books fill a page the
+    upstream pages are not read, the cursor then points at the first one."""
+    start_index = 0
+    serializer = cursor_serializer("book-search-cursor")
+    cursor = request.args.get("cursor")
+    if cursor:
+        try:
+            cursor_data = serializer.loads(cursor)
+            title_search, start_index = cursor_data["q"], int(cursor_data["start"])
+        except (BadSignature, KeyError, TypeError, ValueError):
+            return jsonify({"error": "Invalid search cursor"}), 400
+    else:
+        title_search = " ".join(request.args.get("q", "").split())
     if not title_search:
         return jsonify({"error": "Please enter a book title to search"}), 400
-    api_key = current_app.config["GOOGLE_API_KEY"]
-    params = {
+
+    local_books = [] if cursor else search_local_books(title_search)
+    ndjson = request.args.get("format") == "ndjson"
+    if len(local_books) >= SEARCH_PAGE_SIZE:
+        # A full page of local books, the Google Books results follow from upstream page 0
+        next_cursor = serializer.dumps({"q": title_search, "start": 0})
+        if ndjson:
+            return Response(
+                stream_local_results(local_books, next_cursor),
+                mimetype="application/x-ndjson",
+                headers={"X-Cache": "LOCAL"},
+            )
+        return jsonify(local_books), 200, {"X-Cache": "LOCAL", "X-Next-Cursor": next_cursor}
+    pages = search_pages(title_search, prefetch_starts(start_index))
+
+    if ndjson:
+        # The generator runs after the request context is gone, it gets everything it needs now
+        return Response(
+            stream_search_results(title_search, start_index, local_books, pages, serializer),
+            mimetype="application/x-ndjson",
+        )
+
+    results = {}
+    cache_statuses = set()
+    for start, page, status_code, cache_status in pages:
+        results[start] = (page, status_code)
+        cache_statuses.add(cache_status)
+    first_page, status_code = results[start_index]
+    if first_page is None:
+        if status_code in RETRY_STATUS:
+            books = [{**book, "degraded": True} for book in local_books]
+            return jsonify(books), 200, {"X-Cache": "MISS", "X-Degraded": "1"}
+        return jsonify(
+            {"error": "Failed to fetch data please try again"}
+        ), status_code
+
+    books = list(local_books)
+    listed = {book["data"]["id"] for book in books}
+    for start in sorted(results):
+        page, _ = results[start]
+        if page is None:
+            break
+        books.extend(book for book in page["books"] if book["data"]["id"] not in listed)
+        listed.update(book["data"]["id"] for book in page["books"])
+    headers = {
+        "X-Cache": next(
+            status for status in ["MISS", "STALE", "HIT"] if status in cache_statuses
+        )
+    }
+    next_cursor = next_search_cursor(title_search, start_index, results, serializer)
+    if next_cursor:
+        headers["X-Next-Cursor"] = next_cursor
+    return jsonify(books), 200, headers
+
+
+def stream_search_results(title_search, start_index, local_books, pages, serializer):
+    """Generate the search results as newline delimited json, local books first and then each upstream page as it arrives.
+    Runs outside of the app context, the cursor serializer is provided by the route."""
+    listed = set()
+    results = {}
+    for book in local_books:
+        listed.add(book["data"]["id"])
+        yield json.dumps(book) + "\n"
+    for start, page, status_code, _ in pages:
+        results[start] = (page, status_code)
+        if page is None:
+            continue
+        for book in page["books"]:
+            if book["data"]["id"] not in listed:
+                listed.add(book["data"]["id"])
+                yield json.dumps(book) + "\n"
+    first_page, status_code = results[start_index]
+    yield json.dumps(
+        {
+            "next_cursor": next_search_cursor(title_search, start_index, results, serializer),
+            "degraded": first_page is None and status_code in RETRY_STATUS,
+        }
+    ) + "\n"
+
+
+def stream_local_results(local_books, next_cursor):
+    """Generate a page of local books as newline delimited json, the last line holds the next cursor"""
+    for book in local_books:
+        yield json.dumps(book) + "\n"
+    yield json.dumps({"next_cursor": next_cursor, "degraded": False}) + "\n"
+
+
+def search_pages(title_search, starts):
+    """Generate (start_index, page, status_code, cache_status) for the given upstream result pages.
+    Cached pages come first, the missing ones are fetched concurrently and yielded as they arrive."""
+    misses = []
+    for start in starts:
+        cache_key = search_cache_key(title_search, start)
+        page, cache_status = search_cache.lookup(cache_key)
+        if cache_status == "STALE":
+            search_cache.refresh(cache_key, lambda start=start: search_books(title_search, start))
+        if page is None:
+            misses.append(start)
+        else:
+            yield start, page, 200, cache_status
+
+    params_list = [search_params(title_search, start) for start in misses]
+    for index, (data, status_code) in books_client.search_volumes_concurrently(params_list):
+        start = misses[index]
+        if status_code != 200:
+            yield start, None, status_code, "MISS"
+            continue
+        page = parse_search_page(data)
+        search_cache.set(search_cache_key(title_search, start), page)
+        yield start, page, 200, "MISS"
+
+
+def prefetch_starts(start_index):
+    """Start indexes of the upstream pages read by a search request"""
+    prefetch = current_app.config.get("SEARCH_PREFETCH_PAGES", 2)
+    starts = [start_index + page * SEARCH_PAGE_SIZE for page in range(max(prefetch, 1))]
+    return [start for start in starts if start <= SEARCH_MAX_START] or [start_index]
+
+
+def search_cache_key(title_search, start_index):
+    """Search cache key for one upstream result page"""
+    return f"{normalize_query(title_search, 'en')}@{start_index}"
+
+
+def next_search_cursor(title_search, start_index, results, serializer):
+    """Cursor to the first upstream page after the ones read without errors, None when there are no more results"""
+    start = start_index
+    while start in results:
+        page, _ = results[start]
+        if page is None:
+            break
+        if not page["more"]:
+            return None
+        start += SEARCH_PAGE_SIZE
+    if start > SEARCH_MAX_START:
+        return None
+    return serializer.dumps({"q": title_search, "start": start})
+
+
+def search_params(title_search, start_index=0):
+    """Google Books query parameters for a page of english volumes by title"""
+    return {
         "q": f"intitle:{title_search}",
-        "key": api_key,
-        "maxResults": 40,
+        "startIndex": start_index,
+        "maxResults": SEARCH_PAGE_SIZE,
         "printType": "books",
         # "projection": "lite",
         "langRestrict": "en",
     }
 
-    response = requests.get(url=GOOGLE_BOOKS_API_URL, params=params)
-    if response.status_code == 200:
-        data = response.json()
-        books = []
-        for item in data.get("items", []):
-            if item["volumeInfo"]["language"] == "en":
-                id = item.get("id")
-                volume_info = item.get(
-                    "volumeInfo", {}
-                )  # volume is the google book term for an item (book, magazine or other content)
-                data = {
-                    "title": volume_info.get("title"),
-                    "authors": volume_info.get("authors", []),
-                    "publishedDate": volume_info.get("publishedDate"),
-                    "description": volume_info.get("description"),
-                    "thumbnail": volume_info.get("imageLinks", {}).get("thumbnail"),
-                    "id": id,
-                }
-                books.append({"data": data})
-
-        return jsonify(books)
-    else:
-        return jsonify(
-            {"error": "Failed to fetch data please try again"}
-        ), response.status_code
+
+def search_books(title_search, start_index=0):
+    """Query Google Books for a page of english volumes by title. Returns (page, status_code)"""
+    data, status_code = books_client.search_volumes(search_params(title_search, start_index))
+    if status_code != 200:
+        return None, status_code
+    return parse_search_page(data), 200
+
+
+def parse_search_page(data):
+    """Keep the english volumes of a Google Books search reply.
+    Returns a page dictionary with the books and if more results may follow."""
+    items = data.get("items", [])
+    books = []
+    for item in items:
+        if item["volumeInfo"].get("language") == "en":
+            id = item.get("id")
+            volume_info = item.get(
+                "volumeInfo", {}
+            )  # volume is the google book term for an item (book, magazine or other content)
+            data = {
+                "title": volume_info.get("title"),
+                "authors": volume_info.get("authors", []),
+                "publishedDate": volume_info.get("publishedDate"),
+                "description": volume_info.get("description"),
+                "thumbnail": volume_info.get("imageLinks", {}).get("thumbnail"),
+                "id": id,
+            }
+            books.append({"data": data})
+    return {"books": books, "more": len(items) == SEARCH_PAGE_SIZE}
+
+
+def search_local_books(title_search):
+    """Search the local books table through its full text index"""
+    books = []
+    for book in Book.full_text_search(title_search, limit=SEARCH_PAGE_SIZE):
+        details = book.serialize()
+        data = {
+            key: details[key]
+            for key in ["title", "authors", "publishedDate", "description", "thumbnail", "id"]
+        }
+        books.append({"data": data})
+    return books
 
 
 @book_route.route("/book/<volume_id>", methods=["GET"])
 def book_details_route(volume_id):
     """Route to collect detailed information for a particular book volume"""
-    api_key = current_app.config["GOOGLE_API_KEY"]
-    params = {
-        "key": api_key,
+    data = volume_cache.get(volume_id)
+    cache_status = "HIT"
+    if data is None:
+        cache_status = "MISS"
+        data, status_code = books_client.get_volume(volume_id)
+        if status_code in RETRY_STATUS:
+            local_details = local_volume_details(volume_id)
+            if local_details:
+                return jsonify(local_details), 200, {"X-Cache": cache_status, "X-Degraded": "1"}
+        if status_code != 200:
+            return jsonify(
+                {"error": "Failed to fetch data please try again"}
+            ), status_code
+        volume_cache.set(volume_id, data)
+
+    return jsonify(volume_details(volume_id, data)), 200, {"X-Cache": cache_status}
+
+
+def local_volume_details(volume_id):
+    """Book details from the local Book row, used while Google Books is unavailable.
+    Prefers the last stored upstream payload, even if it is older than the cache TTL."""
+    book = db.session.get(Book, volume_id)
+    if not book:
+        return None
+    details = None
+    if book.raw_payload:
+        try:
+            details = volume_details(volume_id, json.loads(book.raw_payload))
+        except ValueError:
+            pass
+    return {**(details or book.serialize()), "degraded": True}
+
+
+def volume_details(volume_id, data):
+    """Convert a Google Books volume payload into the book details sent to the frontend"""
+    volume_info = data.get(
+        "volumeInfo", {}
+    )  # volume is the google book term for an item (book, magazine or other content)
+    return {
+        "title": volume_info.get("title", ""),
+        "authors": volume_info.get("authors", []),
+        "categories": volume_info.get("categories", []),
+        "publisher": volume_info.get("publisher", ""),
+        "publishedDate": volume_info.get("publishedDate"),
+        "description": volume_info.get("description", ""),
+        "thumbnail": volume_info.get("imageLinks", {}).get("thumbnail"),
+        "page_count": volume_info.get("pageCount", 0),
+        "average_rating": volume_info.get("averageRating", 0),
+        "id": volume_id,
     }
 
-    response = requests.get(url=f"{GOOGLE_BOOKS_API_URL}/{volume_id}", params=params)
-    if response.status_code == 200:
-        data = response.json()
-        volume_info = data.get(
-            "volumeInfo", {}
-        )  # volume is the google book term for an item (book, magazine or other content)
-        book_data = {
-            "title": volume_info.get("title", ""),
-            "authors": volume_info.get("authors", []),
-            "categories": volume_info.get("categories", []),
-            "publisher": volume_info.get("publisher", ""),
-            "publishedDate": volume_info.get("publishedDate"),
-            "description": volume_info.get("description", ""),
-            "thumbnail": volume_info.get("imageLinks", {}).get("thumbnail"),
-            "page_count": volume_info.get("pageCount", 0),
-            "average_rating": volume_info.get("averageRating", 0),
-            "id": volume_id,
-        }
-        return jsonify(book_data)
-    else:
-        return jsonify(
-            {"error": "Failed to fetch data please try again"}
-        ), response.status_code
+
+@book_route.route("/books/batch", methods=["GET"])
+def books_batch_route():
+    """Route to collect the details of several book volumes at once, ids provided as a comma separated list.
+    Cached volumes are answered locally, with a single query for the payloads stored on the books,
+    and the remaining ones are fetched from Google Books concurrently."""
+    volume_ids = list(
+        dict.fromkeys(
+            volume_id.strip()
+            for volume_id in request.args.get("ids", "").split(",")
+            if volume_id.strip()
+        )
+    )
+    if not volume_ids:
+        return jsonify({"error": "Please provide the book ids"}), 400
+    batch_max = current_app.config.get("BOOKS_BATCH_MAX", 40)
+    if len(volume_ids) > batch_max:
+        return jsonify({"error": f"A maximum of {batch_max} books can be requested at once"}), 400
+
+    books = {
+        volume_id: volume_details(volume_id, data)
+        for volume_id, data in volume_cache.get_many(volume_ids).items()
+    }
+    missing = {}
+    misses = [volume_id for volume_id in volume_ids if volume_id not in books]
+
+    if misses:
+        fetched = {}
+        for volume_id, (data, status_code) in books_client.get_volumes(misses).items():
+            if status_code == 200:
+                fetched[volume_id] = data
+                books[volume_id] = volume_details(volume_id, data)
+                continue
+            local_details = (
+                local_volume_details(volume_id) if status_code in RETRY_STATUS else None
+            )
+            if local_details:
+                books[volume_id] = local_details
+            else:
+                missing[volume_id] = status_code
+        volume_cache.set_many(fetched)
+
+    return jsonify(
+        books=[books[volume_id] for volume_id in volume_ids if volume_id in books],
+        missing=missing,
+    ), 200
 
 
 @book_route.route("/book/<volume_id>/clubs", methods=["GET"])
 @login_required
 def book_club_reading_list(volume_id):
     """Route to collect the reading clubs from a the connected user and if the given book is already in the reading list"""
-    book = db.get_or_404(Book, volume_id)
-    user_member_clubs = [
-        membership.club
-        for membership in g.user.membership
-        if membership.status in [1, 2]
-    ]
-    included_clubs = [club.name for club in user_member_clubs if club in book.clubs]
-    club_choices = [club.name for club in user_member_clubs if club not in book.clubs]
+    db.get_or_404(Book, volume_id)
+    club_ids = g.user.club_ids()
+    if not club_ids:
+        return jsonify(included=[], choices=[])
+    user_member_clubs = db.session.execute(
+        db.select(Club.id, Club.name).filter(Club.id.in_(club_ids)).order_by(Club.id)
+    ).all()
+    book_club_ids = set(
+        db.session.scalars(
+            db.select(ClubBook.club_id).filter(
+                ClubBook.book_id == volume_id, ClubBook.club_id.in_(club_ids)
+            )
+        )
+    )
+    included_clubs = [club.name for club in user_member_clubs if club.id in book_club_ids]
+    club_choices = [club.name for club in user_member_clubs if club.id not in book_club_ids]
 
     return jsonify(included=included_clubs, choices=club_choices)
 
@@ -155,14 +412,44 @@ Book Comments Route
 @book_route.route("/comments/<volume_id>", methods=["GET"])
 @login_required
 def book_comments_route(volume_id):
-    """Route to read all available comments from a given book. Replies with json file with comments array"""
-    comments = (
+    """Route to read the public comments of a given book, oldest first, in pages of up to COMMENTS_MAX_PAGE_SIZE.
+    The next page is read with cursor=<next_cursor>. The first page also carries the rating summary of the book."""
+    max_quantity = current_app.config.get("COMMENTS_MAX_PAGE_SIZE", 50)
+    try:
+        quantity = min(max(int(request.args.get("quantity", 20)), 1), max_quantity)
+        cursor = request.args.get("cursor")
+        after = cursor_serializer("comments-cursor").loads(cursor) if cursor else None
+    except (BadSignature, TypeError, ValueError):
+        return jsonify({"error": "Invalid page request"}), 400
+
+    query = (
         db.session.query(Comment)
-        .order_by(Comment.date)
         .filter(and_(Comment.book_id == volume_id, Comment.domain == 2))
-        .all()
+        .options(joinedload(Comment.user))
     )
-    if not comments:
-        return jsonify({"error": "No comments found in the database"}), 400
+    # Comments without a date sort first, as if posted on COMMENTS_NO_DATE
+    comment_date = db.func.coalesce(Comment.date, COMMENTS_NO_DATE)
+    if after:
+        after_date, after_user = date.fromisoformat(after[0]), int(after[1])
+        query = query.filter(
+            or_(
+                comment_date > after_date,
+                and_(comment_date == after_date, Comment.user_id > after_user),
+            )
+        )
+    comments = query.order_by(comment_date, Comment.user_id).limit(quantity + 1).all()
+    next_cursor = None
+    if len(comments) > quantity:
+        comments = comments[:quantity]
+        last = comments[-1]
+        next_cursor = cursor_serializer("comments-cursor").dumps(
+            [(last.date or COMMENTS_NO_DATE).isoformat(), last.user_id]
+        )
 
-    return jsonify(comments=[book_comment.serialize() for book_comment in comments])
\ No newline at end of file
+    data = {
+        "comments": [book_comment.serialize() for book_comment in comments],
+        "next_cursor": next_cursor,
+    }
+    if not after:
+        data["summary"] = BookRating.summary(volume_id)
+    return jsonify(data)
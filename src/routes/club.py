@@ -1,5 +1,6 @@
 from flask import Blueprint, render_template, redirect, url_for, flash, g, jsonify, request
-from .utils import login_required, club_access_required, login, logout
+from sqlalchemy.orm import joinedload, selectinload
+from .utils import login_required, club_access_required, login, logout, first_form_error
 from forms import NewClubForm
 from models import db, Club, ClubMembers, User
 
@@ -20,24 +21,35 @@ def clubs_view():
         )
         if new_club:
             flash("Reading club added to the database", "success")
+        elif not club_form.validate():
+            # A concurrent request created a club with the same name
+            flash(first_form_error(club_form, "Error adding the reading club, please try again"), "danger")
         else:
             flash("Error adding the reading club, please try again", "danger")
         return redirect(url_for("club_route.clubs_view"))
+    memberships = (
+        db.session.query(ClubMembers)
+        .filter(ClubMembers.member_id == g.user.id)
+        .options(joinedload(ClubMembers.club))
+        .all()
+    )
     clubs_member = [
-        membership.club for membership in g.user.membership if membership.status == 2
+        membership.club for membership in memberships if membership.status == 2
     ]
     clubs_owner = [
-        membership.club for membership in g.user.membership if membership.status == 1
+        membership.club for membership in memberships if membership.status == 1
     ]
     clubs_invited = [
-        membership.club for membership in g.user.membership if membership.status == 3
+        membership.club for membership in memberships if membership.status == 3
     ]
+    unread = ClubMembers.unread_counts(g.user.id) if clubs_owner or clubs_member else {}
     return render_template(
         "clubs_page.html",
         form=club_form,
         owned=clubs_owner,
         member=clubs_member,
         invited=clubs_invited,
+        unread=unread,
     )
 
 
@@ -46,14 +58,18 @@ def clubs_view():
 @club_access_required
 def club_view(club_id):
     """View function to open book club information"""
-    club = db.get_or_404(Club, club_id)
-    owner = next(
-        (member.user for member in club.membership if member.status == 1), None
+    club = db.first_or_404(
+        db.select(Club).filter(Club.id == club_id).options(selectinload(Club.books))
     )
     memberships = (
         db.session.query(ClubMembers)
         .filter(ClubMembers.club_id == club_id)
+        .options(joinedload(ClubMembers.user))
         .order_by(ClubMembers.status)
+        .all()
+    )
+    owner = next(
+        (membership.user for membership in memberships if membership.status == 1), None
     )
 
     return render_template("club.html", club=club, memberships=memberships, owner=owner)
@@ -72,6 +88,8 @@ def edit_club_view(club_id):
         )
         if updated_club:
             flash("Reading club updated", "success")
+        elif not club_form.validate():
+            flash(first_form_error(club_form, "Error updating the reading club, please try again"), "danger")
         else:
             flash("Error updating the reading club, please try again", "danger")
         return redirect(url_for("club_route.edit_club_view", club_id=club_id))
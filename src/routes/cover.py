@@ -0,0 +1,52 @@
+import os
+from urllib.parse import urlsplit
+from flask import Blueprint, g, jsonify, redirect, request, send_file
+from models import db, Book
+from services import cover_store, COVER_SIZES
+from services.cover_store import allowed_cover_url, cover_url_for_book
+
+COVER_MAX_AGE = 24 * 60 * 60  # A book cover may be replaced, browsers revalidate it with the ETag after a day
+
+cover_route = Blueprint("cover_route", __name__)
+
+
+@cover_route.route("/covers/<api_id>", methods=["GET"])
+def cover_view(api_id):
+    """Route to serve a book cover from the local cover store.
+    Books saved in the database use their stored cover, search results can provide the Google Books thumbnail
+    of the same volume as src. Only logged in users make the server fetch and store a new cover, visitors are
+    sent to the Google Books image when the cover is not stored yet. Covers that are not proxied (other hosts,
+    a src of another volume) are redirected to, except a src on another host, which would be an open redirect.
+    """
+    size = request.args.get("size", "medium")
+    if size not in COVER_SIZES:
+        return jsonify({"error": f"Size must be one of {', '.join(COVER_SIZES)}"}), 400
+    book = db.session.get(Book, api_id)
+    source_url = book.cover if book else request.args.get("src", "")
+    if not allowed_cover_url(source_url):
+        if book and urlsplit(source_url).scheme in ("http", "https"):
+            return redirect(source_url)
+        return jsonify({"error": "Cover not found"}), 404
+
+    upstream_url = source_url.replace("http://", "https://", 1)
+    if not book and not cover_url_for_book(source_url, api_id):
+        return redirect(upstream_url)
+    if not g.user and not cover_store.has(api_id, source_url):
+        return redirect(upstream_url)
+    cover = cover_store.open_cover(api_id, source_url, size)
+    if not cover:
+        return redirect(upstream_url)
+    cover_file, etag, mimetype = cover
+    stat = os.fstat(cover_file.fileno())
+    response = send_file(
+        cover_file,
+        mimetype=mimetype,
+        etag=etag,
+        last_modified=stat.st_mtime,
+        max_age=COVER_MAX_AGE,
+        conditional=True,
+    )
+    if response.status_code == 200:
+        response.content_length = stat.st_size
+    response.cache_control.public = True
+    return response
@@ -1,5 +1,6 @@
 from flask import Blueprint, render_template, redirect, url_for, flash, g, jsonify, request
 from datetime import date
+from sqlalchemy.orm import joinedload
 from .utils import login_required, club_access_required, login, logout
 from forms import (
     ReadStatisticsForm,
@@ -14,7 +15,12 @@ den_route = Blueprint("den_route", __name__)
 @login_required
 def user_den_view():
     """View function to open user home den"""
-    reading_log = g.user.readlog
+    reading_log = (
+        db.session.query(UserBook)
+        .filter(UserBook.user_id == g.user.id)
+        .options(joinedload(UserBook.book))
+        .all()
+    )
     return render_template("den_page.html", list=reading_log)
 
 
@@ -1,6 +1,16 @@
-from flask import Blueprint, render_template, redirect, url_for, flash, g, jsonify, request
-from .utils import login_required, club_access_required, login, logout
-from models import db, Message
+import json
+from flask import Blueprint, render_template, redirect, url_for, flash, g, jsonify, request, current_app, Response, stream_with_context
+from datetime import datetime
+from time import monotonic
+from itsdangerous import BadSignature
+from markupsafe import escape
+from sqlalchemy import and_, or_
+from sqlalchemy.exc import SQLAlchemyError
+from .utils import login_required, club_access_required, login, logout, cursor_serializer
+from sqlalchemy.orm import joinedload
+from models import db, Message, MessageChange, ClubMembers
+from models.message import HIGHLIGHT_START, HIGHLIGHT_END
+from services import forum_hub
 
 
 forum_route = Blueprint("forum_route", __name__)
@@ -9,18 +19,193 @@ forum_route = Blueprint("forum_route", __name__)
 @login_required
 @club_access_required
 def club_messages_route(club_id):
-    """Route to read all available messages for a given club"""
-    start = request.args.get("start", 0)
-    quantity = request.args.get("quantity", 20)
-    messages = (
-        db.session.query(Message)
-        .filter(Message.club_id == club_id)
-        .order_by(Message.timestamp.desc())
-        .offset(start)
-        .limit(quantity)
+    """Route to read the messages of a given club, newest first.
+    Pages are selected with the opaque cursors returned by the previous page: before=<next_before>
+    reads older messages and after=<next_after> newer ones, "more" tells if the page was cut short.
+    Page size is limited to FORUM_MAX_PAGE_SIZE. The latest page also returns changes_seq, the
+    change log position to follow it with the changes route. Reading the latest or newer messages
+    moves the member read marker used for the unread counts.
+    """
+    max_quantity = current_app.config.get("FORUM_MAX_PAGE_SIZE", 50)
+    try:
+        quantity = min(max(int(request.args.get("quantity", 20)), 1), max_quantity)
+        before = load_message_cursor(request.args.get("before"))
+        after = load_message_cursor(request.args.get("after"))
+    except (BadSignature, TypeError, ValueError):
+        return jsonify({"error": "Invalid page request"}), 400
+
+    query = Message.row_query().where(Message.club_id == club_id)
+    if after:
+        query = query.where(
+            or_(
+                Message.timestamp > after[0],
+                and_(Message.timestamp == after[0], Message.id > after[1]),
+            )
+        ).order_by(Message.timestamp, Message.id)
+    else:
+        if before:
+            query = query.where(
+                or_(
+                    Message.timestamp < before[0],
+                    and_(Message.timestamp == before[0], Message.id < before[1]),
+                )
+            )
+        query = query.order_by(Message.timestamp.desc(), Message.id.desc())
+    messages = db.session.execute(query.limit(quantity + 1)).all()
+    more = len(messages) > quantity
+    messages = messages[:quantity]
+    if after:
+        messages.reverse()
+
+    data = [Message.serialize_row(message) for message in messages]
+    page = dict(
+        messages=data,
+        more=more,
+        next_before=dump_message_cursor(messages[-1]) if messages and (more or after) else None,
+        next_after=dump_message_cursor(messages[0]) if messages else request.args.get("after"),
+    )
+    if not before and not after:
+        # Position in the change log to follow this page with /changes?since=<changes_seq>
+        page["changes_seq"] = MessageChange.latest_seq(club_id)
+    if messages and not before:
+        # The newest messages were viewed, move the member read marker
+        ClubMembers.mark_read(club_id, g.user.id, messages[0].id)
+        db.session.commit()
+    return jsonify(**page), 200
+
+
+def dump_message_cursor(message):
+    """Opaque cursor for a message (or message row) position in the forum"""
+    return cursor_serializer("forum-cursor").dumps([message.timestamp.isoformat(), message.id])
+
+
+def load_message_cursor(cursor):
+    """Message position (timestamp, id) from a cursor, None when no cursor is provided"""
+    if not cursor:
+        return None
+    timestamp, message_id = cursor_serializer("forum-cursor").loads(cursor)
+    return datetime.fromisoformat(timestamp), int(message_id)
+
+
+@forum_route.route("/<club_id>/search", methods=["GET"])
+@login_required
+@club_access_required
+def club_search_route(club_id):
+    """Route to search the club forum messages with q=<words>, best matches first.
+    Each result is a forum message with "highlight", an HTML escaped extract with the matched words
+    in <mark> tags. The next page is read with cursor=<next_cursor>, page size is limited to
+    FORUM_MAX_PAGE_SIZE.
+    """
+    query = request.args.get("q", "").strip()
+    if not query:
+        return jsonify({"error": "Missing search words"}), 400
+    max_quantity = current_app.config.get("FORUM_MAX_PAGE_SIZE", 50)
+    try:
+        quantity = min(max(int(request.args.get("quantity", 20)), 1), max_quantity)
+        after = None
+        if request.args.get("cursor"):
+            cursor_query, score, message_id = cursor_serializer("forum-search-cursor").loads(
+                request.args["cursor"]
+            )
+            if cursor_query != query:
+                raise ValueError
+            after = (float(score), int(message_id))
+    except (BadSignature, TypeError, ValueError):
+        return jsonify({"error": "Invalid page request"}), 400
+
+    hits = Message.full_text_search(int(club_id), query, limit=quantity + 1, after=after)
+    more = len(hits) > quantity
+    hits = hits[:quantity]
+    results = [
+        dict(Message.serialize_row(row), highlight=highlight_snippet(snippet))
+        for row, score, snippet in hits
+    ]
+    next_cursor = (
+        cursor_serializer("forum-search-cursor").dumps([query, hits[-1][1], hits[-1][0].id])
+        if more
+        else None
+    )
+    return jsonify(results=results, next_cursor=next_cursor), 200
+
+
+def highlight_snippet(snippet):
+    """HTML escaped search snippet with the matched words in <mark> tags"""
+    return (
+        str(escape(snippet))
+        .replace(HIGHLIGHT_START, "<mark>")
+        .replace(HIGHLIGHT_END, "</mark>")
     )
-    data = [message.serialize() for message in messages]
-    return jsonify(messages=data), 200
+
+
+@forum_route.route("/<club_id>/changes", methods=["GET"])
+@login_required
+@club_access_required
+def club_changes_route(club_id):
+    """Route to read the forum changes after a change log position: since=<seq>.
+    Only the latest change of each message is returned, "created" and "edited" with the message
+    ("created" when it was posted after the position), "deleted" with its id. "latest" is the position to ask from next time and "more" tells if
+    changes are left after it. Reads up to FORUM_MAX_PAGE_SIZE changes per request.
+    A position older than the pruned part of the log gets a 410, the client reloads the messages.
+    """
+    limit = current_app.config.get("FORUM_MAX_PAGE_SIZE", 50)
+    try:
+        since = int(request.args.get("since", 0))
+        if since < 0:
+            raise ValueError
+    except ValueError:
+        return jsonify({"error": "Invalid change sequence"}), 400
+    if since < MessageChange.horizon(club_id):
+        return jsonify({"error": "Changes pruned, reload the messages"}), 410
+
+    data, latest, more = read_changes(club_id, since, limit)
+    return jsonify(changes=data, latest=latest, more=more), 200
+
+
+def read_changes(club_id, since, limit):
+    """Latest change of each message among the next limit changes of the club log after since.
+    Returns (changes, latest, more): the changes oldest first, each with its "seq", the position
+    to read from next time and whether changes are left after it"""
+    changes = MessageChange.since(club_id, since, limit + 1)
+    more = len(changes) > limit
+    changes = changes[:limit]
+    latest = {change.message_id: change for change in changes}  # the last change of each message wins
+    created = {change.message_id for change in changes if change.kind == "created"}
+    message_ids = [message_id for message_id, change in latest.items() if change.kind != "deleted"]
+    messages = {
+        message.id: message
+        for message in db.session.query(Message)
+        .filter(Message.id.in_(message_ids))
+        .options(joinedload(Message.user))
+    } if message_ids else {}
+
+    data = []
+    for change in sorted(latest.values(), key=lambda change: change.seq):
+        message = messages.get(change.message_id)
+        if message is None:
+            # Deleted after this change, its tombstone is further in the log
+            data.append({"seq": change.seq, "type": "deleted", "id": change.message_id})
+        else:
+            kind = "created" if change.message_id in created else change.kind
+            data.append({"seq": change.seq, "type": kind, "message": message.serialize()})
+    return data, changes[-1].seq if changes else since, more
+
+
+@forum_route.route("/<club_id>/read", methods=["POST"])
+@login_required
+@club_access_required
+def club_read_route(club_id):
+    """Route to move the member read marker to a message shown by the live forum: {"message_id": <id>}"""
+    json_data = request.get_json(silent=True) or {}
+    try:
+        message_id = int(json_data.get("message_id"))
+    except (TypeError, ValueError):
+        return jsonify({"error": "Invalid message"}), 400
+    probe = db.select(db.literal(1)).where(Message.id == message_id, Message.club_id == club_id)
+    if db.session.execute(probe).first() is None:
+        return jsonify({"error": "Invalid message"}), 404
+    ClubMembers.mark_read(club_id, g.user.id, message_id)
+    db.session.commit()
+    return jsonify(message_id=message_id), 200
 
 
 @forum_route.route("/<club_id>/messages", methods=["POST"])
@@ -33,10 +218,28 @@ def add_club_messages_route(club_id):
         club_id=club_id, user_id=g.user.id, message=json_data["message"]
     )
     if new_message:
-        return jsonify(message=new_message.serialize()), 200
+        data = new_message.serialize()
+        forum_hub.notify(club_id)
+        prune_change_log()
+        return jsonify(message=data), 200
     return jsonify(json_data), 400
 
 
+def prune_change_log():
+    """Remove the change log past FORUM_CHANGES_RETENTION_DAYS, when this worker is due to"""
+    before = forum_hub.prune_before()
+    if before is None:
+        return
+    try:
+        pruned = MessageChange.prune(before)
+        db.session.commit()
+    except SQLAlchemyError:
+        db.session.rollback()
+        current_app.logger.exception("Forum change log pruning failed")
+    else:
+        current_app.logger.info("Pruned %s forum changes older than %s", pruned, before.isoformat())
+
+
 @forum_route.route("/<club_id>/messages/<message_id>", methods=["PATCH"])
 @login_required
 @club_access_required
@@ -48,7 +251,9 @@ def update_club_messages_route(club_id, message_id):
         return jsonify(json_data), 403
     modified = message.update_message(json_data.get("message", message.message))
     if modified:
-        return jsonify(message=modified.serialize()), 200
+        data = modified.serialize()
+        forum_hub.notify(club_id)
+        return jsonify(message=data), 200
     return jsonify(json_data), 400
 
 
@@ -63,5 +268,113 @@ def delete_club_messages_route(club_id, message_id):
         return jsonify(json_data), 403
     deleted = message.delete()
     if deleted:
+        forum_hub.notify(club_id)
         return jsonify(message="deleted"), 200
-    return jsonify(json_data), 400
\ No newline at end of file
+    return jsonify(json_data), 400
+
+
+@forum_route.route("/<club_id>/stream", methods=["GET"])
+@login_required
+@club_access_required
+def club_stream_route(club_id):
+    """Server-Sent Events stream of the club forum: created, edited and deleted messages, read from
+    the change log after since=<changes_seq> of the first messages page. Event ids are change log
+    positions, so a reconnecting browser resumes after its Last-Event-ID whichever worker serves it;
+    an invalid id gets a reset event asking to reload the messages. The club access is checked again
+    with every heartbeat and the stream closes after FORUM_STREAM_MAX_SECONDS, the browser
+    reconnects on its own.
+    """
+    start = (
+        request.headers.get("Last-Event-ID")
+        or request.args.get("last_event_id")
+        or request.args.get("since")
+    )
+    latest = MessageChange.latest_seq(club_id)
+    if start is None:
+        position = latest
+    elif start.isdigit() and int(start) >= MessageChange.horizon(club_id):
+        position = int(start)
+    else:
+        position = None  # invalid or pruned position
+    heartbeat = current_app.config.get("FORUM_STREAM_HEARTBEAT", 15)
+    duration = current_app.config.get("FORUM_STREAM_MAX_SECONDS", 300)
+    limit = current_app.config.get("FORUM_MAX_PAGE_SIZE", 50)
+    app = current_app._get_current_object()
+
+    def load(since):
+        # Called by the club reader thread and for the catch up, each read takes its own connection
+        with app.app_context():
+            return read_club_events(int(club_id), since, limit)
+
+    # Give back the connection used by the access check
+    db.session.close()
+    return Response(
+        stream_with_context(
+            forum_events(int(club_id), g.user.id, position, latest, load, heartbeat, duration)
+        ),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+def read_club_events(club_id, since, limit):
+    """Server-Sent Events of the club changes after a log position, as read_changes.
+    Returns (events, latest, more), the events as (seq, event message)"""
+    changes, latest, more = read_changes(club_id, since, limit)
+    events = [
+        (
+            change["seq"],
+            format_event(
+                change["type"],
+                change["message"] if "message" in change else {"id": change["id"]},
+                change["seq"],
+            ),
+        )
+        for change in changes
+    ]
+    return events, latest, more
+
+
+def forum_events(club_id, user_id, position, latest, load, heartbeat, duration):
+    """Server-Sent Events of the club changes after the log position, with keep-alive comments.
+    The events published after the club reader position come from the forum hub, the ones
+    before it are loaded once when the stream starts"""
+    subscription, reader_position = forum_hub.subscribe(club_id, latest, load)
+    try:
+        yield "retry: 3000\n\n"
+        if position is None:
+            position = latest
+            yield format_event("reset", {}, position)
+        while position < reader_position:
+            events, position, more = load(position)
+            for seq, message in events:
+                yield message
+            if not more:
+                break
+        deadline = monotonic() + duration
+        next_check = monotonic() + heartbeat
+        while True:
+            if subscription.overflowed:
+                subscription.overflowed = False
+                yield format_event("reset", {}, position)
+            for seq, message in subscription.get(timeout=min(deadline, next_check) - monotonic()):
+                if seq > position:
+                    yield message
+                    position = seq
+            now = monotonic()
+            if now >= deadline:
+                return
+            if now >= next_check:
+                has_access = ClubMembers.has_access(club_id, user_id)
+                db.session.close()
+                if not has_access:
+                    return
+                yield ": keep-alive\n\n"
+                next_check = now + heartbeat
+    finally:
+        forum_hub.unsubscribe(club_id, subscription)
+
+
+def format_event(event_type, data, event_id):
+    """Server-Sent Event message"""
+    return f"id: {event_id}\nevent: {event_type}\ndata: {json.dumps(data)}\n\n"
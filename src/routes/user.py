@@ -13,7 +13,7 @@ user_route = Blueprint("user_route", __name__)
 @login_required
 def profile_view():
     """View function to open user info and edit page"""
-    edit_form = UserEditForm(obj=g.user)
+    edit_form = UserEditForm(obj=g.user, current_email=g.user.email)
     if request.method == "POST" and edit_form.validate_on_submit():
         button = request.form.get("button")
         if button == "save":
@@ -3,7 +3,10 @@ BoomWorm Den Supporting functions
 """
 
 from functools import wraps
-from flask import session, flash, redirect, url_for, g, request
+from flask import session, flash, redirect, url_for, g, request, current_app
+from itsdangerous import URLSafeSerializer
+from models import ClubMembers
+from services import user_cache
 
 def login_required(f):
     """Decorator function to control protected views"""
@@ -25,12 +28,7 @@ def club_access_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
         club_id = int(kwargs.get("club_id"))
-        member_club_ids = [
-            membership.club.id
-            for membership in g.user.membership
-            if membership.status in [1, 2]
-        ]
-        if club_id not in member_club_ids:
+        if not ClubMembers.has_access(club_id, g.user.id):
             flash("You don't have access to this club", "danger")
             return redirect(url_for("club_route.clubs_view"))
 
@@ -42,8 +40,18 @@ def club_access_required(f):
 def login(user):
     """Function to process login, store user information on flask session"""
     session["CURRENT_USER"] = user.id
+    user_cache.remember_user(user)
 
 
 def logout():
     """Function to process logout, remove user information from flask session"""
-    session.pop("CURRENT_USER")
\ No newline at end of file
+    session.pop("CURRENT_USER")
+
+def cursor_serializer(salt):
+    """Signed serializer for the opaque pagination cursors sent to the frontend"""
+    return URLSafeSerializer(current_app.secret_key, salt=salt)
+
+
+def first_form_error(form, default):
+    """First validation message of a form, default when no field has one"""
+    return next((errors[0] for errors in form.errors.values() if errors), default)
@@ -0,0 +1,44 @@
+from .volume_cache import VolumeCache, volume_cache
+from .search_cache import SearchCache, search_cache, normalize_query
+from .circuit_breaker import CircuitBreaker
+from .single_flight import SingleFlight
+from .books_client import BooksClient, books_client, GOOGLE_BOOKS_API_URL
+from .cover_store import CoverStore, cover_store, COVER_SIZES
+from .sql_stats import QueryCollector, QueryStats, sql_stats
+from .user_cache import UserCache, user_cache, CurrentUser
+from .pool_stats import PoolMonitor, TimedQueuePool, pool_stats, engine_options
+from .read_replica import ReplicaRouter, read_replica
+from .forum_hub import ForumHub, forum_hub
+from .stats_report import StatsReport, stats_report
+
+__all__=[
+    "VolumeCache",
+    "volume_cache",
+    "SearchCache",
+    "search_cache",
+    "normalize_query",
+    "CircuitBreaker",
+    "SingleFlight",
+    "BooksClient",
+    "books_client",
+    "GOOGLE_BOOKS_API_URL",
+    "CoverStore",
+    "cover_store",
+    "COVER_SIZES",
+    "QueryCollector",
+    "QueryStats",
+    "sql_stats",
+    "UserCache",
+    "user_cache",
+    "CurrentUser",
+    "PoolMonitor",
+    "TimedQueuePool",
+    "pool_stats",
+    "engine_options",
+    "ReplicaRouter",
+    "read_replica",
+    "ForumHub",
+    "forum_hub",
+    "StatsReport",
+    "stats_report",
+]
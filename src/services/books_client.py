@@ -0,0 +1,263 @@
+"""
+BookWorm Den Google Books API client
+"""
+
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .circuit_breaker import CircuitBreaker
+from .single_flight import SingleFlight
+
+GOOGLE_BOOKS_API_URL = "https://www.googleapis.com/books/v1/volumes"
+
+RETRY_STATUS = {429, 500, 502, 503, 504}
+# 403 reply reasons of an exhausted API key quota, reported as 429 like the other rate limits
+QUOTA_REASONS = {"dailyLimitExceeded", "rateLimitExceeded", "userRateLimitExceeded", "quotaExceeded"}
+
+
+def quota_reasons(response):
+    """Quota reasons of a Google API 403 error reply, empty for the other 403 replies"""
+    try:
+        errors = response.json()["error"]["errors"]
+        return {error.get("reason") for error in errors} & QUOTA_REASONS
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return set()
+
+
+class LatencyHistogram:
+    """Cumulative latency histogram per upstream operation, bucket bounds in milliseconds"""
+
+    BUCKETS = (25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._data = {}
+
+    def observe(self, operation, seconds):
+        """Record the duration of one upstream call"""
+        milliseconds = seconds * 1000
+        with self._lock:
+            data = self._data.setdefault(
+                operation, {"counts": [0] * (len(self.BUCKETS) + 1), "count": 0, "sum_ms": 0.0}
+            )
+            index = next(
+                (i for i, bound in enumerate(self.BUCKETS) if milliseconds <= bound),
+                len(self.BUCKETS),
+            )
+            data["counts"][index] += 1
+            data["count"] += 1
+            data["sum_ms"] += milliseconds
+
+    def snapshot(self):
+        """Histogram copy keyed by operation, with "+Inf" as the overflow bucket"""
+        labels = [str(bound) for bound in self.BUCKETS] + ["+Inf"]
+        with self._lock:
+            return {
+                operation: {
+                    "buckets": dict(zip(labels, data["counts"])),
+                    "count": data["count"],
+                    "sum_ms": round(data["sum_ms"], 3),
+                }
+                for operation, data in self._data.items()
+            }
+
+
+class BooksClient:
+    """Client for the Google Books volumes API.
+
+    Keeps a pooled keep-alive session, applies connect/read timeouts to every call and
+    retries 429/5xx replies and connection errors a bounded number of times with jittered
+    exponential backoff, all within a total `deadline` in seconds: the attempts and the waits
+    between them never run past it. Calls return (payload, status_code); network failures are
+    reported as 504 (timeout) or 502 (connection and other request errors) with a None payload,
+    and a 403 over the key quota as a 429; a daily quota is not retried.
+    Upstream failures feed a circuit breaker; while it is open calls are refused at once
+    with a 503 so the routes can fall back to the local catalog.
+    Identical concurrent calls are coalesced into a single upstream request.
+    """
+
+    def __init__(
+        self,
+        base_url=GOOGLE_BOOKS_API_URL,
+        api_key=None,
+        connect_timeout=3.05,
+        read_timeout=10,
+        retries=2,
+        backoff=0.25,
+        deadline=15,
+        pool_size=10,
+        breaker_failures=5,
+        breaker_reset=30,
+        lock_dir=None,
+    ):
+        self.base_url = base_url
+        self.api_key = api_key
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.deadline = deadline
+        self.pool_size = pool_size
+        self.latency = LatencyHistogram()
+        self.breaker = CircuitBreaker(breaker_failures, breaker_reset)
+        self.single_flight = SingleFlight(lock_dir)
+        self.session = self._build_session()
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+    def init_app(self, app):
+        """Read the client settings from the flask app configuration"""
+        self.base_url = app.config.get("GOOGLE_BOOKS_API_URL", self.base_url)
+        self.api_key = app.config.get("GOOGLE_API_KEY", self.api_key)
+        self.connect_timeout = app.config.get("GOOGLE_BOOKS_CONNECT_TIMEOUT", self.connect_timeout)
+        self.read_timeout = app.config.get("GOOGLE_BOOKS_READ_TIMEOUT", self.read_timeout)
+        self.retries = app.config.get("GOOGLE_BOOKS_RETRIES", self.retries)
+        self.deadline = app.config.get("GOOGLE_BOOKS_DEADLINE", self.deadline)
+        self.pool_size = app.config.get("GOOGLE_BOOKS_POOL_SIZE", self.pool_size)
+        self.breaker.failure_threshold = app.config.get(
+            "GOOGLE_BOOKS_BREAKER_FAILURES", self.breaker.failure_threshold
+        )
+        self.breaker.reset_timeout = app.config.get(
+            "GOOGLE_BOOKS_BREAKER_RESET", self.breaker.reset_timeout
+        )
+        self.single_flight.lock_dir = app.config.get(
+            "GOOGLE_BOOKS_LOCK_DIR", self.single_flight.lock_dir
+        )
+        self.session = self._build_session()
+        app.extensions["books_client"] = self
+
+    def _build_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=self.pool_size, pool_maxsize=self.pool_size, max_retries=0
+        )
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def get_volume(self, volume_id):
+        """Fetch the details of a single volume"""
+        return self._get("volume", f"{self.base_url}/{volume_id}", {})
+
+    def get_volumes(self, volume_ids):
+        """Fetch several volumes concurrently, on a thread pool bounded by the connection pool size.
+        Returns a dictionary of volume id -> (payload, status_code)"""
+        if len(volume_ids) == 1:
+            return {volume_ids[0]: self.get_volume(volume_ids[0])}
+        results = self._pool().map(self.get_volume, volume_ids)
+        return dict(zip(volume_ids, results))
+
+    def search_volumes_concurrently(self, params_list):
+        """Run several searches concurrently, yielding (index, (payload, status_code)) as each one completes"""
+        futures = {
+            self._pool().submit(self.search_volumes, params): index
+            for index, params in enumerate(params_list)
+        }
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+    def _pool(self):
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.pool_size, thread_name_prefix="books-client"
+                )
+            return self._executor
+
+    def search_volumes(self, params):
+        """Run a volumes search with the given query parameters"""
+        return self._get("search", self.base_url, params)
+
+    def fetch_cover(self, url):
+        """Download a cover image through the pooled session. Returns (content, status_code)"""
+        start = time.perf_counter()
+        try:
+            response = self.session.get(url, timeout=(self.connect_timeout, self.read_timeout))
+        except requests.Timeout:
+            return None, 504
+        except requests.RequestException:
+            return None, 502
+        finally:
+            self.latency.observe("cover", time.perf_counter() - start)
+        if response.status_code != 200:
+            return None, response.status_code
+        return response.content, 200
+
+    def _get(self, operation, url, params):
+        key = f"{url}?{sorted(params.items())}"
+        return self.single_flight.do(key, lambda: self._call(operation, url, params))
+
+    def _call(self, operation, url, params):
+        if not self.breaker.allow_request():
+            return None, 503
+        params = {**params, "key": self.api_key}
+        try:
+            payload, status_code = self._send(operation, url, params)
+        except Exception:
+            # Release a half open trial, the circuit would otherwise refuse calls forever
+            self.breaker.record_failure()
+            raise
+        if status_code in RETRY_STATUS:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        return payload, status_code
+
+    def _send(self, operation, url, params):
+        deadline_at = time.monotonic() + self.deadline
+        for attempt in range(self.retries + 1):
+            remaining = max(deadline_at - time.monotonic(), 0.01)
+            reasons = set()
+            start = time.perf_counter()
+            try:
+                response = self.session.get(
+                    url,
+                    params=params,
+                    timeout=(min(self.connect_timeout, remaining), min(self.read_timeout, remaining)),
+                )
+            except requests.Timeout:
+                payload, status_code, retry_after = None, 504, None
+            except requests.RequestException:
+                payload, status_code, retry_after = None, 502, None
+            else:
+                status_code = response.status_code
+                retry_after = response.headers.get("Retry-After")
+                try:
+                    payload = response.json() if status_code == 200 else None
+                except ValueError:
+                    payload, status_code = None, 502
+                if status_code == 403:
+                    reasons = quota_reasons(response)
+                    status_code = 429 if reasons else 403
+            finally:
+                self.latency.observe(operation, time.perf_counter() - start)
+
+            if status_code not in RETRY_STATUS or attempt == self.retries or "dailyLimitExceeded" in reasons:
+                return payload, status_code
+            delay = self._delay(attempt, retry_after)
+            if time.monotonic() + delay >= deadline_at:
+                return payload, status_code
+            time.sleep(delay)
+
+    def _delay(self, attempt, retry_after=None):
+        """Full-jitter exponential backoff, honouring a short Retry-After header"""
+        delay = random.uniform(0, self.backoff * 2**attempt)
+        if retry_after and retry_after.isdigit():
+            delay = max(delay, min(int(retry_after), self.read_timeout))
+        return delay
+
+    def stats(self):
+        """Upstream latency histograms, circuit state and request coalescing counters"""
+        return {
+            "latency": self.latency.snapshot(),
+            "circuit": self.breaker.state,
+            "coalescing": self.single_flight.stats(),
+        }
+
+
+books_client = BooksClient()
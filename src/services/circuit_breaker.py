@@ -0,0 +1,74 @@
+"""
+BookWorm Den circuit breaker for upstream services
+"""
+
+import threading
+from time import monotonic
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    """Stop calling an upstream after consecutive failures.
+
+    After `failure_threshold` consecutive failures the circuit opens and calls are refused
+    for `reset_timeout` seconds. Then a single trial call is let through (half open): a
+    success closes the circuit again, a failure re-opens it.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_running = False
+
+    @property
+    def state(self):
+        """Current state, moving an expired open circuit to half open"""
+        with self._lock:
+            return self._current_state()
+
+    @property
+    def is_open(self):
+        return self.state == OPEN
+
+    def allow_request(self):
+        """Return True if a call may be sent upstream now"""
+        with self._lock:
+            state = self._current_state()
+            if state == CLOSED:
+                return True
+            if state == HALF_OPEN and not self._trial_running:
+                self._trial_running = True
+                return True
+            return False
+
+    def record_success(self):
+        """Register a successful call, closing the circuit"""
+        with self._lock:
+            self._state = CLOSED
+            self._failures = 0
+            self._trial_running = False
+
+    def record_failure(self):
+        """Register a failed call, opening the circuit when the threshold is reached"""
+        with self._lock:
+            self._failures += 1
+            if self._state == HALF_OPEN or self._failures >= self.failure_threshold:
+                self._state = OPEN
+                self._opened_at = monotonic()
+            self._trial_running = False
+
+    def reset(self):
+        """Force the circuit closed"""
+        self.record_success()
+
+    def _current_state(self):
+        if self._state == OPEN and monotonic() - self._opened_at >= self.reset_timeout:
+            self._state = HALF_OPEN
+        return self._state
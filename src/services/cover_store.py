@@ -0,0 +1,197 @@
+"""
+BookWorm Den book cover image store
+"""
+
+import contextlib
+import hashlib
+import io
+import os
+import tempfile
+import threading
+from urllib.parse import parse_qs, urlsplit
+
+try:
+    from PIL import Image
+except ImportError:  # Without Pillow the original image is served for every size
+    Image = None
+
+COVER_SIZES = {"small": 128, "medium": 256, "large": 512}
+
+ALLOWED_COVER_HOSTS = ("books.google.com", "googleusercontent.com", "googleapis.com")
+
+
+def allowed_cover_url(url):
+    """Only Google Books image URLs are proxied"""
+    try:
+        parts = urlsplit(url)
+    except ValueError:
+        return False
+    host = parts.hostname or ""
+    return parts.scheme in ("http", "https") and any(
+        host == allowed or host.endswith(f".{allowed}") for allowed in ALLOWED_COVER_HOSTS
+    )
+
+
+def cover_url_for_book(url, api_id):
+    """True when a Google Books image URL is the cover of the given volume (its id parameter)"""
+    try:
+        return parse_qs(urlsplit(url).query).get("id") == [api_id]
+    except ValueError:
+        return False
+
+
+class CoverStore:
+    """On disk, content addressed store for book cover images.
+
+    Each cover is downloaded once, saved under the digest of its bytes and resized to the
+    fixed COVER_SIZES widths on first request. A small reference file per book maps the
+    book id and source URL to the content digest.
+    The files are kept under `max_bytes` in total: every use refreshes a file modification
+    time and the least recently used files are removed first.
+    """
+
+    def __init__(self, directory=None, fetch=None, max_bytes=256 * 1024 * 1024):
+        self.directory = directory
+        self.fetch = fetch
+        self.max_bytes = max_bytes
+        self._size = None  # bytes on disk, counted on the first write
+        self._lock = threading.Lock()
+        self._size_lock = threading.Lock()
+
+    def init_app(self, app, fetch):
+        """Read the cover directory and size limit from the flask app configuration"""
+        self.directory = app.config.get(
+            "COVER_CACHE_DIR", os.path.join(app.instance_path, "covers")
+        )
+        self.max_bytes = app.config.get("COVER_CACHE_MAX_BYTES", self.max_bytes)
+        self.fetch = fetch
+        app.extensions["cover_store"] = self
+
+    def has(self, api_id, source_url):
+        """True when the cover of the book is already stored"""
+        return self._stored_digest(api_id, source_url) is not None
+
+    def get(self, api_id, source_url, size="medium"):
+        """Return (path, etag, mimetype) for the cover at the requested size, or None if it can't be fetched"""
+        digest = self._digest_for(api_id, source_url)
+        if digest is None:
+            return None
+        original = os.path.join(self.directory, f"{digest}.orig")
+        self._touch(original)
+        if Image is None:
+            return original, digest, "image/jpeg"
+        path = os.path.join(self.directory, f"{digest}-{size}.jpg")
+        if os.path.exists(path):
+            self._touch(path)
+        else:
+            with self._lock:
+                if not os.path.exists(path) and not self._resize(original, path, COVER_SIZES[size]):
+                    return original, digest, "image/jpeg"
+        return path, f"{digest}-{size}", "image/jpeg"
+
+    def open_cover(self, api_id, source_url, size="medium"):
+        """Return (file, etag, mimetype) with the cover opened for reading, or None if it can't be fetched.
+        An open file stays readable when another request evicts it. A cover evicted between the lookup
+        and the open is looked up, and fetched, once more."""
+        for _ in range(2):
+            cover = self.get(api_id, source_url, size)
+            if cover is None:
+                return None
+            path, etag, mimetype = cover
+            try:
+                return open(path, "rb"), etag, mimetype
+            except FileNotFoundError:
+                continue
+        return None
+
+    def _ref_path(self, api_id):
+        return os.path.join(self.directory, "refs", hashlib.sha256(api_id.encode()).hexdigest())
+
+    def _stored_digest(self, api_id, source_url):
+        source_url = source_url.replace("http://", "https://", 1)
+        ref_path = self._ref_path(api_id)
+        try:
+            with open(ref_path) as ref_file:
+                stored_url, digest = ref_file.read().split("\n")[:2]
+        except (OSError, ValueError):
+            return None
+        if stored_url != source_url or not os.path.exists(os.path.join(self.directory, f"{digest}.orig")):
+            return None
+        self._touch(ref_path)
+        return digest
+
+    def _digest_for(self, api_id, source_url):
+        digest = self._stored_digest(api_id, source_url)
+        if digest is not None:
+            return digest
+
+        source_url = source_url.replace("http://", "https://", 1)
+        content, status_code = self.fetch(source_url)
+        if status_code != 200 or not content:
+            return None
+        digest = hashlib.sha256(content).hexdigest()
+        self._write(os.path.join(self.directory, f"{digest}.orig"), content)
+        self._write(self._ref_path(api_id), f"{source_url}\n{digest}".encode())
+        return digest
+
+    def _resize(self, original, path, width):
+        try:
+            with Image.open(original) as image:
+                image = image.convert("RGB")
+                image.thumbnail((width, width * 2))
+                buffer = io.BytesIO()
+                image.save(buffer, "JPEG", quality=85, optimize=True)
+        except (OSError, ValueError):
+            return False
+        self._write(path, buffer.getvalue())
+        return True
+
+    def _write(self, path, content):
+        """Write atomically, so concurrent workers never serve a partial file"""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with tempfile.NamedTemporaryFile("wb", dir=os.path.dirname(path), delete=False) as temp_file:
+            temp_file.write(content)
+        os.replace(temp_file.name, path)
+        with self._size_lock:
+            if self._size is None:
+                self._size = sum(size for _, _, size in self._files())
+            else:
+                self._size += len(content)
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _touch(self, path):
+        """Mark a file as recently used"""
+        with contextlib.suppress(OSError):
+            os.utime(path)
+
+    def _files(self):
+        """(modification time, path, size) of every stored file"""
+        files = []
+        for directory in (self.directory, os.path.join(self.directory, "refs")):
+            try:
+                entries = list(os.scandir(directory))
+            except OSError:
+                continue
+            for entry in entries:
+                with contextlib.suppress(OSError):
+                    if entry.is_file():
+                        stat = entry.stat()
+                        files.append((stat.st_mtime, entry.path, stat.st_size))
+        return files
+
+    def _evict(self):
+        """Remove the least recently used files until the store is back to 90% of max_bytes.
+        The files are counted again, so the writes of other workers are included."""
+        files = sorted(self._files())
+        size = sum(file_size for _, _, file_size in files)
+        for _, path, file_size in files:
+            if size <= self.max_bytes * 0.9:
+                break
+            with contextlib.suppress(OSError):
+                os.remove(path)
+                size -= file_size
+        self._size = size
+
+
+cover_store = CoverStore()
@@ -0,0 +1,153 @@
+"""
+BookWorm Den live forum events
+"""
+
+import logging
+import queue
+import threading
+from datetime import datetime, timedelta, timezone
+from time import monotonic
+
+
+class ForumHub:
+    """In-process fan-out of the forum change log to the club stream subscribers.
+
+    The clubs with subscribers each get one reader thread per worker. It reads every batch of the
+    shared MessageChange log once, as soon as a message of the club changes in this worker and at
+    least every poll interval for the changes made by the other workers, and pushes the formatted
+    events to the subscriber queues. Subscribers only read their queue, so the database load does
+    not grow with the open streams and no connection is held while they wait.
+    """
+
+    def __init__(self, poll_seconds=2, queue_size=1000, retention_days=30, prune_seconds=3600):
+        self.poll_seconds = poll_seconds
+        self.queue_size = queue_size
+        self.retention_days = retention_days
+        self.prune_seconds = prune_seconds
+        self.logger = logging.getLogger(__name__)
+        self._readers = {}  # club_id -> ClubReader
+        self._lock = threading.Lock()
+        self._pruned_at = None
+
+    def init_app(self, app):
+        """Read the poll interval, queue size and change log retention from the flask app configuration"""
+        self.poll_seconds = app.config.get("FORUM_STREAM_POLL_SECONDS", self.poll_seconds)
+        self.queue_size = app.config.get("FORUM_STREAM_QUEUE_SIZE", self.queue_size)
+        self.retention_days = app.config.get("FORUM_CHANGES_RETENTION_DAYS", self.retention_days)
+        self.logger = app.logger
+        app.extensions["forum_hub"] = self
+
+    def prune_before(self):
+        """Oldest change log time to keep when this worker is due to prune the log (at most once per
+        prune_seconds), None otherwise or when the retention is 0 (keep everything)"""
+        if not self.retention_days:
+            return None
+        with self._lock:
+            now = monotonic()
+            if self._pruned_at is not None and now - self._pruned_at < self.prune_seconds:
+                return None
+            self._pruned_at = now
+        return datetime.now(timezone.utc) - timedelta(days=self.retention_days)
+
+    def subscribe(self, club_id, position, load):
+        """Register a subscriber of a club. The club reader starts at the log position when it is
+        not running yet; load(since) reads the log after a position and returns (events, latest, more),
+        events as (seq, payload) oldest first. Returns (subscription, reader_position): the events
+        after reader_position reach the subscription, the older ones are for the subscriber to load"""
+        club_id = int(club_id)
+        subscription = Subscription(self.queue_size)
+        with self._lock:
+            reader = self._readers.get(club_id)
+            if reader is None:
+                reader = self._readers[club_id] = ClubReader(self, club_id, position, load)
+                reader.start()
+            reader.subscribers.add(subscription)
+            return subscription, reader.position
+
+    def unsubscribe(self, club_id, subscription):
+        """Remove a subscriber, the club reader stops with its last subscriber"""
+        with self._lock:
+            reader = self._readers.get(int(club_id))
+            if reader is not None:
+                reader.subscribers.discard(subscription)
+                if not reader.subscribers:
+                    reader.wake.set()
+
+    def notify(self, club_id):
+        """Wake up the club reader after one of the club messages changed in this worker"""
+        with self._lock:
+            reader = self._readers.get(int(club_id))
+        if reader is not None:
+            reader.wake.set()
+
+    def stats(self):
+        """Number of running club readers and of subscribers"""
+        with self._lock:
+            return {
+                "readers": len(self._readers),
+                "subscribers": sum(len(reader.subscribers) for reader in self._readers.values()),
+            }
+
+
+class ClubReader(threading.Thread):
+    """Reader thread of the change log of one club, see ForumHub"""
+
+    def __init__(self, hub, club_id, position, load):
+        super().__init__(name=f"forum-club-{club_id}", daemon=True)
+        self.hub = hub
+        self.club_id = club_id
+        self.position = position
+        self.load = load
+        self.subscribers = set()
+        self.wake = threading.Event()
+        self.loads = 0
+
+    def run(self):
+        while True:
+            self.wake.wait(self.hub.poll_seconds)
+            self.wake.clear()
+            with self.hub._lock:
+                if not self.subscribers:
+                    del self.hub._readers[self.club_id]
+                    return
+            try:
+                more = True
+                while more:
+                    events, latest, more = self.load(self.position)
+                    self.loads += 1
+                    with self.hub._lock:
+                        for subscription in self.subscribers:
+                            subscription.put(events)
+                        self.position = latest
+            except Exception:
+                self.hub.logger.exception("Forum change log read failed for club %s", self.club_id)
+
+
+class Subscription:
+    """Queue of the (seq, payload) events pushed to one stream subscriber"""
+
+    def __init__(self, maxsize):
+        self._queue = queue.Queue(maxsize)
+        self.overflowed = False  # events were dropped, the subscriber must resynchronize
+
+    def put(self, events):
+        for event in events:
+            try:
+                self._queue.put_nowait(event)
+            except queue.Full:
+                self.overflowed = True
+
+    def get(self, timeout):
+        """Queued events, waiting up to timeout seconds for the first one"""
+        try:
+            events = [self._queue.get(timeout=max(timeout, 0))]
+        except queue.Empty:
+            return []
+        while True:
+            try:
+                events.append(self._queue.get_nowait())
+            except queue.Empty:
+                return events
+
+
+forum_hub = ForumHub()
@@ -0,0 +1,161 @@
+"""
+BookWorm Den connection pool configuration and metrics
+"""
+
+import logging
+import threading
+import weakref
+from time import monotonic, perf_counter
+
+from flask import g, has_app_context
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+
+
+class PoolMonitor:
+    """Checkout wait time and saturation of the connection pools created with TimedQueuePool.
+
+    Saturation is the share of the pool capacity (pool_size + max_overflow) checked out.
+    A saturated pool shows long checkout waits with few or fast queries, while slow
+    queries show in the SQL stats with short waits. Checkout timeouts and waits longer than
+    wait_warn seconds are logged as warnings, at most once per warn_interval seconds with the
+    number of occurrences since the previous warning.
+    """
+
+    def __init__(self, wait_warn=1.0, warn_interval=60):
+        self.wait_warn = wait_warn
+        self.warn_interval = warn_interval
+        self.logger = logging.getLogger(__name__)
+        self._pools = weakref.WeakSet()
+        self._lock = threading.Lock()
+        self._slow = 0  # timeouts and slow checkouts not logged yet
+        self._warned = None
+        self.reset()
+
+    def init_app(self, app):
+        """Read the wait warning threshold from the flask app configuration"""
+        self.wait_warn = app.config.get("DB_POOL_WAIT_WARN_MS", self.wait_warn * 1000) / 1000
+        self.logger = app.logger
+        app.extensions["pool_stats"] = self
+
+    def reset(self):
+        """Reset the counters, the pools stay registered"""
+        with self._lock:
+            self.checkouts = 0
+            self.timeouts = 0
+            self.wait_total = 0.0
+            self.wait_max = 0.0
+            self.peak_in_use = 0
+
+    def register(self, pool):
+        self._pools.add(pool)
+
+    def record_checkout(self, pool, seconds, timed_out=False):
+        """Record the time a connection request waited for the pool"""
+        in_use = pool.checkedout()
+        with self._lock:
+            if timed_out:
+                self.timeouts += 1
+            else:
+                self.checkouts += 1
+            self.wait_total += seconds
+            self.wait_max = max(self.wait_max, seconds)
+            self.peak_in_use = max(self.peak_in_use, in_use)
+            warn = self._slow_checkout(timed_out or seconds >= self.wait_warn)
+        if warn:
+            self.logger.warning(
+                "Database pool %s after %.0f ms, %s slow checkouts or timeouts since the last warning: %s",
+                "timeout" if timed_out else "checkout",
+                seconds * 1000,
+                warn,
+                self.stats(),
+            )
+        if has_app_context() and "sql_stats" in g:
+            g.sql_stats.record_pool_wait(seconds)
+
+    def _slow_checkout(self, slow):
+        """Count a slow checkout, returns the count to log when a warning is due"""
+        if not slow:
+            return 0
+        self._slow += 1
+        now = monotonic()
+        if self._warned is not None and now - self._warned < self.warn_interval:
+            return 0
+        self._warned = now
+        slow, self._slow = self._slow, 0
+        return slow
+
+    def stats(self):
+        """Counters and current usage of the registered pools"""
+        pools = list(self._pools)
+        in_use = sum(pool.checkedout() for pool in pools)
+        capacities = [pool.capacity for pool in pools]
+        capacity = None if None in capacities else sum(capacities)
+        with self._lock:
+            checkouts = self.checkouts + self.timeouts
+            return {
+                "checkouts": self.checkouts,
+                "timeouts": self.timeouts,
+                "wait_avg_ms": round(self.wait_total * 1000 / checkouts, 3) if checkouts else 0.0,
+                "wait_max_ms": round(self.wait_max * 1000, 3),
+                "in_use": in_use,
+                "peak_in_use": self.peak_in_use,
+                "capacity": capacity,
+                "saturation": round(in_use / capacity, 3) if capacity else 0.0,
+                "peak_saturation": round(self.peak_in_use / capacity, 3) if capacity else 0.0,
+            }
+
+
+pool_stats = PoolMonitor()
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool reporting how long each checkout waited to pool_stats"""
+
+    def __init__(self, creator, pool_size=5, max_overflow=10, **kw):
+        super().__init__(creator, pool_size=pool_size, max_overflow=max_overflow, **kw)
+        self.capacity = None if max_overflow < 0 else pool_size + max_overflow
+        pool_stats.register(self)
+
+    def connect(self):
+        start = perf_counter()
+        try:
+            connection = super().connect()
+        except PoolTimeoutError:
+            pool_stats.record_checkout(self, perf_counter() - start, timed_out=True)
+            raise
+        pool_stats.record_checkout(self, perf_counter() - start)
+        return connection
+
+
+def engine_options(
+    database_uri,
+    pool_size=5,
+    max_overflow=10,
+    pool_timeout=30,
+    pool_recycle=1800,
+    pre_ping=True,
+    statement_timeout_ms=0,
+):
+    """SQLALCHEMY_ENGINE_OPTIONS for the database, with a metered connection pool.
+
+    In-memory SQLite keeps the single shared connection set up by Flask-SQLAlchemy.
+    The statement timeout is only applied on PostgreSQL.
+    """
+    if not database_uri:
+        return {}
+    url = make_url(database_uri)
+    if url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:"):
+        return {}
+    options = {
+        "poolclass": TimedQueuePool,
+        "pool_size": pool_size,
+        "max_overflow": max_overflow,
+        "pool_timeout": pool_timeout,
+        "pool_recycle": pool_recycle,
+        "pool_pre_ping": pre_ping,
+    }
+    if statement_timeout_ms and url.get_backend_name() == "postgresql":
+        options["connect_args"] = {"options": f"-c statement_timeout={int(statement_timeout_ms)}"}
+    return options
@@ -0,0 +1,89 @@
+"""
+BookWorm Den read replica routing
+"""
+
+from contextlib import contextmanager
+from time import time
+
+from flask import g, has_app_context, request, session
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from models.database import db, REPLICA_BIND
+
+READ_METHODS = ("GET", "HEAD")
+
+
+class ReplicaRouter:
+    """Route the database reads of GET and HEAD requests to the replica bind, when configured.
+
+    After a request writes, the user's reads stay on the primary for DB_REPLICA_STICKY_SECONDS
+    (tracked in the flask session), so the replica lag never hides the user's own changes.
+    From its first flush on, a request reads and writes on the primary only.
+    Without a replica bind none of this bookkeeping runs.
+    """
+
+    def __init__(self):
+        self.sticky_seconds = 5
+        self._listening = False
+
+    def init_app(self, app):
+        """Register the request hooks deciding where each request reads from"""
+        self.sticky_seconds = app.config.get("DB_REPLICA_STICKY_SECONDS", self.sticky_seconds)
+        self._listen()
+        app.extensions["read_replica"] = self
+
+        @app.before_request
+        def choose_read_bind():
+            g.db_wrote = False
+            g.db_replica = False
+            if REPLICA_BIND not in db.engines:
+                return
+            g.db_replica = (
+                request.method in READ_METHODS
+                and session.get("DB_PRIMARY_UNTIL", 0) < time()
+            )
+
+        @app.after_request
+        def keep_reads_on_primary(response):
+            if (
+                g.get("db_wrote")
+                and request.method not in READ_METHODS
+                and REPLICA_BIND in db.engines
+            ):
+                session["DB_PRIMARY_UNTIL"] = time() + self.sticky_seconds
+            return response
+
+        @app.teardown_request
+        def clear_read_bind(exception=None):
+            g.pop("db_replica", None)
+            g.pop("db_wrote", None)
+
+    @contextmanager
+    def on_primary(self):
+        """Send the reads of the block to the primary, for the checks a lagging replica would fail"""
+        replica = g.get("db_replica", False)
+        g.db_replica = False
+        try:
+            yield
+        finally:
+            g.db_replica = replica and not g.get("db_wrote")
+
+    def _listen(self):
+        if self._listening:
+            return
+        event.listen(Session, "before_flush", self._before_flush)
+        event.listen(Session, "after_flush", self._after_flush)
+        self._listening = True
+
+    def _before_flush(self, db_session, flush_context, instances):
+        # RoutingSession.get_bind reads g.db_replica, the flush and what follows use the primary
+        if has_app_context():
+            g.db_replica = False
+
+    def _after_flush(self, db_session, flush_context):
+        if has_app_context():
+            g.db_wrote = True
+
+
+read_replica = ReplicaRouter()
@@ -0,0 +1,113 @@
+"""
+BookWorm Den book search cache
+"""
+
+import logging
+import threading
+from collections import OrderedDict
+from time import monotonic
+
+
+def normalize_query(query, language="en"):
+    """Cache key for a search: case-folded, whitespace-collapsed and scoped to a language"""
+    return f"{language}:{' '.join(query.casefold().split())}"
+
+
+class SearchCache:
+    """Cache for book search results, keyed by the normalized query.
+
+    Entries are fresh for `ttl` seconds, then may still be served for `grace` seconds
+    while a single background refresh fetches a new copy from upstream.
+    """
+
+    def __init__(self, ttl=300, grace=3600, max_entries=512):
+        self.ttl = ttl
+        self.grace = grace
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> (stored_at, results)
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.refresh_errors = 0
+        self.logger = logging.getLogger(__name__)
+
+    def init_app(self, app):
+        """Read the cache limits from the flask app configuration"""
+        self.ttl = app.config.get("SEARCH_CACHE_TTL", self.ttl)
+        self.grace = app.config.get("SEARCH_CACHE_GRACE", self.grace)
+        self.max_entries = app.config.get("SEARCH_CACHE_MAX_ENTRIES", self.max_entries)
+        self.logger = app.logger
+        app.extensions["search_cache"] = self
+
+    def lookup(self, key):
+        """Return (results, status) where status is "HIT", "STALE" or "MISS" """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry:
+                age = monotonic() - entry[0]
+                if age <= self.ttl:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1], "HIT"
+                if age <= self.ttl + self.grace:
+                    self._entries.move_to_end(key)
+                    self.stale_hits += 1
+                    return entry[1], "STALE"
+                del self._entries[key]
+            self.misses += 1
+            return None, "MISS"
+
+    def set(self, key, results):
+        """Store fresh search results"""
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (monotonic(), results)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def refresh(self, key, loader):
+        """Reload an entry in a background thread, unless a refresh is already running.
+        The loader should return (results, status_code), only 200 replies are stored."""
+        with self._lock:
+            if key in self._refreshing:
+                return False
+            self._refreshing.add(key)
+
+        def run():
+            try:
+                results, status_code = loader()
+                if status_code == 200:
+                    self.set(key, results)
+            except Exception:
+                with self._lock:
+                    self.refresh_errors += 1
+                self.logger.exception("Search cache refresh failed for %r", key)
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        threading.Thread(target=run, daemon=True).start()
+        return True
+
+    def clear(self):
+        """Drop every entry and reset the counters"""
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.stale_hits = self.misses = self.refresh_errors = 0
+
+    def stats(self):
+        """Hit/miss counters and current occupancy"""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "stale_hits": self.stale_hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+                "refreshing": len(self._refreshing),
+                "refresh_errors": self.refresh_errors,
+            }
+
+
+search_cache = SearchCache()
@@ -0,0 +1,125 @@
+"""
+BookWorm Den request coalescing for upstream calls
+"""
+
+import contextlib
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from time import time
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows, coalescing stays in-process
+    fcntl = None
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Share one upstream call between identical concurrent requests.
+
+    Within a process, the first caller for a key runs the function while the others wait
+    for its result. When `lock_dir` is set, callers in other worker processes are
+    serialized with a file lock and reuse a successful result written by the leader
+    during the last `result_ttl` seconds. Keys are hashed to a fixed number of `stripes`,
+    each with one lock file and one result file, so the directory never grows past them.
+    """
+
+    def __init__(self, lock_dir=None, result_ttl=2.0, stripes=256):
+        self.lock_dir = lock_dir
+        self.result_ttl = result_ttl
+        self.stripes = stripes
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.leaders = 0
+        self.followers = 0
+
+    def do(self, key, function):
+        """Run function() once for all concurrent callers with the same key.
+        The function should return a JSON serializable (payload, status_code) tuple."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.leaders += 1
+            else:
+                self.followers += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = self._run(key, function)
+            return call.result
+        except Exception as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def stats(self):
+        """Leader/follower counters"""
+        with self._lock:
+            return {"leaders": self.leaders, "followers": self.followers, "in_flight": len(self._calls)}
+
+    def _run(self, key, function):
+        if not self.lock_dir or fcntl is None:
+            return function()
+        digest = hashlib.sha256(key.encode()).hexdigest()
+        stripe = int(digest[:8], 16) % self.stripes
+        lock_path = os.path.join(self.lock_dir, f"stripe-{stripe}.lock")
+        result_path = os.path.join(self.lock_dir, f"stripe-{stripe}.json")
+        os.makedirs(self.lock_dir, exist_ok=True)
+        with open(lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                shared = self._read_result(result_path, digest)
+                if shared is not None:
+                    return shared
+                result = function()
+                if result[1] == 200:
+                    self._write_result(result_path, digest, result)
+                return result
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read_result(self, path, digest):
+        """Result of the key stored in the stripe result file, None when it holds another key or is too old"""
+        try:
+            if time() - os.path.getmtime(path) > self.result_ttl:
+                return None
+            with open(path) as result_file:
+                shared = json.load(result_file)
+            if shared["key"] != digest:
+                return None
+            payload, status_code = shared["result"]
+            return payload, status_code
+        except (OSError, KeyError, TypeError, ValueError):
+            return None
+
+    def _write_result(self, path, digest, result):
+        temp_path = None
+        try:
+            with tempfile.NamedTemporaryFile("w", dir=self.lock_dir, delete=False) as result_file:
+                temp_path = result_file.name
+                json.dump({"key": digest, "result": list(result)}, result_file)
+            os.replace(temp_path, path)
+        except (OSError, TypeError, ValueError):
+            # Not shared, the other workers call upstream themselves
+            if temp_path:
+                with contextlib.suppress(OSError):
+                    os.unlink(temp_path)
@@ -0,0 +1,151 @@
+"""
+BookWorm Den per-request SQL instrumentation
+"""
+
+import threading
+from contextlib import contextmanager
+from time import perf_counter
+
+from flask import g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from .pool_stats import pool_stats
+
+
+class QueryStats:
+    """Statement count, total database time and slowest statements of a unit of work"""
+
+    def __init__(self, keep_slowest=5):
+        self.keep_slowest = keep_slowest
+        self.count = 0
+        self.total_time = 0.0
+        self.statements = []
+        self.slowest = []  # (seconds, statement), slowest first
+        self.pool_wait = 0.0  # seconds spent waiting for pool connections
+
+    def record(self, statement, seconds):
+        self.count += 1
+        self.total_time += seconds
+        self.statements.append(statement)
+        if len(self.slowest) < self.keep_slowest or seconds > self.slowest[-1][0]:
+            self.slowest.append((seconds, statement))
+            self.slowest.sort(key=lambda item: item[0], reverse=True)
+            del self.slowest[self.keep_slowest:]
+
+    def record_pool_wait(self, seconds):
+        self.pool_wait += seconds
+
+    def __len__(self):
+        return self.count
+
+    def summary(self):
+        return {
+            "queries": self.count,
+            "db_time_ms": round(self.total_time * 1000, 3),
+            "pool_wait_ms": round(self.pool_wait * 1000, 3),
+            "slowest": [
+                {"ms": round(seconds * 1000, 3), "statement": statement}
+                for seconds, statement in self.slowest
+            ],
+        }
+
+
+class QueryCollector:
+    """Collect SQL statement statistics from the SQLAlchemy engine events.
+
+    Statistics are gathered for every request when SQL_STATS_HEADERS or SQL_STATS_LOG is
+    enabled, and for any block wrapped with track(), which the test fixtures use to
+    enforce query budgets.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._listening = False
+
+    def init_app(self, app):
+        """Listen to the engine events and report the request statistics as configured"""
+        self._listen()
+        app.extensions["sql_stats"] = self
+
+        @app.before_request
+        def start_sql_stats():
+            if app.config.get("SQL_STATS_HEADERS") or app.config.get("SQL_STATS_LOG"):
+                g.sql_stats = QueryStats()
+
+        @app.after_request
+        def report_sql_stats(response):
+            stats = g.pop("sql_stats", None)
+            if stats is None:
+                return response
+            if app.config.get("SQL_STATS_HEADERS"):
+                response.headers["X-DB-Queries"] = str(stats.count)
+                response.headers["X-DB-Time-ms"] = f"{stats.total_time * 1000:.3f}"
+                response.headers.add(
+                    "Server-Timing", f'db;dur={stats.total_time * 1000:.3f};desc="{stats.count} queries"'
+                )
+                response.headers["X-DB-Pool-Wait-ms"] = f"{stats.pool_wait * 1000:.3f}"
+                response.headers["X-DB-Pool-Saturation"] = str(pool_stats.stats()["saturation"])
+                response.headers.add("Server-Timing", f"db-pool;dur={stats.pool_wait * 1000:.3f}")
+            if app.config.get("SQL_STATS_LOG"):
+                app.logger.info(
+                    "%s %s: %d queries in %.3f ms, %.3f ms waiting for a connection",
+                    request.method,
+                    request.path,
+                    stats.count,
+                    stats.total_time * 1000,
+                    stats.pool_wait * 1000,
+                )
+                slow_ms = app.config.get("SQL_STATS_SLOW_MS", 100)
+                for seconds, statement in stats.slowest:
+                    if seconds * 1000 >= slow_ms:
+                        app.logger.warning("Slow query (%.3f ms): %s", seconds * 1000, statement)
+            return response
+
+    @contextmanager
+    def track(self):
+        """Collect the statements executed by this thread inside the with block"""
+        stats = QueryStats()
+        trackers = self._trackers()
+        trackers.append(stats)
+        try:
+            yield stats
+        finally:
+            trackers.remove(stats)
+
+    def _trackers(self):
+        if not hasattr(self._local, "trackers"):
+            self._local.trackers = []
+        return self._local.trackers
+
+    def _listen(self):
+        if self._listening:
+            return
+        event.listen(Engine, "before_cursor_execute", self._before_execute)
+        event.listen(Engine, "after_cursor_execute", self._after_execute)
+        event.listen(Engine, "handle_error", self._handle_error)
+        self._listening = True
+
+    def _before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("sql_stats_start", []).append(perf_counter())
+
+    def _after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self._finish(conn, statement)
+
+    def _handle_error(self, exception_context):
+        """A failed statement gets no after_cursor_execute, its start is taken off the stack here"""
+        if exception_context.connection is not None and exception_context.statement is not None:
+            self._finish(exception_context.connection, exception_context.statement)
+
+    def _finish(self, conn, statement):
+        starts = conn.info.get("sql_stats_start")
+        if not starts:
+            return
+        seconds = perf_counter() - starts.pop()
+        for stats in self._trackers():
+            stats.record(statement, seconds)
+        if has_app_context() and "sql_stats" in g:
+            g.sql_stats.record(statement, seconds)
+
+
+sql_stats = QueryCollector()
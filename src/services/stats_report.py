@@ -0,0 +1,60 @@
+"""
+BookWorm Den periodic service statistics
+"""
+
+import json
+import logging
+import threading
+from time import monotonic
+
+
+class StatsReport:
+    """Periodic log line with the counters of the registered services of a worker.
+
+    The line is written by the first request finishing after the interval, so an idle
+    worker logs nothing and no thread is needed.
+    """
+
+    def __init__(self, interval=300):
+        self.interval = interval
+        self.logger = logging.getLogger(__name__)
+        self._sources = {}  # name -> function returning a JSON serializable dict
+        self._lock = threading.Lock()
+        self._last = monotonic()
+
+    def init_app(self, app):
+        """Read the interval from the flask app configuration and log after the requests"""
+        self.interval = app.config.get("STATS_LOG_SECONDS", self.interval)
+        self.logger = app.logger
+        app.extensions["stats_report"] = self
+
+        @app.after_request
+        def log_service_stats(response):
+            if self.due():
+                self.log()
+            return response
+
+    def register(self, name, stats):
+        """Add a source to the report, stats() returns its counters"""
+        self._sources[name] = stats
+
+    def report(self):
+        """Counters of every registered source"""
+        return {name: stats() for name, stats in self._sources.items()}
+
+    def due(self):
+        """True once per interval, 0 disables the report"""
+        if not self.interval:
+            return False
+        with self._lock:
+            now = monotonic()
+            if now - self._last < self.interval:
+                return False
+            self._last = now
+            return True
+
+    def log(self):
+        self.logger.info("Service stats: %s", json.dumps(self.report(), sort_keys=True, default=str))
+
+
+stats_report = StatsReport()
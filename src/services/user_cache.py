@@ -0,0 +1,211 @@
+"""
+BookWorm Den current user cache
+"""
+
+import threading
+from collections import OrderedDict
+from time import monotonic
+
+from flask import abort
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session
+
+from models import db, User, ClubMembers
+
+IDENTITY_FIELDS = ("username", "first_name", "last_name")
+
+
+class UserCache:
+    """Short lived, per-process cache of user identities and membership summaries.
+
+    Identity holds the fields rendered on every page, memberships map club id to status.
+    Entries are dropped when a User or ClubMembers row of the user is flushed and again
+    after the transaction commits, so each worker is at most ttl seconds behind the others.
+    """
+
+    def __init__(self, ttl=30, max_entries=4096):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # user_id -> {"expires_at", "identity", "memberships"}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def init_app(self, app):
+        """Read the cache limits from the flask app configuration"""
+        self.ttl = app.config.get("USER_CACHE_TTL", self.ttl)
+        self.max_entries = app.config.get("USER_CACHE_MAX_ENTRIES", self.max_entries)
+        app.extensions["user_cache"] = self
+
+    def identity(self, user_id):
+        """Username and names of a user, None when the user does not exist"""
+        identity = self._lookup(user_id, "identity")
+        if identity is None:
+            row = db.session.execute(
+                select(*(getattr(User, field) for field in IDENTITY_FIELDS)).where(User.id == user_id)
+            ).first()
+            if row is None:
+                return None
+            identity = {field: getattr(row, field) for field in IDENTITY_FIELDS}
+            self._store(user_id, "identity", identity)
+        return identity
+
+    def remember_user(self, user):
+        """Store the identity of an already loaded User"""
+        self._store(user.id, "identity", {field: getattr(user, field) for field in IDENTITY_FIELDS})
+
+    def memberships(self, user_id):
+        """Map of club id to membership status for a user"""
+        memberships = self._lookup(user_id, "memberships")
+        if memberships is None:
+            rows = db.session.execute(
+                select(ClubMembers.club_id, ClubMembers.status).where(
+                    ClubMembers.member_id == user_id
+                )
+            )
+            memberships = {club_id: status for club_id, status in rows}
+            self._store(user_id, "memberships", memberships)
+        return memberships
+
+    def invalidate(self, user_id):
+        """Drop the cached identity and memberships of a user"""
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        """Drop every entry and reset the counters"""
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+
+    def stats(self):
+        """Hit/miss counters and current occupancy"""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries)}
+
+    def _lookup(self, user_id, part):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry and entry["expires_at"] <= monotonic():
+                del self._entries[user_id]
+                entry = None
+            if entry and entry.get(part) is not None:
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return entry[part]
+            self.misses += 1
+            return None
+
+    def _store(self, user_id, part, value):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or entry["expires_at"] <= monotonic():
+                entry = self._entries[user_id] = {"expires_at": monotonic() + self.ttl}
+            entry[part] = value
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+user_cache = UserCache()
+
+
+class CurrentUser:
+    """Lazy stand-in for the logged in User, stored on flask.g by load_user.
+
+    The id, identity fields and membership summary are answered without loading the User,
+    any other attribute loads it on first access (404 when the account no longer exists).
+    """
+
+    def __init__(self, user_id, cache=user_cache):
+        self.id = user_id
+        self._cache = cache
+        self._user = None
+
+    def __bool__(self):
+        return True
+
+    def __eq__(self, other):
+        return getattr(other, "id", None) == self.id and isinstance(other, (User, CurrentUser))
+
+    def __hash__(self):
+        return hash((User, self.id))
+
+    def __repr__(self):
+        return f"<CurrentUser {self.id}>"
+
+    @property
+    def username(self):
+        return self._identity()["username"]
+
+    @property
+    def first_name(self):
+        return self._identity()["first_name"]
+
+    @property
+    def last_name(self):
+        return self._identity()["last_name"]
+
+    def club_ids(self, statuses=(1, 2)):
+        """Ids of the clubs where the user membership has one of the statuses"""
+        return {
+            club_id
+            for club_id, status in self._cache.memberships(self.id).items()
+            if status in statuses
+        }
+
+    def _get_current_object(self):
+        """The User model instance, loaded on first use"""
+        if self._user is None:
+            self._user = db.get_or_404(User, self.id)
+            self._cache.remember_user(self._user)
+        return self._user
+
+    def _identity(self):
+        if self._user is not None:
+            return {field: getattr(self._user, field) for field in IDENTITY_FIELDS}
+        identity = self._cache.identity(self.id)
+        if identity is None:
+            abort(404)
+        return identity
+
+    def __getattr__(self, name):
+        return getattr(self._get_current_object(), name)
+
+
+"""
+Invalidation
+"""
+
+
+def _mark_changed(target, user_id):
+    session = Session.object_session(target)
+    if session is not None:
+        session.info.setdefault("user_cache_changed", set()).add(user_id)
+    user_cache.invalidate(user_id)
+
+
+def _mark_user(mapper, connection, target):
+    _mark_changed(target, target.id)
+
+
+def _mark_member(mapper, connection, target):
+    _mark_changed(target, target.member_id)
+
+
+for _event in ("after_insert", "after_update", "after_delete"):
+    event.listen(User, _event, _mark_user)
+    event.listen(ClubMembers, _event, _mark_member)
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_committed(session):
+    """Drop again after commit any entry refilled while the transaction was open"""
+    for user_id in session.info.pop("user_cache_changed", ()):
+        user_cache.invalidate(user_id)
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def _forget_rolled_back(session, previous_transaction):
+    for user_id in session.info.pop("user_cache_changed", ()):
+        user_cache.invalidate(user_id)
@@ -0,0 +1,197 @@
+"""
+BookWorm Den volume details cache
+"""
+
+import json
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from time import monotonic
+
+from flask import current_app
+from sqlalchemy import bindparam, update
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
+
+from models import db, Book
+
+
+def utcnow():
+    """Naive UTC timestamp, matching the DateTime columns used by the models"""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+class VolumeCache:
+    """Cache for Google Books volume payloads, keyed by volume id.
+
+    Entries live in an in-process LRU map bounded by entry count and total payload size.
+    Payloads are kept as JSON text, so every get returns a copy the caller is free to change.
+    On a memory miss the raw payload stored on the local Book row is used while it is
+    younger than the TTL, so cached details survive restarts and are shared by workers.
+    """
+
+    def __init__(self, ttl=86400, max_entries=1024, max_bytes=8 * 1024 * 1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # volume_id -> (expires_at, size, payload)
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.db_hits = 0
+        self.misses = 0
+
+    def init_app(self, app):
+        """Read the cache limits from the flask app configuration"""
+        self.ttl = app.config.get("VOLUME_CACHE_TTL", self.ttl)
+        self.max_entries = app.config.get("VOLUME_CACHE_MAX_ENTRIES", self.max_entries)
+        self.max_bytes = app.config.get("VOLUME_CACHE_MAX_BYTES", self.max_bytes)
+        app.extensions["volume_cache"] = self
+
+    def get(self, volume_id):
+        """Return the cached payload for a volume or None when it is missing or expired"""
+        with self._lock:
+            entry = self._entries.get(volume_id)
+            if entry and entry[0] > monotonic():
+                self._entries.move_to_end(volume_id)
+                self.hits += 1
+                return json.loads(entry[2])
+            if entry:
+                self._discard(volume_id)
+
+        encoded = self._load_stored(volume_id)
+        with self._lock:
+            if encoded is None:
+                self.misses += 1
+                return None
+            self.db_hits += 1
+        self._remember(volume_id, encoded)
+        return json.loads(encoded)
+
+    def get_many(self, volume_ids):
+        """Return {volume_id: payload} for the cached volumes among volume_ids.
+        The volumes missing from memory are read from their Book rows with a single query."""
+        encoded = {}
+        missing = []
+        with self._lock:
+            now = monotonic()
+            for volume_id in volume_ids:
+                entry = self._entries.get(volume_id)
+                if entry and entry[0] > now:
+                    self._entries.move_to_end(volume_id)
+                    self.hits += 1
+                    encoded[volume_id] = entry[2]
+                    continue
+                if entry:
+                    self._discard(volume_id)
+                missing.append(volume_id)
+
+        stored = {}
+        if missing:
+            for book in db.session.query(Book).filter(Book.api_id.in_(missing)):
+                payload = self._stored_payload(book)
+                if payload is not None:
+                    stored[book.api_id] = payload
+        with self._lock:
+            self.db_hits += len(stored)
+            self.misses += len(missing) - len(stored)
+        for volume_id, payload in stored.items():
+            self._remember(volume_id, payload)
+        encoded.update(stored)
+        return {volume_id: json.loads(payload) for volume_id, payload in encoded.items()}
+
+    def set(self, volume_id, payload):
+        """Store a fresh upstream payload in memory and on the local Book row, if any"""
+        self.set_many({volume_id: payload})
+
+    def set_many(self, payloads):
+        """Store fresh upstream payloads given as {volume_id: payload}, with a single database write"""
+        encoded = {volume_id: json.dumps(payload) for volume_id, payload in payloads.items()}
+        for volume_id, payload in encoded.items():
+            self._remember(volume_id, payload)
+        if encoded:
+            self._persist(encoded)
+
+    def invalidate(self, volume_id):
+        """Drop a volume from the in-process cache"""
+        with self._lock:
+            self._discard(volume_id)
+
+    def clear(self):
+        """Drop every in-process entry and reset the counters"""
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+            self.hits = self.db_hits = self.misses = 0
+
+    def stats(self):
+        """Hit/miss counters and current occupancy"""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "db_hits": self.db_hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+                "bytes": self._size,
+            }
+
+    def _remember(self, volume_id, encoded):
+        size = len(encoded)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            self._discard(volume_id)
+            self._entries[volume_id] = (monotonic() + self.ttl, size, encoded)
+            self._size += size
+            while self._entries and (
+                len(self._entries) > self.max_entries or self._size > self.max_bytes
+            ):
+                _, (_, evicted_size, _) = self._entries.popitem(last=False)
+                self._size -= evicted_size
+
+    def _discard(self, volume_id):
+        entry = self._entries.pop(volume_id, None)
+        if entry:
+            self._size -= entry[1]
+
+    def _load_stored(self, volume_id):
+        book = db.session.get(Book, volume_id)
+        return self._stored_payload(book) if book else None
+
+    def _stored_payload(self, book):
+        """Payload stored on a Book row, None when it is missing, expired or invalid"""
+        if not book.raw_payload or not book.fetched_at:
+            return None
+        if utcnow() - book.fetched_at > timedelta(seconds=self.ttl):
+            return None
+        try:
+            json.loads(book.raw_payload)
+        except ValueError:
+            return None
+        return book.raw_payload
+
+    def _persist(self, encoded):
+        """Write the payloads to their Book rows in a session of its own, so storing the cache
+        never commits or rolls back the pending changes of the request session"""
+        books = Book.__table__
+        statement = (
+            update(books)
+            .where(books.c.api_id == bindparam("volume_id"))
+            .values(raw_payload=bindparam("payload"), fetched_at=utcnow())
+        )
+        try:
+            with Session(db.engine) as session, session.begin():
+                session.execute(
+                    statement,
+                    [{"volume_id": volume_id, "payload": payload} for volume_id, payload in encoded.items()],
+                )
+        except SQLAlchemyError as error:
+            current_app.logger.warning("Could not store the volume payloads of %s: %s", ", ".join(encoded), error)
+            return
+        for volume_id in encoded:
+            book = db.session.identity_map.get(db.session.identity_key(Book, volume_id))
+            if book is not None:
+                db.session.expire(book, ["raw_payload", "fetched_at"])
+
+
+volume_cache = VolumeCache()
@@ -21,13 +21,22 @@ const userIsLogged = $("#user-page-link").length ? true : false;
 //================================================================
 //Supporting Functions
 
+//function to build the local cover proxy address for a book thumbnail
+function coverUrl(book, size) {
+    if (!book.thumbnail) {
+        return "";
+    }
+    const params = new URLSearchParams({ src: book.thumbnail, size: size });
+    return `/covers/${book.id}?${params}`;
+}
+
 //function to create book search result markup
 function addMarkup(book) {
     const template = document
         .getElementById("book-search-result-template")
         .content.cloneNode(true);
 
-    template.querySelector(".book-cover-image").src = book.thumbnail;
+    template.querySelector(".book-cover-image").src = coverUrl(book, "small");
     template.querySelector(".book-cover-image").id = book.id;
     template.querySelector(".book-link").textContent = book.title;
     template.querySelector(".book-link").id = book.id;
@@ -62,7 +71,7 @@ function addBookDetailsMarkup(book) {
         .getElementById("book-details-template")
         .content.cloneNode(true);
 
-    template.querySelector(".book-thumbnail").src = book.thumbnail;
+    template.querySelector(".book-thumbnail").src = coverUrl(book, "medium");
     template.querySelector(".book-title").textContent = book.title;
     template.querySelector(".book-authors").textContent = book.authors;
     template.querySelector(
@@ -16,11 +16,15 @@ const divDescription = document.querySelector("#div-description");
 const divStatistics = document.querySelector("#div-statistics");
 const divComments = document.querySelector("#div-comments");
 const listComments = document.querySelector("#ul-comments");
+const commentsSummary = document.querySelector("#comments-summary");
 const divAddComment = document.querySelector("#div-add-comment");
 const divBookClubs = document.querySelector("#div-book-clubs");
 const listClubs = document.querySelector("#ul-clubs");
 const clubSelectList = document.querySelector("#club-select-list");
 const addReadingClubButton = document.querySelector("#add-reading-club");
+const moreCommentsButton = document.querySelector("#more-comments-btn");
+let commentsBookId = null;
+let commentsCursor = null;
 
 //================================================================
 //Supporting Functions
@@ -44,6 +48,30 @@ function getCommentMarkup(comment) {
       `;
 }
 
+// Function to describe the rating summary of a book: {count, mean_rating, histogram}
+function getSummaryText(summary) {
+    if (!summary || summary.count === 0) {
+        return "";
+    }
+    const comments = summary.count === 1 ? "1 comment" : `${summary.count} comments`;
+    if (summary.mean_rating === null) {
+        return `${comments}, no ratings yet`;
+    }
+    const stars = [5, 4, 3, 2, 1, 0]
+        .map((star) => `${star}★ ${summary.histogram[star]}`)
+        .join(" · ");
+    return `Average rating ${summary.mean_rating} from ${comments} (${stars})`;
+}
+
+// Function to create li element with a book comment
+function getCommentLi(comment) {
+    const commentEntry = document.createElement("li");
+    commentEntry.id = `(${comment.user_id},${comment.book_id})`;
+    commentEntry.classList.add("list-group-item");
+    commentEntry.innerHTML = getCommentMarkup(comment);
+    return commentEntry;
+}
+
 // Function to create li element with reading club name
 function getClubLi(clubName) {
     newLi = document.createElement("li");
@@ -80,6 +108,9 @@ bookComments.addEventListener("click", showComments);
 bookAddComment.addEventListener("click", showAddComment);
 bookClubs.addEventListener("click", showBookClubs);
 
+// Event Listener to load the next page of comments
+moreCommentsButton.addEventListener("click", loadMoreComments);
+
 // Event Listener to add book to a reading club
 addReadingClubButton.addEventListener("click", addReadingClub);
 
@@ -127,22 +158,37 @@ async function showComments(event) {
     divAddComment.hidden = true;
     divBookClubs.hidden = true;
     const bookId = event.target.dataset.book;
-    const commentsList = await Comment.getAllComments(bookId);
-    if (!commentsList) {
-        listComments.innerHTML = "";
+    const page = await Comment.getCommentsPage(bookId, null);
+    commentsBookId = bookId;
+    commentsCursor = page ? page.nextCursor : null;
+    moreCommentsButton.hidden = !commentsCursor;
+    commentsSummary.innerText = page ? getSummaryText(page.summary) : "";
+    listComments.innerHTML = "";
+    if (!page || page.comments.length === 0) {
         const newLine = document.createElement("p");
         newLine.innerText = "No comments found in the server.";
         listComments.appendChild(newLine);
     } else {
-        listComments.innerHTML = "";
-        commentsList.forEach((comment) => {
-            const htmlComment = getCommentMarkup(comment);
-            const commentEntry = document.createElement("li");
-            commentEntry.id = `(${comment.user_id},${comment.book_id})`;
-            commentEntry.classList.add("list-group-item");
-            commentEntry.innerHTML = htmlComment;
-            listComments.appendChild(commentEntry);
+        page.comments.forEach((comment) => {
+            listComments.appendChild(getCommentLi(comment));
+        });
+    }
+}
+
+// Procedure to append the next page of comments to the comments tab
+async function loadMoreComments(event) {
+    if (!commentsCursor) {
+        return;
+    }
+    moreCommentsButton.disabled = true;
+    const page = await Comment.getCommentsPage(commentsBookId, commentsCursor);
+    moreCommentsButton.disabled = false;
+    if (page) {
+        page.comments.forEach((comment) => {
+            listComments.appendChild(getCommentLi(comment));
         });
+        commentsCursor = page.nextCursor;
+        moreCommentsButton.hidden = !commentsCursor;
     }
 }
 
@@ -209,11 +255,14 @@ async function addReadingClub(event) {
 if (typeof module !== "undefined" && module.exports) {
     module.exports = {
         getCommentMarkup,
+        getSummaryText,
+        getCommentLi,
         getClubLi,
         addClub,
         showDescription,
         showStatistics,
         showComments,
+        loadMoreComments,
         showAddComment,
         showBookClubs,
         addReadingClub,
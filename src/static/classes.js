@@ -39,8 +39,36 @@ class Book {
         }
         return new Book(response.data);
     }
+
+    static async getBookDetailsByIds(bookIds) {
+        /**Class method to get book details for a list of book IDs, IDs provided as an array.
+         * The IDs are sent in batches of up to BATCH_SIZE, all batches requested at once */
+        const batches = [];
+        for (let start = 0; start < bookIds.length; start += Book.BATCH_SIZE) {
+            batches.push(bookIds.slice(start, start + Book.BATCH_SIZE));
+        }
+        const responses = await Promise.all(
+            batches.map((batch) =>
+                axios
+                    .get(`/books/batch`, {
+                        params: { ids: batch.join(",") },
+                    })
+                    .catch((error) => {
+                        return error;
+                    })
+            )
+        );
+        if (responses.some((response) => response instanceof Error)) {
+            return;
+        }
+        return responses.flatMap((response) =>
+            response.data.books.map((book) => new Book(book))
+        );
+    }
 }
 
+Book.BATCH_SIZE = 40; // BOOKS_BATCH_MAX of the backend
+
 class Comment {
     /**
      * Class to store book comments information.
@@ -51,16 +79,32 @@ class Comment {
     }
 
     static async getAllComments(volumeId) {
-        /**Class method to get all available comments for a given book */
+        /**Class method to get the first page of comments for a given book */
+        const page = await Comment.getCommentsPage(volumeId, null);
+        if (!page) {
+            return;
+        }
+        return page.comments;
+    }
+
+    static async getCommentsPage(volumeId, cursor) {
+        /**Class method to get a page of comments for a given book, cursor is the nextCursor of the previous page.
+         * The first page also includes the rating summary {count, mean_rating, histogram} */
         const response = await axios
-            .get(`/comments/${volumeId}`)
+            .get(`/comments/${volumeId}`, {
+                params: cursor ? { cursor: cursor } : {},
+            })
             .catch((error) => {
                 return error;
             });
         if (response instanceof Error) {
             return;
         }
-        return response.data.comments.map((comment) => new Comment(comment));
+        return {
+            comments: response.data.comments.map((comment) => new Comment(comment)),
+            summary: response.data.summary,
+            nextCursor: response.data.next_cursor,
+        };
     }
 }
 
@@ -103,11 +147,16 @@ class Message {
         Object.assign(this, { ...properties });
     }
 
-    static async getClubMessages(clubId, offset, quantity) {
-        /**Class method to get club messages from the server*/
+    static async getClubMessages(clubId, before, quantity) {
+        /**Class method to get club messages from the server, newest first.
+         * before is the cursor returned with the previous page, null for the latest messages */
+        const params = { quantity: quantity };
+        if (before) {
+            params.before = before;
+        }
         const response = await axios
             .get(`/forum/${clubId}/messages`, {
-                params: { start: offset, quantity: quantity },
+                params: params,
             })
             .catch((error) => {
                 return error;
@@ -115,8 +164,58 @@ class Message {
         if (response instanceof Error) {
             return false;
         }
-        return response.data.messages.map((message) => new Message(message));
-        //messages format from server: {id, message, timestamp, user_first_name, user_last_name, user_username}
+        return {
+            messages: response.data.messages.map((message) => new Message(message)),
+            nextBefore: response.data.next_before,
+            changesSeq: response.data.changes_seq,
+        };
+        //messages format from server: {id, message, timestamp (ISO 8601 UTC), user_first_name, user_last_name, user_username}
+    }
+
+    static async getClubChanges(clubId, since) {
+        /**Class method to get the forum changes after a change log position.
+         * Each change is {seq, type, message} for created and edited messages, {seq, type, id} for deleted ones */
+        const response = await axios
+            .get(`/forum/${clubId}/changes`, { params: { since: since } })
+            .catch((error) => {
+                return error;
+            });
+        if (response instanceof Error) {
+            return false;
+        }
+        return response.data;
+    }
+
+    static async markRead(clubId, messageId) {
+        /**Class method to move the member read marker of a club forum to a message */
+        const response = await axios
+            .post(`/forum/${clubId}/read`, { message_id: messageId })
+            .catch((error) => {
+                return error;
+            });
+        return !(response instanceof Error);
+    }
+
+    static async searchClubMessages(clubId, query, cursor) {
+        /**Class method to search the club forum, best matches first.
+         * cursor is the one returned with the previous page of results, null for the first page */
+        const params = { q: query };
+        if (cursor) {
+            params.cursor = cursor;
+        }
+        const response = await axios
+            .get(`/forum/${clubId}/search`, { params: params })
+            .catch((error) => {
+                return error;
+            });
+        if (response instanceof Error) {
+            return false;
+        }
+        return {
+            results: response.data.results.map((message) => new Message(message)),
+            nextCursor: response.data.next_cursor,
+        };
+        //results are forum messages with highlight: escaped HTML extract with the matched words in <mark>
     }
 
     static async sendNewMessage(clubId, message) {
@@ -131,7 +230,7 @@ class Message {
         if (response instanceof Error) {
             return false;
         }
-        return new Message(message);
+        return new Message(response.data.message);
     }
 
     static async sendDelete(clubId, messageId) {
@@ -161,7 +260,7 @@ class Message {
         if (response instanceof Error) {
             return false;
         }
-        return new Message(message);
+        return new Message(response.data.message);
     }
 }
 
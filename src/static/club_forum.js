@@ -13,6 +13,19 @@ const userUsername = $("#user-page-link").text();
 const $newMessageContent = $("#new-message-content");
 const $sendMessageButton = $("#send-message-btn");
 const $messageForm = $("#new-message-form");
+const $olderMessagesButton = $("#older-messages-btn");
+const $searchInput = $("#forum-search-input");
+const $searchButton = $("#forum-search-btn");
+const $searchResultsUl = $("#forum-search-results");
+const $moreResultsButton = $("#more-results-btn");
+let olderMessagesCursor = null;
+let forumStream = null;
+let changesSeq = null;
+let readMessageId = null;
+let markReadTimer = null;
+const MARK_READ_DELAY = 2000;
+let searchQuery = "";
+let searchCursor = null;
 
 // clubId = club.id variable injected from backend
 
@@ -44,11 +57,74 @@ function getMessageMarkup(message) {
         "#message-user"
     ).textContent = `${message["user_first_name"]} ${message["user_last_name"]}`;
     template.querySelector("#message-timestamp").textContent =
-        message.timestamp;
+        formatTimestamp(message.timestamp);
 
     return template;
 }
 
+// Function to format the ISO 8601 timestamp of a message in the browser locale and time zone
+function formatTimestamp(timestamp) {
+    const date = new Date(timestamp);
+    if (isNaN(date)) {
+        return timestamp;
+    }
+    return date.toLocaleString(undefined, {
+        day: "2-digit",
+        month: "short",
+        year: "2-digit",
+        hour: "2-digit",
+        minute: "2-digit",
+    });
+}
+
+// Function to add a list of messages at the end of the forum list
+function appendMessages(messageList) {
+    messageList.forEach((message) => {
+        const messageContent = getMessageMarkup(message);
+        const messageText = messageContent.querySelector("#message-text");
+        messageText.textContent = message["message"];
+        messageText.style.whiteSpace = "pre-wrap";
+        $messagesUl.append(messageContent);
+    });
+}
+
+// Function to add a message at the top of the forum list, a message already shown gets its text updated
+function prependMessage(message) {
+    if ($messagesUl.find(`[data-messageid=${message.id}]`).length) {
+        replaceMessageText(message);
+        return;
+    }
+    const messageContent = getMessageMarkup(message);
+    const messageText = messageContent.querySelector("#message-text");
+    messageText.textContent = message["message"];
+    messageText.style.whiteSpace = "pre-wrap";
+    $messagesUl.prepend(messageContent);
+}
+
+// Function to replace the text of a message shown in the forum list
+function replaceMessageText(message) {
+    const $messageDiv = $messagesUl.find(`[data-messagecontent=${message.id}]`);
+    $messageDiv.empty();
+    $messageDiv.text(message["message"]);
+}
+
+// Function to remove a message from the forum list
+function dropMessage(messageId) {
+    $messagesUl.find(`[data-messageid=${messageId}]`).remove();
+}
+
+// Function to add a list of search results at the end of the results list
+function appendSearchResults(resultList) {
+    resultList.forEach((result) => {
+        const resultContent = getMessageMarkup(result);
+        resultContent.querySelector("#remove-message").style.display = "none";
+        resultContent.querySelector("#edit-message").style.display = "none";
+        // highlight is escaped by the server, only the <mark> tags are markup
+        resultContent.querySelector("#message-text").innerHTML = result["highlight"];
+        $searchResultsUl.append(resultContent);
+    });
+}
+
 // Function to create the input text area for a message edit. Event listener to handle updates
 function getMessageEditMarkup(message) {
     const inputMarkup = `
@@ -88,9 +164,22 @@ $sendMessageButton.on("click", sendNewMessage);
 // Event listener to process user click to delete or edit a message
 $messagesUl.on("click", processMessageIcon);
 
+// Event listener to load older forum messages
+$olderMessagesButton.on("click", loadOlderMessages);
+
+// Event listeners to search the forum messages
+$searchButton.on("click", searchForum);
+$searchInput.on("keydown", (event) => {
+    if (event.key === "Enter") {
+        searchForum();
+    }
+});
+$moreResultsButton.on("click", loadMoreResults);
+
 // Event listener to process the forum messages once the page load is complete
-$(document).ready(() => {
-    loadInitialMessages();
+$(document).ready(async () => {
+    await loadInitialMessages();
+    connectForumStream();
 });
 
 //----------------------------------------------------------------
@@ -100,25 +189,137 @@ $(document).ready(() => {
 async function loadInitialMessages() {
     $forumMessageLoading.prop("hidden", false);
     $messagesUl.empty();
-    const messageList = await Message.getClubMessages(clubId, 0, 20);
-    if (messageList) {
-        messageList.forEach((message) => {
-            const messageContent = getMessageMarkup(message);
-            const messageText = messageContent.querySelector("#message-text");
-            messageText.textContent = message["message"];
-            messageText.style.whiteSpace = "pre-wrap";
-            $messagesUl.append(messageContent);
+    const page = await Message.getClubMessages(clubId, null, 20);
+    if (page) {
+        appendMessages(page.messages);
+        olderMessagesCursor = page.nextBefore;
+        changesSeq = page.changesSeq;
+        $olderMessagesButton.prop("hidden", !olderMessagesCursor);
+        $forumMessageLoading.prop("hidden", true);
+    }
+}
+
+// Procedure to apply the forum changes made since the messages were loaded, reloading them if that fails
+async function syncChanges() {
+    if (changesSeq === null || changesSeq === undefined) {
+        return loadInitialMessages();
+    }
+    let delta;
+    do {
+        delta = await Message.getClubChanges(clubId, changesSeq);
+        if (!delta) {
+            return loadInitialMessages();
+        }
+        delta.changes.forEach((change) => {
+            if (change.type === "deleted") {
+                dropMessage(change.id);
+            } else if (change.type === "edited") {
+                replaceMessageText(change.message);
+            } else {
+                prependMessage(change.message);
+                scheduleMarkRead(change.message.id);
+            }
         });
+        changesSeq = delta.latest;
+    } while (delta.more);
+}
+
+// Procedure to follow the forum changes pushed by the server, starting at the change log position of
+// the first page. The browser reconnects on its own, resuming after the last event received; a
+// reset event means the position was lost and the changes since the last sync are requested instead
+function connectForumStream() {
+    if (typeof EventSource === "undefined" || forumStream) {
+        return;
+    }
+    const since = changesSeq === null || changesSeq === undefined ? "" : `?since=${changesSeq}`;
+    forumStream = new EventSource(`/forum/${clubId}/stream${since}`);
+    forumStream.addEventListener("created", (event) => {
+        const message = JSON.parse(event.data);
+        prependMessage(message);
+        advanceChangesSeq(event);
+        scheduleMarkRead(message.id);
+    });
+    forumStream.addEventListener("edited", (event) => {
+        replaceMessageText(JSON.parse(event.data));
+        advanceChangesSeq(event);
+    });
+    forumStream.addEventListener("deleted", (event) => {
+        dropMessage(JSON.parse(event.data).id);
+        advanceChangesSeq(event);
+    });
+    forumStream.addEventListener("reset", syncChanges);
+}
+
+// Procedure to move the read marker to a message shown live, batching the messages of a burst in one call
+function scheduleMarkRead(messageId) {
+    if (readMessageId !== null && messageId <= readMessageId) {
+        return;
+    }
+    readMessageId = messageId;
+    if (markReadTimer === null) {
+        markReadTimer = setTimeout(() => {
+            markReadTimer = null;
+            Message.markRead(clubId, readMessageId);
+        }, MARK_READ_DELAY);
+    }
+}
+
+// Procedure to move the change log position to a stream event id, so a later sync starts after it
+function advanceChangesSeq(event) {
+    const seq = parseInt(event.lastEventId, 10);
+    if (!Number.isNaN(seq) && (changesSeq === null || changesSeq === undefined || seq > changesSeq)) {
+        changesSeq = seq;
+    }
+}
+
+// Procedure to load the next 20 older messages at the end of the forum list
+async function loadOlderMessages() {
+    if (!olderMessagesCursor) {
+        return;
+    }
+    $forumMessageLoading.prop("hidden", false);
+    const page = await Message.getClubMessages(clubId, olderMessagesCursor, 20);
+    if (page) {
+        appendMessages(page.messages);
+        olderMessagesCursor = page.nextBefore;
+        $olderMessagesButton.prop("hidden", !olderMessagesCursor);
         $forumMessageLoading.prop("hidden", true);
     }
 }
 
+// Procedure to search the forum messages, an empty search hides the results
+async function searchForum() {
+    searchQuery = $searchInput.val().trim();
+    searchCursor = null;
+    $searchResultsUl.empty();
+    $searchResultsUl.prop("hidden", !searchQuery);
+    $moreResultsButton.prop("hidden", true);
+    if (searchQuery) {
+        await loadMoreResults();
+    }
+}
+
+// Procedure to load the next page of search results
+async function loadMoreResults() {
+    const page = await Message.searchClubMessages(clubId, searchQuery, searchCursor);
+    if (page) {
+        if (!searchCursor && !page.results.length) {
+            $searchResultsUl.append(
+                $("<li>", { class: "list-group-item text-center" }).text("No messages found")
+            );
+        }
+        appendSearchResults(page.results);
+        searchCursor = page.nextCursor;
+        $moreResultsButton.prop("hidden", !searchCursor);
+    }
+}
+
 // Procedure to add a new message to the forum.
 async function sendNewMessage() {
     const messageContent = $newMessageContent.val();
     const message = await Message.sendNewMessage(clubId, messageContent);
     if (message) {
-        loadInitialMessages();
+        prependMessage(message);
         $newMessageContent.val("");
     } else {
         const error = $("<small>", { class: "error" }).text(
@@ -132,7 +333,7 @@ async function sendNewMessage() {
 async function removeMessage(messageId) {
     const deleted = await Message.sendDelete(clubId, messageId);
     if (deleted) {
-        loadInitialMessages();
+        dropMessage(messageId);
     } else {
         const error = $("<small>", { class: "error" }).text(
             "Error - Failed to remove message"
@@ -159,7 +360,7 @@ async function updateMessage(event) {
         (message = messageInput.value)
     );
     if (update) {
-        loadInitialMessages();
+        replaceMessageText(update);
     } else {
         const error = $("<small>", { class: "error" }).text(
             "Error - Failed to update message"
@@ -174,9 +375,22 @@ async function updateMessage(event) {
 if (typeof module !== "undefined" && module.exports) {
     module.exports = {
         getMessageMarkup,
+        formatTimestamp,
         getMessageEditMarkup,
         processMessageIcon,
+        appendMessages,
         loadInitialMessages,
+        loadOlderMessages,
+        connectForumStream,
+        advanceChangesSeq,
+        scheduleMarkRead,
+        syncChanges,
+        appendSearchResults,
+        searchForum,
+        loadMoreResults,
+        prependMessage,
+        replaceMessageText,
+        dropMessage,
         sendNewMessage,
         removeMessage,
         showEditMessage,
@@ -17,6 +17,7 @@ const userSearchInput = document.querySelector("#user-input");
 const userDropdown = document.querySelector("#user-dropdown-list");
 const membersListDiv = document.querySelector("#members-list");
 const deleteBookButton = document.querySelectorAll("[data-delete-book-btn]");
+const readingListDetails = document.querySelectorAll("[data-book-details]");
 
 // clubId = club.id variable injected from backend
 
@@ -105,6 +106,9 @@ deleteBookButton.forEach((button) => {
     button.addEventListener("click", deleteBook);
 });
 
+// Event listener to complete the reading list details once the page load is complete
+document.addEventListener("DOMContentLoaded", showReadingListDetails);
+
 // Event listener to process request to send a join request to a member
 sendInviteButton.addEventListener("click", addMember);
 
@@ -208,6 +212,27 @@ async function deleteMember(event) {
     }
 }
 
+// Procedure to complete the reading list with the authors and publishing date of each book, in a single request
+async function showReadingListDetails() {
+    const bookIds = [...readingListDetails].map((entry) => entry.dataset.bookDetails);
+    if (!bookIds.length) {
+        return;
+    }
+    const books = await Book.getBookDetailsByIds(bookIds);
+    if (!books) {
+        return;
+    }
+    const booksById = new Map(books.map((book) => [book.id, book]));
+    readingListDetails.forEach((entry) => {
+        const book = booksById.get(entry.dataset.bookDetails);
+        if (book) {
+            entry.textContent = [book.authors.join(", "), book.publishedDate]
+                .filter((detail) => detail)
+                .join(" - ");
+        }
+    });
+}
+
 //procedure to delete book from book club reading list
 async function deleteBook(event) {
     const deleted = await sendDeleteBook(event.target.dataset.book, clubId);
@@ -231,5 +256,6 @@ if (typeof module !== "undefined" && module.exports) {
         addMember,
         deleteMember,
         deleteBook,
+        showReadingListDetails,
     };
 }